@@ -0,0 +1,373 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from cachetools import LRUCache
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from core import SessionLocal, get_graph_client, run_db
+from metrics import GRAPH_REQUEST_SECONDS, GRAPH_REQUESTS, graph_outcome
+from structured_logging import describe_error
+from models import Transcription
+from transcription_backends import *
+
+
+# ++++++++++++++++++++++++++++++++++
+# ++++++++++ AUDIO PIPELINE ++++++++
+# ++++++++++++++++++++++++++++++++++
+
+# Voice notes are never held in memory whole. The Graph media download is streamed chunk by
+# chunk into the transcription backend, so a worker only holds one chunk per voice note. Notes
+# larger than AUDIO_MAX_BYTES are rejected (up front from the media metadata, and again while
+# streaming), and at most TRANSCRIPTION_CONCURRENCY notes are downloaded/transcribed at once.
+#
+# Transcriptions are cached by WhatsApp media id and by the audio's SHA-256 (Graph reports it
+# in the media metadata), in memory, so a redelivered or retried webhook never transcribes the
+# same note twice. Concurrent requests for one media id share a single transcription. With
+# TRANSCRIPTION_CACHE_DB=true the cache is also kept in the Transcriptions table, across
+# restarts and instances. Those rows are patient data: they are only used, and kept, for
+# TRANSCRIPTION_CACHE_DB_DAYS, and the webhook queue's recovery loop deletes older ones.
+#
+# With TRANSCRIPTION_BATCH_SIZE > 1, downloaded notes are spooled (to disk past
+# AUDIO_SPOOL_BYTES) and handed to the backend together, up to TRANSCRIPTION_BATCH_SIZE notes
+# or whatever arrived within TRANSCRIPTION_BATCH_WINDOW seconds.
+
+AUDIO_MAX_BYTES = int(os.getenv("AUDIO_MAX_BYTES", 16 * 1024 * 1024))  # WhatsApp's own limit for audio
+AUDIO_CHUNK_SIZE = int(os.getenv("AUDIO_CHUNK_SIZE", 64 * 1024))
+AUDIO_SPOOL_BYTES = int(os.getenv("AUDIO_SPOOL_BYTES", 1024 * 1024))
+TRANSCRIPTION_CONCURRENCY = int(os.getenv("TRANSCRIPTION_CONCURRENCY", 4))
+TRANSCRIPTION_CACHE_SIZE = int(os.getenv("TRANSCRIPTION_CACHE_SIZE", 10000))
+TRANSCRIPTION_CACHE_DB = os.getenv("TRANSCRIPTION_CACHE_DB", "false").lower() == "true"
+TRANSCRIPTION_CACHE_DB_DAYS = float(os.getenv("TRANSCRIPTION_CACHE_DB_DAYS", 7))
+TRANSCRIPTION_PRUNE_BATCH_SIZE = int(os.getenv("TRANSCRIPTION_PRUNE_BATCH_SIZE", 1000))
+TRANSCRIPTION_BATCH_SIZE = int(os.getenv("TRANSCRIPTION_BATCH_SIZE", 1))
+TRANSCRIPTION_BATCH_WINDOW = float(os.getenv("TRANSCRIPTION_BATCH_WINDOW", 0.5))
+TRANSCRIPTION_LATENCY_SAMPLES = int(os.getenv("TRANSCRIPTION_LATENCY_SAMPLES", 1000))
+
+logger = logging.getLogger(__name__)
+
+_semaphore = asyncio.Semaphore(TRANSCRIPTION_CONCURRENCY)
+_by_media_id = LRUCache(maxsize=TRANSCRIPTION_CACHE_SIZE)
+_by_hash = LRUCache(maxsize=TRANSCRIPTION_CACHE_SIZE)
+_in_flight: dict[str, asyncio.Task] = {}
+_batch_queue: asyncio.Queue | None = None
+_batcher: asyncio.Task | None = None
+_latencies = deque(maxlen=TRANSCRIPTION_LATENCY_SAMPLES)
+_stats = {
+    "hits": 0,
+    "db_hits": 0,
+    "pruned": 0,
+    "coalesced": 0,
+    "transcribed": 0,
+    "too_large": 0,
+    "errors": 0,
+    "in_flight": 0,
+    "waiting": 0,
+    "batches": 0,
+    "max_batch_size": 0,
+    "bytes": 0,
+    "max_bytes_seen": 0,
+    "wait_seconds": 0.0,
+    "metadata_seconds": 0.0,
+    "download_seconds": 0.0,
+    "transcription_seconds": 0.0,
+    "max_metadata_seconds": 0.0,
+    "max_download_seconds": 0.0,
+    "max_transcription_seconds": 0.0,
+}
+
+
+def _record_phase(phase: str, seconds: float):
+    _stats[f"{phase}_seconds"] += seconds
+    _stats[f"max_{phase}_seconds"] = max(_stats[f"max_{phase}_seconds"], seconds)
+
+
+def _cache_transcription(media_id: str, content_hash: str | None, text: str):
+    _by_media_id[media_id] = text
+    if content_hash:
+        _by_hash[content_hash] = text
+
+
+def _transcription_cutoff() -> datetime:
+    return datetime.now(timezone.utc) - timedelta(days=TRANSCRIPTION_CACHE_DB_DAYS)
+
+
+def _load_transcription(media_id: str | None = None, content_hash: str | None = None) -> str | None:
+    db = SessionLocal()
+    try:
+        # Rows past the retention window may not have been pruned yet
+        query = db.query(Transcription.text).filter(Transcription.created_at >= _transcription_cutoff())
+        if content_hash is not None:
+            query = query.filter(Transcription.content_hash == content_hash)
+        else:
+            query = query.filter(Transcription.media_id == media_id)
+        row = query.first()
+        return row.text if row else None
+    finally:
+        db.close()
+
+
+def _save_transcription(media_id: str, content_hash: str, text: str, backend: str):
+    db = SessionLocal()
+    try:
+        db.execute(
+            insert(Transcription)
+            .values(content_hash=content_hash, media_id=media_id, text=text, backend=backend, created_at=datetime.now(timezone.utc))
+            .on_conflict_do_nothing(index_elements=[Transcription.content_hash])
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def prune_transcriptions() -> int:
+    # Runs whether or not the cache is on, so rows written while it was on are still removed
+    batch = select(Transcription.content_hash).where(
+        Transcription.created_at < _transcription_cutoff()
+    ).limit(TRANSCRIPTION_PRUNE_BATCH_SIZE)
+    pruned = 0
+    db = SessionLocal()
+    try:
+        while True:
+            deleted = db.query(Transcription).filter(Transcription.content_hash.in_(batch)).delete(synchronize_session=False)
+            db.commit()
+            pruned += deleted
+            if deleted < TRANSCRIPTION_PRUNE_BATCH_SIZE:
+                break
+    finally:
+        db.close()
+    _stats["pruned"] += pruned
+    return pruned
+
+
+def _content_hash(digest) -> str:
+    # Base64, the same form Graph uses for the sha256 in media metadata
+    return base64.b64encode(digest.digest()).decode()
+
+
+async def _guarded_chunks(download, digest, timings: dict):
+    # Enforces the size limit and hashes the audio as it streams past
+    received = 0
+    async for chunk in download.aiter_bytes(AUDIO_CHUNK_SIZE):
+        received += len(chunk)
+        if received > AUDIO_MAX_BYTES:
+            _stats["too_large"] += 1
+            raise ValueError(f"Audio is larger than AUDIO_MAX_BYTES ({AUDIO_MAX_BYTES})")
+        digest.update(chunk)
+        yield chunk
+    timings["download_finished"] = time.perf_counter()
+    timings["bytes"] = received
+
+
+async def _spooled_chunks(spool):
+    try:
+        spool.seek(0)
+        while chunk := spool.read(AUDIO_CHUNK_SIZE):
+            yield chunk
+    finally:
+        spool.close()
+
+
+async def _batch_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await _batch_queue.get()]
+        deadline = loop.time() + TRANSCRIPTION_BATCH_WINDOW
+        while len(items) < TRANSCRIPTION_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(_batch_queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+
+        _stats["batches"] += 1
+        _stats["max_batch_size"] = max(_stats["max_batch_size"], len(items))
+        try:
+            texts = await get_transcription_backend().transcribe_batch([note for note, _ in items])
+            for (_, future), text in zip(items, texts):
+                if not future.done():
+                    future.set_result(text)
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+
+
+async def _transcribe_batched(note: VoiceNote) -> str:
+    global _batch_queue, _batcher
+    if _batcher is None or _batcher.done():
+        _batch_queue = asyncio.Queue()
+        _batcher = asyncio.create_task(_batch_loop())
+    future = asyncio.get_running_loop().create_future()
+    await _batch_queue.put((note, future))
+    return await future
+
+
+async def stop_transcription_batcher():
+    global _batcher
+    if _batcher is not None:
+        _batcher.cancel()
+        await asyncio.gather(_batcher, return_exceptions=True)
+        _batcher = None
+
+
+async def _download_and_transcribe(media: dict, note_args: dict) -> tuple[str, str, dict]:
+    graph = get_graph_client()
+    digest = hashlib.sha256()
+    timings = {}
+    backend = get_transcription_backend()
+
+    async with graph.stream("GET", media["url"]) as download:
+        GRAPH_REQUESTS.labels("media_download", graph_outcome(download.status_code)).inc()
+        download.raise_for_status()
+        chunks = _guarded_chunks(download, digest, timings)
+        if TRANSCRIPTION_BATCH_SIZE <= 1:
+            text = await backend.transcribe(VoiceNote(chunks=chunks, **note_args))
+            return text, _content_hash(digest), timings
+        spool = tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_BYTES)
+        try:
+            async for chunk in chunks:
+                spool.write(chunk)
+        except Exception:
+            spool.close()
+            raise
+
+    # The batch may wait for other notes, so the semaphore is not held past the download
+    return None, _content_hash(digest), {**timings, "spool": spool}
+
+
+async def _transcribe(media_id: str) -> str | None:
+    if TRANSCRIPTION_CACHE_DB:
+        text = await run_db(_load_transcription, media_id=media_id)
+        if text is not None:
+            _stats["db_hits"] += 1
+            _cache_transcription(media_id, None, text)
+            return text
+
+    started = time.perf_counter()
+    response = await get_graph_client().get(f"/{media_id}/")
+    metadata_seconds = time.perf_counter() - started
+    GRAPH_REQUEST_SECONDS.labels("media_metadata").observe(metadata_seconds)
+    GRAPH_REQUESTS.labels("media_metadata", graph_outcome(response.status_code)).inc()
+    response.raise_for_status()
+    media = response.json()
+    _record_phase("metadata", metadata_seconds)
+
+    # The same audio forwarded or re-sent arrives under a new media id with the same hash
+    content_hash = media.get("sha256")
+    if content_hash:
+        text = _by_hash.get(content_hash)
+        if text is None and TRANSCRIPTION_CACHE_DB:
+            text = await run_db(_load_transcription, content_hash=content_hash)
+            if text is not None:
+                _stats["db_hits"] += 1
+        elif text is not None:
+            _stats["hits"] += 1
+        if text is not None:
+            _cache_transcription(media_id, content_hash, text)
+            return text
+
+    file_size = media.get("file_size")
+    if file_size is not None and int(file_size) > AUDIO_MAX_BYTES:
+        _stats["too_large"] += 1
+        logger.warning("Audio over the size limit", extra={"media_id": media_id, "file_size": int(file_size), "limit": AUDIO_MAX_BYTES})
+        return None
+    note_args = {
+        "media_id": media_id,
+        "mime_type": media.get("mime_type", "audio/ogg").split(";")[0].strip(),
+        "file_size": int(file_size) if file_size is not None else None,
+    }
+
+    waiting_since = time.perf_counter()
+    _stats["waiting"] += 1
+    try:
+        await _semaphore.acquire()
+    finally:
+        _stats["waiting"] -= 1
+    _stats["wait_seconds"] += time.perf_counter() - waiting_since
+    _stats["in_flight"] += 1
+    download_started = time.perf_counter()
+    try:
+        text, computed_hash, timings = await _download_and_transcribe(media, note_args)
+    except Exception:
+        _stats["errors"] += 1
+        raise
+    finally:
+        _stats["in_flight"] -= 1
+        _semaphore.release()
+
+    if "spool" in timings:
+        try:
+            text = await _transcribe_batched(VoiceNote(chunks=_spooled_chunks(timings["spool"]), **note_args))
+        except Exception:
+            _stats["errors"] += 1
+            raise
+    finished = time.perf_counter()
+
+    # The download and the upload overlap; transcription is the time after the last byte was read
+    download_finished = timings.get("download_finished", finished)
+    _record_phase("download", download_finished - download_started)
+    GRAPH_REQUEST_SECONDS.labels("media_download").observe(download_finished - download_started)
+    _record_phase("transcription", finished - download_finished)
+    _latencies.append(finished - download_started)
+    _stats["transcribed"] += 1
+    _stats["bytes"] += timings.get("bytes", 0)
+    _stats["max_bytes_seen"] = max(_stats["max_bytes_seen"], timings.get("bytes", 0))
+
+    if text is None:
+        return None
+    content_hash = content_hash or computed_hash
+    _cache_transcription(media_id, content_hash, text)
+    if TRANSCRIPTION_CACHE_DB:
+        try:
+            await run_db(_save_transcription, media_id, content_hash, text, get_transcription_backend().name)
+        except Exception as e:
+            logger.error("Error saving transcription", extra={"media_id": media_id, "error": describe_error(e)})
+    return text
+
+
+async def transcribe_media(media_id: str) -> str | None:
+    text = _by_media_id.get(media_id)
+    if text is not None:
+        _stats["hits"] += 1
+        return text
+
+    task = _in_flight.get(media_id)
+    if task is not None:
+        _stats["coalesced"] += 1
+    else:
+        task = asyncio.create_task(_transcribe(media_id))
+        _in_flight[media_id] = task
+        task.add_done_callback(lambda _: _in_flight.pop(media_id, None))
+    # Shielded so one cancelled caller does not cancel the transcription the others are waiting on
+    return await asyncio.shield(task)
+
+
+def _percentile(samples: list[float], percent: float) -> float | None:
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+def audio_pipeline_stats() -> dict:
+    lookups = _stats["hits"] + _stats["db_hits"] + _stats["coalesced"] + _stats["transcribed"]
+    latencies = sorted(_latencies)
+    return {
+        **_stats,
+        "backend": TRANSCRIPTION_BACKEND,
+        "batch_size": TRANSCRIPTION_BATCH_SIZE,
+        "concurrency": TRANSCRIPTION_CONCURRENCY,
+        "max_bytes": AUDIO_MAX_BYTES,
+        "hit_rate": (_stats["hits"] + _stats["db_hits"] + _stats["coalesced"]) / lookups if lookups else 0.0,
+        "cache_size": len(_by_media_id),
+        "latency_p50_seconds": _percentile(latencies, 50),
+        "latency_p95_seconds": _percentile(latencies, 95),
+        "latency_p99_seconds": _percentile(latencies, 99),
+    }
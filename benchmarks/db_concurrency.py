@@ -0,0 +1,92 @@
+"""Concurrent-request throughput with blocking vs thread-pooled database calls.
+
+Runs the same number of concurrent "requests" against DATABASE_URL twice: once calling the
+synchronous session directly on the event loop (how the handlers used to work) and once
+through core.run_db. Each request issues QUERIES statements that take QUERY_SECONDS on the
+server, and a probe measures how late the event loop wakes up while the requests run.
+
+    python -m benchmarks.db_concurrency --requests 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from sqlalchemy import text
+from core import SessionLocal, run_db, DB_THREADS
+
+
+def handle_request(queries: int, query_seconds: float):
+    db = SessionLocal()
+    try:
+        for _ in range(queries):
+            db.execute(text("SELECT pg_sleep(:seconds)"), {"seconds": query_seconds})
+        db.commit()
+    finally:
+        db.close()
+
+
+async def blocking_request(queries: int, query_seconds: float):
+    handle_request(queries, query_seconds)
+
+
+async def pooled_request(queries: int, query_seconds: float):
+    await run_db(handle_request, queries, query_seconds)
+
+
+async def loop_lag_probe(stop: asyncio.Event, lags: list, interval: float = 0.01):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run(mode: str, requests: int, concurrency: int, queries: int, query_seconds: float) -> dict:
+    request_fn = blocking_request if mode == "blocking" else pooled_request
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            await request_fn(queries, query_seconds)
+            latencies.append(time.perf_counter() - started)
+
+    stop = asyncio.Event()
+    lags = []
+    probe = asyncio.create_task(loop_lag_probe(stop, lags))
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "requests_per_second": requests / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "max_loop_lag_ms": max(lags, default=0.0) * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=3)
+    parser.add_argument("--query-seconds", type=float, default=0.005)
+    args = parser.parse_args()
+
+    print(f"DB threads: {DB_THREADS}")
+    for mode in ("blocking", "pooled"):
+        result = await run(mode, args.requests, args.concurrency, args.queries, args.query_seconds)
+        print(
+            f"{result['mode']:>8}: {result['requests_per_second']:8.1f} req/s  "
+            f"p50 {result['p50_ms']:7.1f}ms  p95 {result['p95_ms']:7.1f}ms  "
+            f"max loop lag {result['max_loop_lag_ms']:7.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
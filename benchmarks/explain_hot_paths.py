@@ -0,0 +1,164 @@
+"""Query-plan regression check for the hot-path queries.
+
+Runs the real hot-path functions (phone lookup, route lookup, conversation state, Initiated
+lookup, /init_questionnaire preparation, webhook claim) inside a transaction that is rolled
+back, captures every statement they send, and EXPLAINs each one. Exits non-zero if any plan
+contains a sequential scan, i.e. a query that no longer has an index to use.
+
+Point DATABASE_URL at a local, disposable Postgres. With --seed an empty database gets the
+tables, the migrations and a realistic volume of rows (plans on near-empty tables are
+meaningless, Postgres seq scans anything that fits in a page or two):
+
+    DATABASE_URL=postgresql://localhost/moodify_explain python -m benchmarks.explain_hot_paths --seed
+"""
+import argparse
+import json
+import sys
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from core import Base, engine
+from migrations import run_migrations
+from models import InitQuestionnaireRequest
+from lookups import get_patient_id_from_phone_number, _load_patient_route
+from webhook_queue import claim_next_event
+from main import get_conversation_state, get_initiated_conversation, prepare_init_questionnaire
+
+
+SEED_STATEMENTS = [
+    """INSERT INTO "Teams" (name, whatsapp_number, whatsapp_number_id)
+       SELECT 'Team ' || g, '+4420' || lpad(g::text, 8, '0'), 100000 + g FROM generate_series(1, :teams) g""",
+    """INSERT INTO "Users" (first_name, last_name, email, team_id)
+       SELECT 'User', g::text, 'user' || g || '@example.com', (SELECT min(id) FROM "Teams") + g % :teams
+       FROM generate_series(1, :users) g""",
+    """INSERT INTO "Templates" (owner, duration, title, questions)
+       SELECT (SELECT min(id) FROM "Users") + g % :users, '5', 'Template ' || g,
+              '{"questions_list": [{"index": 0, "text": "How are you?", "response_format": "scale"}],
+                "answer_schemes": {"scale": {"explanation": "0-10", "range": {"start": 0, "end": 10}}}}'::jsonb
+       FROM generate_series(1, :templates) g""",
+    """INSERT INTO "Patients" (first_name, last_name, assigned_to, phone_number)
+       SELECT 'Patient', g::text, (SELECT min(id) FROM "Users") + g % :users, '4470' || lpad(g::text, 8, '0')
+       FROM generate_series(1, :patients) g""",
+    """INSERT INTO "Questionnaires" (patient_id, template_id, user_id, questions, current_status)
+       SELECT p.id, (SELECT min(id) FROM "Templates") + (p.id + n) % :templates, p.assigned_to,
+              (SELECT questions FROM "Templates" ORDER BY id LIMIT 1), (n % 3)::text
+       FROM "Patients" p, generate_series(1, :per_patient) n""",
+    """INSERT INTO "Conversations" (patient_id, questionnaire_id, status, created_at, ended_at)
+       SELECT q.patient_id, q.id,
+              (ARRAY['Initiated', 'QuestionnaireInProgress', 'ReadyToComplete', 'Completed'])[1 + q.id % 4],
+              now() - (q.id % 1000) * interval '1 hour', now() - (q.id % 1000) * interval '1 hour' + interval '1 day'
+       FROM "Questionnaires" q""",
+    """INSERT INTO "Chat_logs" (conversation_id, patient_id, role, message_text)
+       SELECT c.id, c.patient_id, 'user', 'message ' || n FROM "Conversations" c, generate_series(1, :messages) n""",
+    """INSERT INTO "Webhook_events" (payload, status, attempts)
+       SELECT '{}'::jsonb, CASE WHEN g % 1000 = 0 THEN 'pending' ELSE 'done' END, 1 FROM generate_series(1, :events) g""",
+]
+
+
+def seed(patients: int):
+    Base.metadata.create_all(bind=engine)
+    run_migrations()
+    with engine.begin() as connection:
+        if connection.execute(text('SELECT count(*) FROM "Patients"')).scalar():
+            print("Database already has patients, not seeding")
+        else:
+            params = {
+                "teams": max(patients // 1000, 10),
+                "users": max(patients // 50, 50),
+                "templates": max(patients // 200, 20),
+                "patients": patients,
+                "per_patient": 3,
+                "messages": 4,
+                "events": patients * 5,
+            }
+            print(f"Seeding {patients} patients")
+            for statement in SEED_STATEMENTS:
+                connection.execute(text(statement), params)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("ANALYZE"))
+
+
+def seq_scans(plan: dict) -> list[str]:
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", action="store_true", help="Create, migrate and fill an empty database first")
+    parser.add_argument("--patients", type=int, default=20000)
+    parser.add_argument("--allow-seq-scan", action="append", default=[], metavar="TABLE",
+                        help="Table that may be seq scanned (repeatable)")
+    parser.add_argument("--verbose", action="store_true", help="Print every statement and plan")
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(args.patients)
+
+    with engine.connect() as connection:
+        patient = connection.execute(text('''
+            SELECT p.id, p.phone_number FROM "Patients" p
+            WHERE EXISTS (SELECT 1 FROM "Conversations" c WHERE c.patient_id = p.id)
+            ORDER BY p.id DESC LIMIT 1
+        ''')).first()
+        template_id = connection.execute(text('SELECT min(id) FROM "Templates"')).scalar()
+        user_id = connection.execute(text('SELECT min(id) FROM "Users"')).scalar()
+    if patient is None or template_id is None:
+        sys.exit("No patients with conversations in the database, run with --seed against an empty database")
+
+    hot_paths = [
+        ("patient by phone number", lambda db: get_patient_id_from_phone_number(patient.phone_number, db)),
+        ("patient route", lambda db: _load_patient_route(patient.id, db)),
+        ("conversation state", lambda db: get_conversation_state(patient.id, db)),
+        ("initiated conversation", lambda db: get_initiated_conversation(patient.id, db)),
+        ("init questionnaire", lambda db: prepare_init_questionnaire(
+            InitQuestionnaireRequest(patient_id=patient.id, template_id=template_id, user_id=user_id), db)),
+        ("claim webhook event", claim_next_event),
+    ]
+
+    failures = 0
+    with engine.connect() as connection:
+        # Commits inside the hot paths become savepoints; everything is rolled back at the end
+        outer = connection.begin()
+        db = Session(bind=connection, join_transaction_mode="create_savepoint", expire_on_commit=False)
+        captured = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "WITH")):
+                captured.append((statement, parameters))
+
+        try:
+            for name, run in hot_paths:
+                captured.clear()
+                event.listen(engine, "before_cursor_execute", capture)
+                try:
+                    run(db)
+                finally:
+                    event.remove(engine, "before_cursor_execute", capture)
+
+                for statement, parameters in list(captured):
+                    plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters).scalar()
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    scans = [table for table in seq_scans(plan[0]["Plan"]) if table not in args.allow_seq_scan]
+                    if scans:
+                        failures += 1
+                        print(f"FAIL  {name}: seq scan on {', '.join(scans)}")
+                        print(f"      {' '.join(statement.split())}")
+                    else:
+                        print(f"ok    {name}")
+                    if args.verbose:
+                        print(json.dumps(plan, indent=2))
+        finally:
+            db.close()
+            outer.rollback()
+
+    print(f"{failures} hot-path statements fall back to a sequential scan" if failures else "No sequential scans on hot paths")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""Synthetic patient-population load simulator.
+
+For each population size in --patients (e.g. 100,1000,5000) a fresh cohort is created through
+the app's own API, the same way the dashboard does it:
+    /db/new_team, /db/new_user, /db/new_template, /db/new_patient for every patient,
+    /init_questionnaire for every patient (which sends the begin_questionnaire template).
+Then every virtual patient runs at once, with a random start within --ramp-seconds and think
+time between messages: presses Begin, then per question answers, skips, ends the questionnaire,
+sends free text the app has to ask about, or sends a voice note, at the configured rates. Patients
+that finish or end may send a feedback message.
+
+Outbound services are the stubs from benchmarks/stub_services.py. While a step runs /stats is
+sampled for DB connection-pool and DB-thread saturation and webhook queue depth. The report
+shows how throughput and tail latency move as the population grows.
+
+Use a local, disposable Postgres, simulation rows from earlier runs are deleted first:
+
+    DATABASE_URL=postgresql://localhost/moodify_bench python -m benchmarks.load_simulator --patients 100,500,2000
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from collections import Counter
+import httpx
+from sqlalchemy import text
+from core import Base, engine
+from migrations import run_migrations
+from benchmarks.stub_services import add_latency_arguments, stubs_from_arguments
+from benchmarks.webhook_replay import Replay, WebhookFactory, load_sample_payloads, percentile, start_app
+
+SIMULATION_PHONE_PREFIX = "4478"
+ACTIONS = ("answer", "skip", "end", "free_text", "voice")
+FREE_TEXT = ["not sure how to answer this", "what do you mean?", "can you explain that", "hmm"]
+
+
+def delete_previous_simulations():
+    Base.metadata.create_all(bind=engine)
+    run_migrations()
+    with engine.begin() as connection:
+        patient_ids = f'SELECT id FROM "Patients" WHERE phone_number LIKE \'{SIMULATION_PHONE_PREFIX}%\''
+        connection.execute(text(f'DELETE FROM "Chat_logs" WHERE patient_id IN ({patient_ids})'))
+        connection.execute(text(f'DELETE FROM "Conversations" WHERE patient_id IN ({patient_ids})'))
+        connection.execute(text(f'DELETE FROM "Questionnaires" WHERE patient_id IN ({patient_ids})'))
+        connection.execute(text(f'DELETE FROM "Patients" WHERE id IN ({patient_ids})'))
+        connection.execute(text('DELETE FROM "Templates" WHERE title LIKE \'Simulation %\''))
+        connection.execute(text('DELETE FROM "Users" WHERE email LIKE \'sim-clinician-%\''))
+        connection.execute(text('DELETE FROM "Teams" WHERE name LIKE \'Simulation %\''))
+
+
+class PopulationSimulation(Replay):
+    def __init__(self, app_url: str, factory: WebhookFactory, stubs, args, step: int):
+        super().__init__(app_url, factory, stubs, args)
+        self.step = step
+        self.actions = Counter()
+        self.samples = []
+        weights = [args.answer_rate, args.skip_rate, args.end_rate, args.free_text_rate, args.voice_rate]
+        self.weights = [weight / sum(weights) for weight in weights]
+
+    async def _create(self, client: httpx.AsyncClient, path: str, body: dict) -> dict:
+        response = await client.post(path, json=body)
+        response.raise_for_status()
+        result = response.json()
+        if result.get("status") != "success":
+            raise RuntimeError(f"{path} failed: {result}")
+        return result.get("data")
+
+    async def setup_cohort(self, client: httpx.AsyncClient, patients: int) -> list[str]:
+        # Everything goes through the API so setup exercises the same code the dashboard does
+        team = await self._create(client, "/db/new_team", {
+            "name": f"Simulation team {self.step}",
+            "whatsapp_number": "447000000000",
+            "whatsapp_number_id": self.factory.business_phone_number_id,
+        })
+        user = await self._create(client, "/db/new_user", {
+            "first_name": "Simulation",
+            "last_name": "Clinician",
+            "email": f"sim-clinician-{self.step}@example.com",
+            "team_id": team["id"],
+        })
+        template = await self._create(client, "/db/new_template", {
+            "owner": user["id"],
+            "team_id": team["id"],
+            "duration": "3",
+            "title": f"Simulation {self.step}",
+            "questions": {
+                "questions_list": [
+                    {"index": index, "text": f"Question {index + 1}", "response_format": "scale"}
+                    for index in range(self.args.questions)
+                ],
+                "answer_schemes": {"scale": {"explanation": "Reply with a number from 0 to 10", "range": {"start": 0, "end": 10}}},
+            },
+        })
+
+        semaphore = asyncio.Semaphore(self.args.setup_concurrency)
+        phones = [f"{SIMULATION_PHONE_PREFIX}{self.step:02d}{index:06d}" for index in range(patients)]
+
+        async def create_patient(phone: str):
+            async with semaphore:
+                patient = await self._create(client, "/db/new_patient", {
+                    "first_name": "Simulated",
+                    "last_name": phone,
+                    "assigned_to": user["id"],
+                    "phone_number": phone,
+                    "email": f"sim-{phone}@example.com",
+                })
+                response = await client.post("/init_questionnaire", json={
+                    "patient_id": patient["id"],
+                    "template_id": template["id"],
+                    "user_id": user["id"],
+                })
+                if response.json().get("status") != "success":
+                    self.errors["init_questionnaire"] += 1
+
+        await asyncio.gather(*(create_patient(phone) for phone in phones))
+        return phones
+
+    def think(self, rng: random.Random) -> float:
+        return rng.expovariate(1 / self.args.think_seconds) if self.args.think_seconds > 0 else 0
+
+    async def run_patient(self, client: httpx.AsyncClient, index: int, phone: str, semaphore: asyncio.Semaphore):
+        rng = random.Random(self.args.seed * 1_000_003 + self.step * 100_003 + index)
+        await asyncio.sleep(rng.uniform(0, self.args.ramp_seconds))
+        await self.send_message(client, "button", *self.factory.button(phone))
+
+        question = 0
+        while question < self.args.questions:
+            await asyncio.sleep(self.think(rng))
+            action = rng.choices(ACTIONS, weights=self.weights)[0]
+            self.actions[action] += 1
+            if action == "answer":
+                await self.send_message(client, "text", *self.factory.text(phone, str(rng.randint(0, 10))))
+                question += 1
+            elif action == "skip":
+                await self.send_message(client, "text", *self.factory.text(phone, "skip"))
+                question += 1
+            elif action == "end":
+                await self.send_message(client, "text", *self.factory.text(phone, "end"))
+                break
+            elif action == "free_text":
+                # Not an answer, the app asks for clarification and the question stays open
+                await self.send_message(client, "text_llm", *self.factory.text(phone, rng.choice(FREE_TEXT)))
+            else:
+                await self.send_message(client, "audio", *self.factory.audio(phone))
+                question += 1
+
+        if rng.random() < self.args.feedback_rate:
+            await asyncio.sleep(self.think(rng))
+            self.actions["feedback"] += 1
+            await self.send_message(client, "text_feedback", *self.factory.text(phone, "Thanks, that was helpful"))
+
+    async def sample_stats(self, client: httpx.AsyncClient, stop: asyncio.Event):
+        while not stop.is_set():
+            try:
+                stats = (await client.get("/stats")).json()
+                self.samples.append({
+                    "checked_out": stats["db_pool"]["checked_out"],
+                    "saturation": stats["db_pool"]["saturation"],
+                    "run_db_waiting": stats["db_pool"]["run_db_waiting"],
+                    "queue_pending": stats["webhook_queue"]["pending"],
+                    "queue_in_flight": stats["webhook_queue"]["in_flight"],
+                })
+            except (httpx.HTTPError, KeyError, ValueError):
+                self.errors["stats_sample"] += 1
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.args.sample_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_step(self, patients: int) -> dict:
+        self.stubs.on_read = self._on_read
+        limits = httpx.Limits(max_connections=self.args.max_connections)
+        async with httpx.AsyncClient(base_url=self.app_url, limits=limits, timeout=60) as client:
+            setup_started = time.perf_counter()
+            phones = await self.setup_cohort(client, patients)
+            setup_seconds = time.perf_counter() - setup_started
+
+            self.stubs.reset()
+            stop = asyncio.Event()
+            sampler = asyncio.create_task(self.sample_stats(client, stop))
+            started = time.perf_counter()
+            semaphore = asyncio.Semaphore(patients)  # Every patient is active at once
+            await asyncio.gather(*(self.run_patient(client, index, phone, semaphore) for index, phone in enumerate(phones)))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await sampler
+
+        all_e2e = [latency for latencies in self.e2e_latencies.values() for latency in latencies]
+        messages = sum(len(latencies) for latencies in self.e2e_latencies.values())
+        ms = lambda seconds: round(seconds * 1000, 2) if seconds is not None else None
+        column = lambda name: [sample[name] for sample in self.samples] or [0]
+        return {
+            "patients": patients,
+            "setup_seconds": round(setup_seconds, 2),
+            "elapsed_seconds": round(elapsed, 2),
+            "webhooks": sum(self.webhooks.values()),
+            "messages_processed": messages,
+            "messages_per_second": round(messages / elapsed, 2),
+            "webhooks_per_second": round(sum(self.webhooks.values()) / elapsed, 2),
+            "ack_p95_ms": ms(percentile(self.ack_latencies, 95)),
+            "ack_p99_ms": ms(percentile(self.ack_latencies, 99)),
+            "e2e_p50_ms": ms(percentile(all_e2e, 50)),
+            "e2e_p95_ms": ms(percentile(all_e2e, 95)),
+            "e2e_p99_ms": ms(percentile(all_e2e, 99)),
+            "actions": dict(self.actions),
+            "errors": dict(self.errors),
+            "db_pool": {
+                "max_checked_out": max(column("checked_out")),
+                "max_saturation": round(max(column("saturation")), 3),
+                "mean_saturation": round(statistics.fmean(column("saturation")), 3),
+                "max_run_db_waiting": max(column("run_db_waiting")),
+                "samples": len(self.samples),
+            },
+            "max_queue_pending": max(column("queue_pending")),
+            "max_queue_in_flight": max(column("queue_in_flight")),
+            "outbound_calls": self.stubs.stats(),
+        }
+
+
+def print_report(steps: list[dict]):
+    print(f"{'patients':>9} {'msg/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'pool max':>9} {'pool avg':>9} {'db wait':>8} {'queue':>6} {'errors':>7}")
+    for step in steps:
+        pool = step["db_pool"]
+        print(
+            f"{step['patients']:>9} {step['messages_per_second']:>8} {step['e2e_p50_ms']!s:>9} {step['e2e_p95_ms']!s:>9} "
+            f"{step['e2e_p99_ms']!s:>9} {pool['max_saturation']:>9.0%} {pool['mean_saturation']:>9.0%} "
+            f"{pool['max_run_db_waiting']:>8} {step['max_queue_pending']:>6} {sum(step['errors'].values()):>7}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", default="100,500,1000", help="Comma-separated population sizes, one step each")
+    parser.add_argument("--questions", type=int, default=5)
+    parser.add_argument("--answer-rate", type=float, default=0.7)
+    parser.add_argument("--skip-rate", type=float, default=0.1)
+    parser.add_argument("--end-rate", type=float, default=0.03)
+    parser.add_argument("--free-text-rate", type=float, default=0.07)
+    parser.add_argument("--voice-rate", type=float, default=0.1)
+    parser.add_argument("--feedback-rate", type=float, default=0.3)
+    parser.add_argument("--think-seconds", type=float, default=5, help="Mean pause between a patient's messages")
+    parser.add_argument("--ramp-seconds", type=float, default=30, help="Patients start at random within this window")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for a message to be processed")
+    parser.add_argument("--sample-interval", type=float, default=1)
+    parser.add_argument("--setup-concurrency", type=int, default=20)
+    parser.add_argument("--max-connections", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--app-port", type=int, default=8800)
+    parser.add_argument("--stub-port", type=int, default=8900)
+    add_latency_arguments(parser)
+    parser.add_argument("--output", help="Write the per-step results to this file")
+    args = parser.parse_args()
+
+    steps = [int(patients) for patients in args.patients.split(",")]
+    factory = WebhookFactory(load_sample_payloads())
+    delete_previous_simulations()
+
+    stubs = stubs_from_arguments(args)
+    stub_server = stubs.start_in_thread(port=args.stub_port)
+    app = start_app(args.app_port, stubs.app_env())
+    results = []
+    try:
+        for step, patients in enumerate(steps):
+            print(f"Simulating {patients} patients")
+            simulation = PopulationSimulation(f"http://127.0.0.1:{args.app_port}", factory, stubs, args, step)
+            results.append(asyncio.run(simulation.run_step(patients)))
+            print(json.dumps(results[-1], indent=2))
+    finally:
+        app.terminate()
+        app.wait(timeout=30)
+        stub_server.should_exit = True
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if any(step["errors"] for step in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
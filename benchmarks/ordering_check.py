@@ -0,0 +1,111 @@
+"""Check that each patient's messages are handled in order across separate webhook deliveries.
+
+Meta usually sends one message per webhook, so a patient answering quickly produces several
+events that different workers could pick up at once. This starts the stubs and the app like
+benchmarks/webhook_replay.py, presses Begin for each benchmark patient, then posts every answer
+as its own webhook back to back without waiting for the previous one to be processed. Once all
+of them have been marked read it checks, in the database, that each question holds the answer
+that was sent for it and that every questionnaire completed. Exits non-zero on any mismatch.
+
+    DATABASE_URL=postgresql://localhost/moodify_bench python -m benchmarks.ordering_check --patients 20 --workers 8
+"""
+import argparse
+import asyncio
+import sys
+import httpx
+from core import SessionLocal
+from models import Patient, Questionnaire
+from benchmarks.stub_services import add_latency_arguments, stubs_from_arguments
+from benchmarks.webhook_replay import Replay, WebhookFactory, load_sample_payloads, seed_patients, start_app
+
+
+def answers_for(questions: int) -> list[str]:
+    # Distinct in-range numbers with skips in between, so a swapped pair shows up
+    return ["skip" if question % 3 == 1 else str((question * 3 + 1) % 11) for question in range(questions)]
+
+
+class OrderingCheck(Replay):
+    async def run_patient(self, client: httpx.AsyncClient, index: int, phone: str, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            await self.send_message(client, "button", *self.factory.button(phone))
+            waiters = []
+            for answer in answers_for(self.args.questions):
+                # Each answer is acknowledged (and so queued) before the next is posted, but none is waited on
+                message_id, payload = self.factory.text(phone, answer)
+                future = asyncio.get_running_loop().create_future()
+                self.read_waiters[message_id] = future
+                await self.post(client, "text", payload)
+                waiters.append((message_id, future))
+            for message_id, future in waiters:
+                try:
+                    await asyncio.wait_for(future, timeout=self.args.timeout)
+                except asyncio.TimeoutError:
+                    self.errors["text_timeout"] += 1
+                finally:
+                    self.read_waiters.pop(message_id, None)
+
+
+def check_answers(phones: list[str], questions: int) -> list[str]:
+    expected = answers_for(questions)
+    problems = []
+    db = SessionLocal()
+    try:
+        rows = db.query(Patient.phone_number, Questionnaire).join(
+            Questionnaire, Questionnaire.patient_id == Patient.id
+        ).filter(Patient.phone_number.in_(phones)).all()
+        for phone, questionnaire in rows:
+            received = [question.get("answer") for question in questionnaire.questions["questions_list"]]
+            if received != expected:
+                problems.append(f"{phone}: answers {received}, expected {expected}")
+            if questionnaire.current_status != "Completed":
+                problems.append(f"{phone}: questionnaire status {questionnaire.current_status}")
+        if len(rows) != len(phones):
+            problems.append(f"Found {len(rows)} questionnaires for {len(phones)} patients")
+    finally:
+        db.close()
+    return problems
+
+
+async def run_patients(check: OrderingCheck, phones: list[str]):
+    async with httpx.AsyncClient(base_url=check.app_url, timeout=30) as client:
+        semaphore = asyncio.Semaphore(check.args.concurrency)
+        await asyncio.gather(*(check.run_patient(client, index, phone, semaphore) for index, phone in enumerate(phones)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=6)
+    parser.add_argument("--workers", type=int, default=8, help="WEBHOOK_WORKERS for the app, more workers make a race more likely")
+    parser.add_argument("--concurrency", type=int, default=20, help="Patients sending at the same time")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for a message to be processed")
+    parser.add_argument("--app-port", type=int, default=8800)
+    parser.add_argument("--stub-port", type=int, default=8900)
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    factory = WebhookFactory(load_sample_payloads())
+    phones = seed_patients(args.patients, args.questions, factory.business_phone_number_id)
+
+    stubs = stubs_from_arguments(args)
+    stub_server = stubs.start_in_thread(port=args.stub_port)
+    app = start_app(args.app_port, {**stubs.app_env(), "WEBHOOK_WORKERS": str(args.workers)})
+    check = OrderingCheck(f"http://127.0.0.1:{args.app_port}", factory, stubs, args)
+    stubs.on_read = check._on_read
+    try:
+        asyncio.run(run_patients(check, phones))
+    finally:
+        app.terminate()
+        app.wait(timeout=30)
+        stub_server.should_exit = True
+
+    problems = [f"{kind}: {count}" for kind, count in check.errors.items()] + check_answers(phones, args.questions)
+    for problem in problems:
+        print(f"FAIL  {problem}")
+    if not problems:
+        print(f"OK  {len(phones)} patients, {args.questions} answers each, all recorded in order")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
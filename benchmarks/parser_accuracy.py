@@ -0,0 +1,56 @@
+"""Accuracy of the local message parser against a labelled corpus of replies.
+
+Each corpus entry is {"text": ..., "expected": ...} where expected is the answer the
+conversation should act on: an int, "skip", "end", or null for replies that must be left to
+the LLM. A wrong local answer is a bug (it would be recorded without the LLM ever seeing the
+reply), so the script exits non-zero if there is one. Escalated replies that have a label are
+reported as missed coverage.
+
+    python -m benchmarks.parser_accuracy --corpus benchmarks/parser_corpus.json
+"""
+import argparse
+import json
+import os
+import sys
+from message_parser import parse_locally, PARSER_CONFIDENCE_THRESHOLD
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(__file__), "parser_corpus.json"))
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.corpus) as f:
+        corpus = json.load(f)
+
+    correct, wrong, missed, escalated = [], [], [], []
+    for entry in corpus:
+        result = parse_locally(entry["text"])
+        if result.confident:
+            (correct if result.value == entry["expected"] else wrong).append((entry, result))
+        elif entry["expected"] is not None:
+            missed.append((entry, result))
+        else:
+            escalated.append((entry, result))
+
+    local = len(correct) + len(wrong)
+    print(f"threshold: {PARSER_CONFIDENCE_THRESHOLD}")
+    print(f"entries: {len(corpus)}")
+    print(f"resolved locally: {local} ({local / len(corpus):.1%})")
+    print(f"  correct: {len(correct)}")
+    print(f"  wrong: {len(wrong)}")
+    print(f"escalated: {len(escalated) + len(missed)}")
+    print(f"  missed coverage (labelled but escalated): {len(missed)}")
+
+    for entry, result in wrong:
+        print(f"WRONG   {entry['text']!r}: expected {entry['expected']!r}, got {result.value!r} ({result.confidence:.2f})")
+    if args.verbose:
+        for entry, result in missed:
+            print(f"MISSED  {entry['text']!r}: expected {entry['expected']!r}, got {result.value!r} ({result.confidence:.2f})")
+
+    sys.exit(1 if wrong else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Local stand-ins for every service the app calls out to, for benchmarks and load tests.
+
+One FastAPI app answers for:
+    graph.facebook.com   POST /{version}/{phone_number_id}/messages, GET /{version}/{media_id}/,
+                         GET /media/{media_id} (the media download URL it hands out)
+    OpenAI               POST /v1/chat/completions, POST /v1/audio/transcriptions
+    Flowise              POST /flowise/prediction
+Each answers after a configurable delay and counts its calls (GET /_stats, POST /_reset).
+Point the app at it with:
+
+    GRAPH_API_BASE_URL=http://127.0.0.1:8900
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1
+    TRANSCRIPTION_URL=http://127.0.0.1:8900/v1/audio/transcriptions
+    FLOWISE_URL=http://127.0.0.1:8900/flowise/prediction
+
+    python -m benchmarks.stub_services --port 8900 --graph-latency-ms 80
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+
+class StubServices:
+    def __init__(self, graph_latency: float = 0.08, chat_latency: float = 0.4, transcription_latency: float = 0.8,
+                 flowise_latency: float = 0.5, audio_bytes: int = 32 * 1024, transcription_text: str = "seven"):
+        self.graph_latency = graph_latency
+        self.chat_latency = chat_latency
+        self.transcription_latency = transcription_latency
+        self.flowise_latency = flowise_latency
+        self.audio_bytes = audio_bytes
+        self.transcription_text = transcription_text
+        self.base_url = None
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        # Harness hooks, called from the stub server's thread
+        self.on_read = None  # (message_id, perf_counter time) when the app marks a message as read
+        self.on_send = None  # (payload, perf_counter time) for every Graph send
+        self.app = self._build_app()
+
+    def count(self, name: str):
+        with self.lock:
+            self.calls[name] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.calls)
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+    def audio_for(self, media_id: str) -> bytes:
+        # Deterministic per media id, so a re-sent media id has the same content hash
+        seed = hashlib.sha256(media_id.encode()).digest()
+        return (seed * (self.audio_bytes // len(seed) + 1))[:self.audio_bytes]
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.get("/_stats")
+        def get_stats():
+            return self.stats()
+
+        @app.post("/_reset")
+        def reset():
+            self.reset()
+            return {"status": "success"}
+
+        @app.get("/media/{media_id}")
+        async def download_media(media_id: str):
+            self.count("graph_media_download")
+            await asyncio.sleep(self.graph_latency)
+            return Response(content=self.audio_for(media_id), media_type="audio/ogg")
+
+        @app.post("/v1/chat/completions")
+        async def chat_completions(request: Request):
+            self.count("openai_chat")
+            body = await request.json()
+            await asyncio.sleep(self.chat_latency)
+            # Answer like the interpretation prompt expects: the first number in the message, or None
+            user_text = body["messages"][-1]["content"]
+            number = re.search(r"\d+", user_text)
+            content = number.group() if number else "None"
+            return {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "stub"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+
+        @app.post("/v1/audio/transcriptions")
+        async def transcriptions(request: Request):
+            self.count("openai_transcription")
+            async for _ in request.stream():
+                pass
+            await asyncio.sleep(self.transcription_latency)
+            return {"text": self.transcription_text}
+
+        @app.post("/flowise/prediction")
+        async def flowise(request: Request):
+            self.count("flowise")
+            await request.body()
+            await asyncio.sleep(self.flowise_latency)
+            return {"text": "Stub reply"}
+
+        @app.post("/{version}/{phone_number_id}/messages")
+        async def send_message(version: str, phone_number_id: str, request: Request):
+            payload = await request.json()
+            now = time.perf_counter()
+            if payload.get("status") == "read":
+                self.count("graph_mark_read")
+                if self.on_read:
+                    self.on_read(payload.get("message_id"), now)
+            else:
+                self.count(f"graph_send_{payload.get('type', 'text')}")
+            if self.on_send:
+                self.on_send(payload, now)
+            await asyncio.sleep(self.graph_latency)
+            return {
+                "messaging_product": "whatsapp",
+                "contacts": [{"input": payload.get("to"), "wa_id": payload.get("to")}],
+                "messages": [{"id": f"wamid.stub{uuid.uuid4().hex}"}],
+            }
+
+        @app.get("/{version}/{media_id}/")
+        async def media_metadata(version: str, media_id: str):
+            self.count("graph_media_metadata")
+            await asyncio.sleep(self.graph_latency)
+            audio = self.audio_for(media_id)
+            return {
+                "messaging_product": "whatsapp",
+                "url": f"{self.base_url}/media/{media_id}",
+                "mime_type": "audio/ogg; codecs=opus",
+                "sha256": base64.b64encode(hashlib.sha256(audio).digest()).decode(),
+                "file_size": len(audio),
+                "id": media_id,
+            }
+
+        return app
+
+    def start_in_thread(self, host: str = "127.0.0.1", port: int = 8900) -> uvicorn.Server:
+        self.base_url = f"http://{host}:{port}"
+        server = uvicorn.Server(uvicorn.Config(self.app, host=host, port=port, log_level="warning", access_log=False))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.05)
+        return server
+
+    def app_env(self) -> dict:
+        # Environment that points the app at these stubs
+        return {
+            "GRAPH_API_BASE_URL": self.base_url,
+            "OPENAI_BASE_URL": f"{self.base_url}/v1",
+            "TRANSCRIPTION_URL": f"{self.base_url}/v1/audio/transcriptions",
+            "FLOWISE_URL": f"{self.base_url}/flowise/prediction",
+            "WHATSAPP_GRAPH_API_TOKEN": "stub",
+            "OPENAI_KEY": "stub",
+        }
+
+
+def add_latency_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--graph-latency-ms", type=float, default=80)
+    parser.add_argument("--chat-latency-ms", type=float, default=400)
+    parser.add_argument("--transcription-latency-ms", type=float, default=800)
+    parser.add_argument("--flowise-latency-ms", type=float, default=500)
+
+
+def stubs_from_arguments(args) -> StubServices:
+    return StubServices(
+        graph_latency=args.graph_latency_ms / 1000,
+        chat_latency=args.chat_latency_ms / 1000,
+        transcription_latency=args.transcription_latency_ms / 1000,
+        flowise_latency=args.flowise_latency_ms / 1000,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+    stubs = stubs_from_arguments(args)
+    stubs.base_url = f"http://{args.host}:{args.port}"
+    for name, value in stubs.app_env().items():
+        print(f"{name}={value}")
+    uvicorn.run(stubs.app, host=args.host, port=args.port, log_level="warning")
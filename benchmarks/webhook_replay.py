@@ -0,0 +1,368 @@
+"""End-to-end webhook replay benchmark.
+
+Starts the stub services (benchmarks/stub_services.py) and the real app (uvicorn main:app)
+pointed at them and at DATABASE_URL, seeds benchmark patients with an Initiated questionnaire,
+then replays WhatsApp webhooks built from the payload shapes in whatsapp_notification_bodies.json.
+Each virtual patient presses Begin, answers every question (plain numbers, wordy answers
+the local parser handles, ambiguous answers that go to the LLM, and voice notes), sends a
+feedback message, and gets sent/delivered/read statuses along the way. A patient's next
+message is only sent once the app has marked the previous one as read.
+
+Reports webhook ack latency, end-to-end message latency (POST until the app marks the
+message read) as p50/p95/p99, webhooks per second, DB queries per webhook (from the queue's
+query counter) and outbound calls per webhook (from the stubs). Results can be saved as a
+baseline, and later runs are compared against it and exit non-zero on a regression.
+
+Use a local, disposable Postgres, benchmark patients and their rows are deleted and re-created:
+
+    DATABASE_URL=postgresql://localhost/moodify_bench python -m benchmarks.webhook_replay --patients 50 --save-baseline
+    DATABASE_URL=postgresql://localhost/moodify_bench python -m benchmarks.webhook_replay --patients 50
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+import httpx
+from sqlalchemy import text
+from core import Base, engine, SessionLocal
+from migrations import run_migrations
+from models import Team, User, Template, Patient, Questionnaire, Conversation
+from benchmarks.stub_services import add_latency_arguments, stubs_from_arguments
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES_PATH = os.path.join(REPO_ROOT, "whatsapp_notification_bodies.json")
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "webhook_replay.json")
+BENCHMARK_PHONE_PREFIX = "4479"
+BENCHMARK_TEAM_NAME = "Benchmark team"
+
+# Lower is better for all of these except webhooks_per_second
+COMPARED_METRICS = {
+    "e2e_p50_ms": "lower",
+    "e2e_p95_ms": "lower",
+    "e2e_p99_ms": "lower",
+    "ack_p95_ms": "lower",
+    "webhooks_per_second": "higher",
+    "queries_per_webhook": "lower",
+    "outbound_calls_per_webhook": "lower",
+}
+
+TEXT_ANSWERS = ["7", "I'd say 6", "seven!", "skip"]
+LLM_ANSWERS = ["between 4 and 5 I guess", "3 or 4 probably", "no idea, maybe 5 or 6?"]  # Ambiguous, so escalated
+
+
+def load_sample_payloads(path: str = SAMPLES_PATH) -> dict:
+    # The file is a series of "LABEL" lines each followed by one JSON payload
+    with open(path) as f:
+        content = f.read()
+    parts = re.split(r"^([A-Z]+)\s*$", content, flags=re.MULTILINE)
+    return {label.lower(): json.loads(body) for label, body in zip(parts[1::2], parts[2::2])}
+
+
+class WebhookFactory:
+    def __init__(self, samples: dict):
+        self.samples = samples
+        self.business_phone_number_id = samples["message"]["entry"][0]["changes"][0]["value"]["metadata"]["phone_number_id"]
+
+    def _message(self, sample: str, phone: str) -> tuple[str, dict, dict]:
+        payload = copy.deepcopy(self.samples[sample])
+        value = payload["entry"][0]["changes"][0]["value"]
+        value["contacts"][0]["wa_id"] = phone
+        message = value["messages"][0]
+        message_id = f"wamid.bench{uuid.uuid4().hex}"
+        message.update({"from": phone, "id": message_id, "timestamp": str(int(time.time()))})
+        return message_id, payload, message
+
+    def text(self, phone: str, body: str) -> tuple[str, dict]:
+        message_id, payload, message = self._message("message", phone)
+        message["text"] = {"body": body}
+        return message_id, payload
+
+    def button(self, phone: str, button_payload: str = "Begin") -> tuple[str, dict]:
+        message_id, payload, message = self._message("button", phone)
+        message["button"] = {"payload": button_payload, "text": button_payload}
+        return message_id, payload
+
+    def audio(self, phone: str) -> tuple[str, dict]:
+        message_id, payload, message = self._message("audio", phone)
+        message["audio"]["id"] = str(uuid.uuid4().int)[:15]
+        return message_id, payload
+
+    def status(self, phone: str, status: str) -> dict:
+        payload = copy.deepcopy(self.samples[status])
+        entry = payload["entry"][0]["changes"][0]["value"]["statuses"][0]
+        entry.update({"id": f"wamid.bench{uuid.uuid4().hex}", "recipient_id": phone, "timestamp": str(int(time.time()))})
+        return payload
+
+
+def seed_patients(patients: int, questions: int, business_phone_number_id: str) -> list[str]:
+    # Deletes previous benchmark rows and creates fresh patients, each with an Initiated
+    # questionnaire. Returns their phone numbers.
+    Base.metadata.create_all(bind=engine)
+    run_migrations()
+    with engine.begin() as connection:
+        patient_ids = f'SELECT id FROM "Patients" WHERE phone_number LIKE \'{BENCHMARK_PHONE_PREFIX}%\''
+        connection.execute(text(f'DELETE FROM "Chat_logs" WHERE patient_id IN ({patient_ids})'))
+        connection.execute(text(f'DELETE FROM "Conversations" WHERE patient_id IN ({patient_ids})'))
+        connection.execute(text(f'DELETE FROM "Questionnaires" WHERE patient_id IN ({patient_ids})'))
+        connection.execute(text(f'DELETE FROM "Patients" WHERE id IN ({patient_ids})'))
+
+    db = SessionLocal()
+    try:
+        team = db.query(Team).filter(Team.name == BENCHMARK_TEAM_NAME).first()
+        if team is None:
+            team = Team(name=BENCHMARK_TEAM_NAME, whatsapp_number="447000000000", whatsapp_number_id=int(business_phone_number_id))
+            db.add(team)
+            db.flush()
+            db.add(User(first_name="Benchmark", last_name="Clinician", email="benchmark@example.com", team_id=team.id))
+            db.flush()
+        user = db.query(User).filter(User.team_id == team.id).first()
+        template = Template(
+            owner=user.id,
+            team_id=team.id,
+            duration="2",
+            title=f"Benchmark {questions} questions",
+            questions={
+                "questions_list": [
+                    {"index": index, "text": f"Question {index + 1}", "response_format": "scale"}
+                    for index in range(questions)
+                ],
+                "answer_schemes": {"scale": {"explanation": "Reply with a number from 0 to 10", "range": {"start": 0, "end": 10}}},
+            },
+        )
+        db.add(template)
+        db.flush()
+
+        phones = [f"{BENCHMARK_PHONE_PREFIX}{index:08d}" for index in range(patients)]
+        for phone in phones:
+            patient = Patient(first_name="Benchmark", last_name=phone, phone_number=phone, assigned_to=user.id)
+            db.add(patient)
+            db.flush()
+            questionnaire = Questionnaire(patient_id=patient.id, template_id=template.id, user_id=user.id,
+                                          questions=template.questions, current_status="0")
+            db.add(questionnaire)
+            db.flush()
+            db.add(Conversation(patient_id=patient.id, questionnaire_id=questionnaire.id, status="Initiated"))
+        db.commit()
+        return phones
+    finally:
+        db.close()
+
+
+def percentile(samples: list[float], percent: float) -> float | None:
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+class Replay:
+    def __init__(self, app_url: str, factory: WebhookFactory, stubs, args):
+        self.app_url = app_url
+        self.factory = factory
+        self.stubs = stubs
+        self.args = args
+        self.read_waiters: dict[str, asyncio.Future] = {}
+        self.ack_latencies = []
+        self.e2e_latencies = {}
+        self.webhooks = Counter()
+        self.errors = Counter()
+
+    def _on_read(self, message_id: str, at: float):
+        # Called on the stub server's thread
+        future = self.read_waiters.get(message_id)
+        if future is not None:
+            future.get_loop().call_soon_threadsafe(lambda: future.done() or future.set_result(at))
+
+    async def post(self, client: httpx.AsyncClient, kind: str, payload: dict) -> float:
+        started = time.perf_counter()
+        response = await client.post("/whatsapp/webhook", json=payload)
+        self.ack_latencies.append(time.perf_counter() - started)
+        self.webhooks[kind] += 1
+        if response.status_code != 200:
+            self.errors[f"{kind}_http_{response.status_code}"] += 1
+        return started
+
+    async def send_message(self, client: httpx.AsyncClient, kind: str, message_id: str, payload: dict):
+        future = asyncio.get_running_loop().create_future()
+        self.read_waiters[message_id] = future
+        try:
+            started = await self.post(client, kind, payload)
+            read_at = await asyncio.wait_for(future, timeout=self.args.timeout)
+            self.e2e_latencies.setdefault(kind, []).append(read_at - started)
+        except asyncio.TimeoutError:
+            self.errors[f"{kind}_timeout"] += 1
+        finally:
+            self.read_waiters.pop(message_id, None)
+
+    async def send_status(self, client: httpx.AsyncClient, phone: str, status: str):
+        await self.post(client, "status", self.factory.status(phone, status))
+
+    async def run_patient(self, client: httpx.AsyncClient, index: int, phone: str, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            await self.send_status(client, phone, "sent")
+            await self.send_status(client, phone, "delivered")
+            await self.send_message(client, "button", *self.factory.button(phone))
+            for question in range(self.args.questions):
+                await self.send_status(client, phone, "read")
+                # Deterministic mix so every run replays the same traffic
+                slot = (index * self.args.questions + question) % 100
+                if slot < self.args.audio_percent:
+                    await self.send_message(client, "audio", *self.factory.audio(phone))
+                elif slot < self.args.audio_percent + self.args.llm_percent:
+                    await self.send_message(client, "text_llm", *self.factory.text(phone, LLM_ANSWERS[slot % len(LLM_ANSWERS)]))
+                else:
+                    await self.send_message(client, "text", *self.factory.text(phone, TEXT_ANSWERS[slot % len(TEXT_ANSWERS)]))
+            await self.send_message(client, "text_feedback", *self.factory.text(phone, "Thanks, that was easy"))
+
+    async def run(self, phones: list[str]) -> dict:
+        self.stubs.on_read = self._on_read
+        limits = httpx.Limits(max_connections=self.args.concurrency * 2)
+        async with httpx.AsyncClient(base_url=self.app_url, limits=limits, timeout=30) as client:
+            before = (await client.get("/stats")).json()
+            self.stubs.reset()
+            started = time.perf_counter()
+            semaphore = asyncio.Semaphore(self.args.concurrency)
+            await asyncio.gather(*(self.run_patient(client, index, phone, semaphore) for index, phone in enumerate(phones)))
+            elapsed = time.perf_counter() - started
+            # Statuses are not waited on individually, give the workers a moment to drain them
+            await asyncio.sleep(self.args.drain_seconds)
+            after = (await client.get("/stats")).json()
+
+        total_webhooks = sum(self.webhooks.values())
+        processed = after["webhook_queue"]["processed"] - before["webhook_queue"]["processed"]
+        queries = after["webhook_queue"]["queries"] - before["webhook_queue"]["queries"]
+        outbound = self.stubs.stats()
+        all_e2e = [latency for latencies in self.e2e_latencies.values() for latency in latencies]
+        ms = lambda seconds: round(seconds * 1000, 2) if seconds is not None else None
+        return {
+            "patients": len(phones),
+            "concurrency": self.args.concurrency,
+            "webhooks": total_webhooks,
+            "webhooks_by_kind": dict(self.webhooks),
+            "processed": processed,
+            "errors": dict(self.errors),
+            "elapsed_seconds": round(elapsed, 3),
+            "webhooks_per_second": round(total_webhooks / elapsed, 2),
+            "ack_p50_ms": ms(percentile(self.ack_latencies, 50)),
+            "ack_p95_ms": ms(percentile(self.ack_latencies, 95)),
+            "ack_p99_ms": ms(percentile(self.ack_latencies, 99)),
+            "e2e_p50_ms": ms(percentile(all_e2e, 50)),
+            "e2e_p95_ms": ms(percentile(all_e2e, 95)),
+            "e2e_p99_ms": ms(percentile(all_e2e, 99)),
+            "e2e_by_kind": {
+                kind: {"count": len(latencies), "p50_ms": ms(percentile(latencies, 50)),
+                       "p95_ms": ms(percentile(latencies, 95)), "p99_ms": ms(percentile(latencies, 99))}
+                for kind, latencies in self.e2e_latencies.items()
+            },
+            "queries_per_webhook": round(queries / processed, 2) if processed else None,
+            "outbound_calls_per_webhook": round(sum(outbound.values()) / total_webhooks, 2) if total_webhooks else None,
+            "outbound_calls": outbound,
+        }
+
+
+def start_app(port: int, env: dict) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_ROOT,
+        env={**os.environ, **env},
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited with code {process.returncode} during startup")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return process
+        except httpx.TransportError:
+            time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError("App did not start within 60 seconds")
+
+
+def compare_with_baseline(label: str, results: dict, tolerance: float) -> list[str]:
+    if not os.path.exists(BASELINES_PATH):
+        return []
+    with open(BASELINES_PATH) as f:
+        baseline = json.load(f).get(label)
+    if baseline is None:
+        return []
+    regressions = []
+    for metric, better in COMPARED_METRICS.items():
+        old, new = baseline.get(metric), results.get(metric)
+        if old is None or new is None:
+            continue
+        if better == "lower" and new > old * (1 + tolerance) + 0.01:
+            regressions.append(f"{metric}: {old} -> {new}")
+        elif better == "higher" and new < old * (1 - tolerance):
+            regressions.append(f"{metric}: {old} -> {new}")
+    return regressions
+
+
+def save_baseline(label: str, results: dict):
+    baselines = {}
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH) as f:
+            baselines = json.load(f)
+    baselines[label] = results
+    os.makedirs(os.path.dirname(BASELINES_PATH), exist_ok=True)
+    with open(BASELINES_PATH, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+    print(f"Saved baseline '{label}' to {BASELINES_PATH}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=25, help="Patients replaying at the same time")
+    parser.add_argument("--questions", type=int, default=5)
+    parser.add_argument("--audio-percent", type=int, default=20, help="Share of answers sent as voice notes")
+    parser.add_argument("--llm-percent", type=int, default=20, help="Share of answers the local parser escalates to the LLM")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for a message to be processed")
+    parser.add_argument("--drain-seconds", type=float, default=2)
+    parser.add_argument("--app-port", type=int, default=8800)
+    parser.add_argument("--stub-port", type=int, default=8900)
+    add_latency_arguments(parser)
+    parser.add_argument("--label", default="default", help="Baseline name, use one per scenario")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression against the baseline")
+    parser.add_argument("--output", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    factory = WebhookFactory(load_sample_payloads())
+    phones = seed_patients(args.patients, args.questions, factory.business_phone_number_id)
+
+    stubs = stubs_from_arguments(args)
+    stub_server = stubs.start_in_thread(port=args.stub_port)
+    app = start_app(args.app_port, stubs.app_env())
+    try:
+        results = asyncio.run(Replay(f"http://127.0.0.1:{args.app_port}", factory, stubs, args).run(phones))
+    finally:
+        app.terminate()
+        app.wait(timeout=30)
+        stub_server.should_exit = True
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        save_baseline(args.label, results)
+        return
+    regressions = compare_with_baseline(args.label, results, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION  {regression}")
+    if results["errors"]:
+        print(f"Errors: {results['errors']}")
+    sys.exit(1 if regressions or results["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
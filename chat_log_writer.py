@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from core import SessionLocal, run_db
+from structured_logging import describe_error
+from models import ChatLogMessage
+
+
+# ++++++++++++++++++++++++++++++++++
+# +++++++++ CHAT LOG WRITER ++++++++
+# ++++++++++++++++++++++++++++++++++
+
+# Chat log rows are buffered in memory and written with one multi-row INSERT when
+# CHAT_LOG_BATCH_SIZE rows are waiting or CHAT_LOG_FLUSH_INTERVAL seconds have passed, and
+# on shutdown. Writes happen on a worker thread with their own session, so the conversation
+# path no longer pays a commit and a refresh per line. If a batch is refused because of its
+# data, the rows are written one by one and only the rows the database rejects are dropped;
+# other failures (database unreachable) put the whole batch back for the next flush.
+
+CHAT_LOG_BATCH_SIZE = int(os.getenv("CHAT_LOG_BATCH_SIZE", 100))
+CHAT_LOG_FLUSH_INTERVAL = float(os.getenv("CHAT_LOG_FLUSH_INTERVAL", 1))
+CHAT_LOG_MAX_BUFFER = int(os.getenv("CHAT_LOG_MAX_BUFFER", 10000))
+
+logger = logging.getLogger(__name__)
+
+_buffer: list[dict] = []
+_flush_requested = asyncio.Event()
+_task: asyncio.Task | None = None
+_stats = {
+    "buffered": 0,
+    "written": 0,
+    "flushes": 0,
+    "failed_flushes": 0,
+    "rejected": 0,  # Rows the database refused on their own (e.g. their conversation was deleted)
+    "dropped": 0,
+}
+
+
+def chat_log_writer_running() -> bool:
+    return _task is not None and not _task.done()
+
+
+def enqueue_chat_log(row: dict):
+    _buffer.append(row)
+    _stats["buffered"] += 1
+    if len(_buffer) >= CHAT_LOG_BATCH_SIZE:
+        _flush_requested.set()
+
+
+def _write_rows(rows: list[dict]):
+    db = SessionLocal()
+    try:
+        db.execute(insert(ChatLogMessage), rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _write_rows_individually(rows: list[dict]) -> list[dict]:
+    # Fallback after a failed batch: each row gets its own savepoint, so one bad row cannot hold
+    # back the rest. Returns the rows the database rejected; connection-level errors still raise.
+    rejected = []
+    db = SessionLocal()
+    try:
+        for row in rows:
+            savepoint = db.begin_nested()
+            try:
+                db.execute(insert(ChatLogMessage), [row])
+                savepoint.commit()
+            except (IntegrityError, DataError) as e:
+                savepoint.rollback()
+                rejected.append(row)
+                logger.warning("Rejected chat log row", extra={
+                    "conversation_id": row.get("conversation_id"),
+                    "error": describe_error(e),
+                })
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    return rejected
+
+
+async def flush_chat_logs():
+    global _buffer
+    if not _buffer:
+        return
+    rows, _buffer = _buffer, []
+    try:
+        written = len(rows)
+        try:
+            await run_db(_write_rows, rows)
+        except (IntegrityError, DataError):
+            rejected = await run_db(_write_rows_individually, rows)
+            _stats["rejected"] += len(rejected)
+            written -= len(rejected)
+        _stats["written"] += written
+        _stats["flushes"] += 1
+    except Exception as e:
+        logger.error("Error writing chat logs", extra={"rows": len(rows), "error": describe_error(e)})
+        _stats["failed_flushes"] += 1
+        # Put the rows back for the next flush, oldest first, without growing without bound
+        _buffer = rows + _buffer
+        if len(_buffer) > CHAT_LOG_MAX_BUFFER:
+            dropped = len(_buffer) - CHAT_LOG_MAX_BUFFER
+            _buffer = _buffer[dropped:]
+            _stats["dropped"] += dropped
+            logger.warning("Dropped chat log rows, buffer full", extra={"dropped": dropped})
+
+
+async def _flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_flush_requested.wait(), timeout=CHAT_LOG_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_requested.clear()
+        await flush_chat_logs()
+
+
+def start_chat_log_writer():
+    global _task
+    if chat_log_writer_running():
+        return
+    _task = asyncio.create_task(_flush_loop())
+
+
+async def stop_chat_log_writer():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    await flush_chat_logs()
+
+
+def chat_log_writer_stats() -> dict:
+    return {
+        **_stats,
+        "pending": len(_buffer),
+    }
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+from core import SessionLocal, run_db
+from structured_logging import describe_error
+from models import Conversation, Questionnaire
+
+
+# ++++++++++++++++++++++++++++++++++
+# ++++++ CONVERSATION SWEEPER ++++++
+# ++++++++++++++++++++++++++++++++++
+
+# Conversations only stay in a live status while they are live. Every
+# CONVERSATION_SWEEP_INTERVAL seconds:
+#   QuestionnaireInProgress past ended_at        -> Expired (its questionnaire too)
+#   ReadyToComplete more than 24h past ended_at  -> Closed, the feedback window is over
+# so the inbound-message and /init_questionnaire paths can look conversations up by status
+# alone. Rows are moved in set-based batches of CONVERSATION_SWEEP_BATCH_SIZE; a conversation
+# can stay live for up to one interval after it expires.
+
+CONVERSATION_SWEEP_INTERVAL = float(os.getenv("CONVERSATION_SWEEP_INTERVAL", 60))
+CONVERSATION_SWEEP_BATCH_SIZE = int(os.getenv("CONVERSATION_SWEEP_BATCH_SIZE", 1000))
+FEEDBACK_WINDOW = timedelta(hours=24)
+
+logger = logging.getLogger(__name__)
+
+_task: asyncio.Task | None = None
+_stats = {
+    "sweeps": 0,
+    "failed_sweeps": 0,
+    "expired": 0,
+    "closed": 0,
+    "last_sweep_at": None,
+    "last_expired": 0,
+    "last_closed": 0,
+    "last_batches": 0,
+    "last_sweep_seconds": 0.0,
+    "max_sweep_seconds": 0.0,
+}
+
+
+def _expire_batch(status: str, ended_before: datetime, new_status: str, questionnaire_status: str | None, db: Session) -> int:
+    # Moves one batch and returns how many conversations it moved. SKIP LOCKED keeps the sweeper
+    # from waiting on conversations a handler is updating; they are picked up next sweep.
+    batch = select(Conversation.id).where(
+        Conversation.status == status,
+        Conversation.ended_at <= ended_before
+    ).order_by(Conversation.ended_at).limit(CONVERSATION_SWEEP_BATCH_SIZE).with_for_update(skip_locked=True)
+    rows = db.execute(
+        update(Conversation)
+        .where(Conversation.id.in_(batch.scalar_subquery()))
+        .values(status=new_status)
+        .returning(Conversation.questionnaire_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+    questionnaire_ids = [row.questionnaire_id for row in rows if row.questionnaire_id is not None]
+    if questionnaire_status and questionnaire_ids:
+        db.execute(
+            update(Questionnaire)
+            .where(
+                Questionnaire.id.in_(questionnaire_ids),
+                Questionnaire.current_status.notin_(["Completed", "Cancelled"])
+            )
+            .values(current_status=questionnaire_status)
+            .execution_options(synchronize_session=False)
+        )
+    db.commit()
+    return len(rows)
+
+
+def sweep_conversations() -> dict:
+    # Returns {"expired", "closed", "batches"} for this sweep
+    now = datetime.now(timezone.utc)
+    counts = {"expired": 0, "closed": 0, "batches": 0}
+    db = SessionLocal()
+    try:
+        for key, status, ended_before, new_status, questionnaire_status in (
+            ("expired", "QuestionnaireInProgress", now, "Expired", "Expired"),
+            ("closed", "ReadyToComplete", now - FEEDBACK_WINDOW, "Closed", None),
+        ):
+            while True:
+                moved = _expire_batch(status, ended_before, new_status, questionnaire_status, db)
+                counts[key] += moved
+                counts["batches"] += 1
+                if moved < CONVERSATION_SWEEP_BATCH_SIZE:
+                    break
+    finally:
+        db.close()
+    return counts
+
+
+async def _sweep_loop():
+    while True:
+        started = time.perf_counter()
+        try:
+            counts = await run_db(sweep_conversations)
+            seconds = time.perf_counter() - started
+            _stats["sweeps"] += 1
+            _stats["expired"] += counts["expired"]
+            _stats["closed"] += counts["closed"]
+            _stats["last_sweep_at"] = datetime.now(timezone.utc).isoformat()
+            _stats["last_expired"] = counts["expired"]
+            _stats["last_closed"] = counts["closed"]
+            _stats["last_batches"] = counts["batches"]
+            _stats["last_sweep_seconds"] = seconds
+            _stats["max_sweep_seconds"] = max(_stats["max_sweep_seconds"], seconds)
+            if counts["expired"] or counts["closed"]:
+                logger.info("Conversation sweep", extra={"expired": counts["expired"], "closed": counts["closed"], "seconds": round(seconds, 3)})
+        except Exception as e:
+            _stats["failed_sweeps"] += 1
+            logger.error("Conversation sweep error", extra={"error": describe_error(e)})
+        await asyncio.sleep(CONVERSATION_SWEEP_INTERVAL)
+
+
+def start_conversation_sweeper():
+    global _task
+    if _task is not None and not _task.done():
+        return
+    _task = asyncio.create_task(_sweep_loop())
+
+
+async def stop_conversation_sweeper():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+
+def conversation_sweeper_stats() -> dict:
+    return {
+        **_stats,
+        "interval_seconds": CONVERSATION_SWEEP_INTERVAL,
+        "batch_size": CONVERSATION_SWEEP_BATCH_SIZE,
+    }
@@ -1,6 +1,14 @@
 import os
+import asyncio
+import contextvars
+import functools
+import threading
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from fastapi import FastAPI, Request
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from fastapi.middleware.cors import CORSMiddleware
@@ -10,6 +18,10 @@ if os.environ.get('ENVIRONMENT') != 'production':
     from dotenv import load_dotenv
     load_dotenv()
 
+# Imported after the .env file is loaded, the logging settings are read from the environment
+from structured_logging import RequestIdMiddleware, configure_logging
+configure_logging()
+
 FRONTEND_URL = os.environ.get('FRONTEND_URL', 'http://localhost:5173')
 
 app = FastAPI()
@@ -21,18 +33,142 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(RequestIdMiddleware)
 
 
 # Database setup
 DATABASE_URL = os.environ.get('DATABASE_URL')  # Ensure this environment variable is correctly set¬
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+engine = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+# Attributes stay loaded after commit, so async code never triggers a refresh SELECT on the event loop
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 Base = declarative_base()
 
+# Blocking database work from async handlers runs on this bounded pool instead of the event loop.
+# It is sized to the connection pool. That only holds up while no session keeps a connection
+# between run_db calls: a session left idle in transaction while its coroutine awaits the LLM or
+# Graph still holds its pooled connection, and enough of them leave the threads blocked on
+# checkout. Reads that are followed by a network call therefore end with end_read_transaction.
+DB_THREADS = int(os.environ.get('DB_THREADS', DB_POOL_SIZE + DB_MAX_OVERFLOW))
+_db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+
+async def run_db(fn, *args, **kwargs):
+    # Context is copied so per-task state (e.g. the query counter) follows the call onto the thread
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    _db_pool_stats["run_db_in_flight"] += 1
+    _db_pool_stats["peak_run_db_in_flight"] = max(_db_pool_stats["peak_run_db_in_flight"], _db_pool_stats["run_db_in_flight"])
+    try:
+        return await loop.run_in_executor(_db_executor, functools.partial(context.run, fn, *args, **kwargs))
+    finally:
+        _db_pool_stats["run_db_in_flight"] -= 1
+
+def end_read_transaction(db):
+    # Hands the session's connection back to the pool. A commit rather than a rollback, so loaded
+    # objects stay usable (expire_on_commit=False) and nothing already added to the session is lost.
+    db.commit()
+
+# Connection pool and DB thread pool usage, so saturation shows up in /stats
+_db_pool_lock = threading.Lock()
+_db_pool_stats = {
+    "checkouts": 0,
+    "peak_checked_out": 0,
+    "run_db_in_flight": 0,  # Only touched on the event loop
+    "peak_run_db_in_flight": 0,
+}
+
+
+@event.listens_for(engine, "checkout")
+def _record_checkout(dbapi_connection, connection_record, connection_proxy):
+    with _db_pool_lock:
+        _db_pool_stats["checkouts"] += 1
+        _db_pool_stats["peak_checked_out"] = max(_db_pool_stats["peak_checked_out"], engine.pool.checkedout())
+
+
+def db_pool_stats() -> dict:
+    pool = engine.pool
+    capacity = DB_POOL_SIZE + DB_MAX_OVERFLOW
+    checked_out = pool.checkedout()
+    with _db_pool_lock:
+        stats = dict(_db_pool_stats)
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "capacity": capacity,
+        "checked_out": checked_out,
+        "overflow": max(0, pool.overflow()),
+        "saturation": checked_out / capacity,
+        **stats,
+        "db_threads": DB_THREADS,
+        "run_db_waiting": max(0, stats["run_db_in_flight"] - DB_THREADS),  # Calls queued for a free DB thread
+    }
+
+# Per-task query counters, used to report how many statements a unit of work issued.
+# Counters nest: a statement counts towards every count_queries() block it runs inside.
+_query_counters: ContextVar[tuple] = ContextVar("query_counters", default=())
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    for counter in _query_counters.get():
+        counter[0] += 1
+
+
+@contextmanager
+def count_queries():
+    counter = [0]
+    token = _query_counters.set(_query_counters.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _query_counters.reset(token)
+
 # Dependency
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+# WhatsApp Graph API client
+# One long-lived client is shared by every outbound Graph call so connections to
+# graph.facebook.com are kept alive and reused instead of re-handshaking per request.
+GRAPH_API_VERSION = os.environ.get('GRAPH_API_VERSION', 'v20.0')
+GRAPH_API_BASE_URL = os.environ.get('GRAPH_API_BASE_URL', 'https://graph.facebook.com')  # Overridden for local stubs
+GRAPH_API_URL = f"{GRAPH_API_BASE_URL}/{GRAPH_API_VERSION}"
+GRAPH_HTTP2 = os.environ.get('GRAPH_HTTP2', 'false').lower() == 'true'  # Requires the h2 package
+GRAPH_MAX_CONNECTIONS = int(os.environ.get('GRAPH_MAX_CONNECTIONS', 100))
+GRAPH_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('GRAPH_MAX_KEEPALIVE_CONNECTIONS', 20))
+GRAPH_KEEPALIVE_EXPIRY = float(os.environ.get('GRAPH_KEEPALIVE_EXPIRY', 30))
+GRAPH_CONNECT_TIMEOUT = float(os.environ.get('GRAPH_CONNECT_TIMEOUT', 5))
+GRAPH_TIMEOUT = float(os.environ.get('GRAPH_TIMEOUT', 15))
+
+graph_client: httpx.AsyncClient | None = None
+
+
+def get_graph_client() -> httpx.AsyncClient:
+    global graph_client
+    if graph_client is None or graph_client.is_closed:
+        graph_client = httpx.AsyncClient(
+            base_url=GRAPH_API_URL,
+            headers={"Authorization": f"Bearer {os.environ.get('WHATSAPP_GRAPH_API_TOKEN')}"},
+            http2=GRAPH_HTTP2,
+            limits=httpx.Limits(
+                max_connections=GRAPH_MAX_CONNECTIONS,
+                max_keepalive_connections=GRAPH_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=GRAPH_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(GRAPH_TIMEOUT, connect=GRAPH_CONNECT_TIMEOUT),
+        )
+    return graph_client
+
+
+@app.on_event("shutdown")
+async def close_graph_client():
+    global graph_client
+    if graph_client is not None:
+        await graph_client.aclose()
+        graph_client = None
@@ -1,15 +1,29 @@
-from fastapi import HTTPException, Depends
+from fastapi import HTTPException, Depends, Header
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta, timezone
 from fastapi import HTTPException
 import os
 from googleapiclient.discovery import build
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+import json
+import hashlib
+import re
+import logging
+import threading
+import time
 from supabase import create_client, Client
 from sqlalchemy.exc import SQLAlchemyError
 from core import *
 from models import *
-from sqlalchemy import create_engine, MetaData, Table, inspect
+from lookups import *
+from questionnaire_templates import *
+from chat_log_writer import *
+from structured_logging import describe_error
+from sqlalchemy import create_engine, MetaData, Table, inspect, cast, func, insert, text, Text
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, array
+
+logger = logging.getLogger(__name__)
 
 
 # ++++++++++++++++++++++++++++++
@@ -37,7 +51,7 @@ def create_item_in_db(db: Session, item):
         db.refresh(item)
         return {"status": "success", "data": item}
     except SQLAlchemyError as e:
-        print('Error:', str(e), 'Rolling back')
+        logger.error("Error creating item, rolling back", extra={"error": describe_error(e)})
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -48,61 +62,127 @@ def create_item_in_db_internal(db: Session, item):
         db.refresh(item)
         return item
     except Exception as e:
-        print('Error:', str(e), 'Rolling back')
+        logger.error("Error creating item, rolling back", extra={"error": describe_error(e)})
         db.rollback()
         raise HTTPException(status_code=400, detail=f"Failed to create item: {str(e)}")
 
 
 @app.get("/db/table_info")
-def table_info_endpoint(db: Session = Depends(get_db)):
-    table_info = get_table_info(db)
-    return {"status": "success", "data": table_info}
-
+def table_info_endpoint(if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    snapshot = get_table_info_snapshot(db)
+    headers = {"ETag": snapshot["etag"], "Cache-Control": "no-cache"}
+    if if_none_match and etag_matches(if_none_match, snapshot["etag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot["body"], media_type="application/json", headers=headers)
+
+
+_ENTITY_TAG = re.compile(r'(?:W/)?("[^"]*")')
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match is "*" or a comma-separated list of entity tags, compared weakly (RFC 9110
+    # 13.1.2): a W/ prefix on either side is ignored and only the quoted opaque tags are compared
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = _ENTITY_TAG.match(etag).group(1)
+    return opaque_tag in _ENTITY_TAG.findall(if_none_match)
+
+
+# The schema snapshot is built once and reused until the schema fingerprint changes. The
+# fingerprint is an md5 over the catalog (columns, types, defaults, primary and foreign keys),
+# checked at most every TABLE_INFO_CHECK_INTERVAL seconds; invalidate_table_info() drops the
+# snapshot straight away after a migration.
+TABLE_INFO_CHECK_INTERVAL = float(os.getenv("TABLE_INFO_CHECK_INTERVAL", 10))
+
+SCHEMA_FINGERPRINT_QUERY = text("""
+    SELECT md5(coalesce(string_agg(entry, ',' ORDER BY entry), '')) FROM (
+        SELECT c.relname || '.' || a.attname || ':' || format_type(a.atttypid, a.atttypmod) || ':'
+               || a.attnotnull || ':' || coalesce(pg_get_expr(d.adbin, d.adrelid), '') AS entry
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+        WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'p') AND a.attnum > 0 AND NOT a.attisdropped
+        UNION ALL
+        SELECT conrelid::regclass::text || ':' || pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE connamespace = current_schema()::regnamespace AND contype IN ('p', 'f')
+    ) entries
+""")
+
+_table_info = {"snapshot": None, "checked_at": 0.0}
+_table_info_lock = threading.Lock()
+
+
+def invalidate_table_info():
+    with _table_info_lock:
+        _table_info["snapshot"] = None
+
+
+def get_table_info_snapshot(db: Session) -> dict:
+    # Returns {"fingerprint", "etag", "data", "body"}, body being the serialized response
+    with _table_info_lock:
+        snapshot = _table_info["snapshot"]
+        if snapshot is not None and time.monotonic() - _table_info["checked_at"] < TABLE_INFO_CHECK_INTERVAL:
+            return snapshot
+
+    fingerprint = db.execute(SCHEMA_FINGERPRINT_QUERY).scalar()
+    if snapshot is None or snapshot["fingerprint"] != fingerprint:
+        data = get_table_info(db)
+        body = json.dumps({"status": "success", "data": data}, default=str).encode()
+        snapshot = {
+            "fingerprint": fingerprint,
+            "etag": f'"{hashlib.md5(body).hexdigest()}"',
+            "data": data,
+            "body": body,
+        }
+    with _table_info_lock:
+        _table_info["snapshot"] = snapshot
+        _table_info["checked_at"] = time.monotonic()
+    return snapshot
 
 
 def get_table_info(db: Session) -> List[Dict[str, Any]]:
-    # Use SQLAlchemy's Inspector to fetch information directly from the database
+    # Use SQLAlchemy's Inspector to fetch information directly from the database. The get_multi_*
+    # calls read columns, primary keys and foreign keys for every table in one catalog query each.
     inspector = inspect(db.bind)
-    
-    # Get a list of all table names in the database
-    table_names = inspector.get_table_names()
-    
+    columns_by_table = inspector.get_multi_columns()
+    primary_keys = inspector.get_multi_pk_constraint()
+    foreign_keys = inspector.get_multi_foreign_keys()
+
     table_info = []
 
-    # Loop through each table in the database
-    for table_name in table_names:
+    # Keys are (schema, table_name), schema being None for the default schema
+    for key in sorted(columns_by_table, key=lambda key: key[1]):
+        schema, table_name = key
         table_details = {
             "table_name": table_name,
             "columns": []
         }
-        
-        # Get column information for each table
-        columns = inspector.get_columns(table_name)
-        for column in columns:
+
+        primary_key_columns = set(primary_keys.get(key, {}).get('constrained_columns') or [])
+        foreign_key_by_column = {}
+        for fk in foreign_keys.get(key, []):
+            for fk_column in fk['constrained_columns']:
+                foreign_key_by_column[fk_column] = {
+                    "referred_table": fk['referred_table'],
+                    "referred_column": fk['referred_columns'][0]
+                }
+
+        for column in columns_by_table[key]:
             column_info = {
                 "name": column['name'],
                 "type": str(column['type']),
                 "nullable": column['nullable'],  # Whether the column can contain NULL values
                 "default": column.get('default'),  # The default value (if any)
                 "autoincrement": column.get('autoincrement', False),  # Auto-increment
-                "primary_key": column.get('primary_key', False),  # Primary key
+                "primary_key": column['name'] in primary_key_columns,  # Primary key
+                "foreign_key": foreign_key_by_column.get(column['name']),
             }
-            
-            # Check for foreign key relationships
-            foreign_keys = inspector.get_foreign_keys(table_name)
-            column_info["foreign_key"] = None
-            for fk in foreign_keys:
-                for fk_column in fk['constrained_columns']:
-                    if fk_column == column['name']:
-                        column_info["foreign_key"] = {
-                            "referred_table": fk['referred_table'],
-                            "referred_column": fk['referred_columns'][0]
-                        }
-
             table_details["columns"].append(column_info)
-        
+
         table_info.append(table_details)
-    
+
     return table_info
 
 # Helper function to create new objects
@@ -126,7 +206,9 @@ def create_new_patient(patient: PatientCreateRequest, db: Session = Depends(get_
         email=patient.email,
         created_at=datetime.now(timezone.utc)
     )
-    return create_item_in_db(db, new_patient)
+    result = create_item_in_db(db, new_patient)
+    cache_patient_phone_number(new_patient.phone_number, new_patient.id)
+    return result
 
 
 @app.post("/db/new_user")
@@ -144,6 +226,10 @@ def create_new_user(user: UserCreateRequest, db: Session = Depends(get_db)):
 
 @app.post("/db/new_template")
 def create_new_template(template: TemplateCreateRequest, db: Session = Depends(get_db)):
+    try:
+        compiled = compile_questions(template.questions)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid template questions: {str(e)}")
     new_template = Template(
         owner=template.owner,
         duration=template.duration,
@@ -151,7 +237,9 @@ def create_new_template(template: TemplateCreateRequest, db: Session = Depends(g
         title=template.title,
         created_at=datetime.now(timezone.utc)
     )
-    return create_item_in_db(db, new_template)
+    result = create_item_in_db(db, new_template)
+    cache_compiled_template(new_template.id, compiled)
+    return result
 
 
 def create_new_questionnaire(patient_id, template_id, user_id, current_status, db: Session):
@@ -159,7 +247,7 @@ def create_new_questionnaire(patient_id, template_id, user_id, current_status, d
         # Fetch the template from the database
         template_instance = db.query(Template).filter(Template.id == template_id).first()
         if not template_instance:
-            print("ERROR: Template not found")
+            logger.warning("Template not found", extra={"template_id": template_id})
             raise HTTPException(status_code=404, detail="Template not found")
 
         # Process questions
@@ -193,7 +281,40 @@ def create_new_conversation(patient_id: int, status: str, questionnaire_id: int
     return create_item_in_db_internal(db, new_conversation)
 
 
-def log_chat_message(conversation_id: int, patient_id: int, message: str, role: str, db: Session):
+def create_questionnaires_bulk(rows: List[Dict[str, Any]], db: Session) -> Dict[int, int]:
+    # rows are Questionnaire column dicts, returns patient_id -> new questionnaire id. The caller commits.
+    if not rows:
+        return {}
+    result = db.execute(
+        insert(Questionnaire).returning(Questionnaire.patient_id, Questionnaire.id),
+        rows
+    )
+    return {row.patient_id: row.id for row in result}
+
+
+def create_conversations_bulk(rows: List[Dict[str, Any]], db: Session) -> Dict[int, int]:
+    # rows are Conversation column dicts, returns patient_id -> new conversation id. The caller commits.
+    if not rows:
+        return {}
+    result = db.execute(
+        insert(Conversation).returning(Conversation.patient_id, Conversation.id),
+        rows
+    )
+    return {row.patient_id: row.id for row in result}
+
+
+def log_chat_message(conversation_id: int, patient_id: int, message: str, role: str, db: Session, sync: bool = False):
+    # Buffered by the chat log writer unless the caller needs the row (and its id) back
+    if not sync and chat_log_writer_running():
+        enqueue_chat_log({
+            "message_text": message,
+            "patient_id": patient_id,
+            "conversation_id": conversation_id,
+            "created_at": datetime.now(timezone.utc),
+            "role": role,
+        })
+        return None
+
     new_message = ChatLogMessage(
         message_text=message,
         patient_id=patient_id,
@@ -203,3 +324,84 @@ def log_chat_message(conversation_id: int, patient_id: int, message: str, role:
     )
 
     return create_item_in_db_internal(db, new_message)
+
+
+# Partial updates of Questionnaire.questions
+# Answers and comments are written with jsonb_set on the server instead of rewriting the whole
+# document, so the write size no longer grows with the template and its comment history.
+# The caller commits. The in-memory "questions" attribute is expired so later reads are fresh.
+
+def set_questionnaire_answer(questionnaire: Questionnaire, position: int, answer: str, db: Session):
+    path = cast(array(["questions_list", str(position), "answer"]), ARRAY(Text))
+    db.query(Questionnaire).filter(Questionnaire.id == questionnaire.id).update(
+        {Questionnaire.questions: func.jsonb_set(Questionnaire.questions, path, func.to_jsonb(cast(answer, Text)))},
+        synchronize_session=False
+    )
+    db.expire(questionnaire, ["questions"])
+
+
+def append_questionnaire_comment(questionnaire: Questionnaire, comment: str, db: Session):
+    path = cast(array(["comments"]), ARRAY(Text))
+    comments = func.coalesce(Questionnaire.questions["comments"], cast("[]", JSONB)).op("||")(
+        func.jsonb_build_array(cast(comment, Text))
+    )
+    db.query(Questionnaire).filter(Questionnaire.id == questionnaire.id).update(
+        {Questionnaire.questions: func.jsonb_set(Questionnaire.questions, path, comments)},
+        synchronize_session=False
+    )
+    db.expire(questionnaire, ["questions"])
+
+
+# List endpoints
+# Rows are keyset-paginated on id (pass the X-Next-Cursor header back as ?cursor=), can be
+# projected with ?fields=, and are read through a server-side cursor in LIST_CHUNK_SIZE chunks.
+# A JSON response is built in memory, so it holds at most LIST_DEFAULT_PAGE_SIZE rows unless
+# ?limit= says otherwise; callers that want everything follow the cursor, or use format=ndjson,
+# which streams one row per line and is unbounded unless a limit is given, for full exports.
+
+LIST_CHUNK_SIZE = int(os.getenv("LIST_CHUNK_SIZE", 500))
+LIST_DEFAULT_PAGE_SIZE = int(os.getenv("LIST_DEFAULT_PAGE_SIZE", 1000))
+
+
+def select_list_columns(model, fields: str | None):
+    column_names = [column.name for column in model.__table__.columns]
+    if not fields:
+        return [getattr(model, name) for name in column_names]
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in column_names]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    if "id" not in names:
+        names.insert(0, "id")  # Needed for the cursor
+    return [getattr(model, name) for name in names]
+
+
+def _stream_ndjson(statement):
+    # The request's session is closed before a streamed body is sent, so use a dedicated one
+    db = SessionLocal()
+    try:
+        result = db.execute(statement.execution_options(yield_per=LIST_CHUNK_SIZE))
+        for row in result:
+            yield json.dumps(jsonable_encoder(dict(row._mapping))) + "\n"
+    finally:
+        db.close()
+
+
+def list_rows(model, filters: list, cursor: int | None, limit: int | None, fields: str | None, format: str, db: Session):
+    query = db.query(*select_list_columns(model, fields)).filter(*filters)
+    if cursor is not None:
+        query = query.filter(model.id > cursor)
+    query = query.order_by(model.id)
+    if limit is None and format != "ndjson":
+        limit = LIST_DEFAULT_PAGE_SIZE
+    if limit is not None:
+        query = query.limit(limit)
+
+    if format == "ndjson":
+        return StreamingResponse(_stream_ndjson(query.statement), media_type="application/x-ndjson")
+
+    rows = [dict(row._mapping) for row in query.yield_per(LIST_CHUNK_SIZE)]
+    headers = {}
+    if limit is not None and len(rows) == limit:
+        headers["X-Next-Cursor"] = str(rows[-1]["id"])
+    return JSONResponse(content=jsonable_encoder(rows), headers=headers)
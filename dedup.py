@@ -0,0 +1,97 @@
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from cachetools import TTLCache
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from models import ProcessedMessage
+
+
+# ++++++++++++++++++++++++++++++++++
+# ++++++++ MESSAGE DEDUPLICATION +++
+# ++++++++++++++++++++++++++++++++++
+
+# Meta redelivers webhooks it thinks we missed. Each inbound message id is claimed once:
+# recently seen ids are answered from memory, everything else goes through a unique-keyed
+# insert into Processed_messages so the claim holds across restarts and across workers.
+# Claims are only needed while Meta may still redeliver the message (it retries undelivered
+# webhooks for up to 7 days), so older rows are deleted by the webhook queue's recovery loop.
+
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", 10000))
+DEDUP_CACHE_TTL = int(os.getenv("DEDUP_CACHE_TTL", 24 * 60 * 60))
+DEDUP_RETENTION_DAYS = float(os.getenv("DEDUP_RETENTION_DAYS", 7))
+DEDUP_PRUNE_BATCH_SIZE = int(os.getenv("DEDUP_PRUNE_BATCH_SIZE", 5000))
+
+_seen_message_ids = TTLCache(maxsize=DEDUP_CACHE_SIZE, ttl=DEDUP_CACHE_TTL)
+_stats = {
+    "checked": 0,
+    "memory_hits": 0,
+    "db_hits": 0,
+    "claimed": 0,
+    "released": 0,
+    "pruned": 0,
+}
+_lock = threading.Lock()  # Claims run on the database threads
+
+
+def claim_message_id(message_id: str, db: Session) -> bool:
+    # Returns True the first time a message id is seen, False for duplicates
+    with _lock:
+        _stats["checked"] += 1
+        if message_id in _seen_message_ids:
+            _stats["memory_hits"] += 1
+            return False
+
+    claimed = db.execute(
+        insert(ProcessedMessage)
+        .values(message_id=message_id, created_at=datetime.now(timezone.utc))
+        .on_conflict_do_nothing(index_elements=[ProcessedMessage.message_id])
+        .returning(ProcessedMessage.message_id)
+    ).first()
+    db.commit()
+
+    with _lock:
+        _seen_message_ids[message_id] = True
+        if claimed is None:
+            _stats["db_hits"] += 1
+            return False
+        _stats["claimed"] += 1
+    return True
+
+
+def release_message_id(message_id: str, db: Session):
+    # Undo a claim when processing failed so the queue's retry can handle the message again
+    with _lock:
+        _seen_message_ids.pop(message_id, None)
+    db.query(ProcessedMessage).filter(ProcessedMessage.message_id == message_id).delete(synchronize_session=False)
+    db.commit()
+    with _lock:
+        _stats["released"] += 1
+
+
+def prune_processed_messages(db: Session) -> int:
+    batch = select(ProcessedMessage.message_id).where(
+        ProcessedMessage.created_at < datetime.now(timezone.utc) - timedelta(days=DEDUP_RETENTION_DAYS)
+    ).limit(DEDUP_PRUNE_BATCH_SIZE)
+    pruned = 0
+    while True:
+        deleted = db.query(ProcessedMessage).filter(ProcessedMessage.message_id.in_(batch)).delete(synchronize_session=False)
+        db.commit()
+        pruned += deleted
+        if deleted < DEDUP_PRUNE_BATCH_SIZE:
+            break
+    with _lock:
+        _stats["pruned"] += pruned
+    return pruned
+
+
+def dedup_stats() -> dict:
+    with _lock:
+        duplicates = _stats["memory_hits"] + _stats["db_hits"]
+        return {
+            **_stats,
+            "duplicates": duplicates,
+            "hit_rate": duplicates / _stats["checked"] if _stats["checked"] else 0.0,
+            "cache_size": len(_seen_message_ids),
+        }
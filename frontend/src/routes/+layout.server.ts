@@ -1,24 +1,29 @@
 import { error } from "@sveltejs/kit";
 import type { LayoutServerLoad } from "./$types";
 import type { Patient, Questionnaire, Template } from "$lib/types/models";
-export const load: LayoutServerLoad = async ({ fetch }) => {
-    try {
-        const [patientsRes, questionnairesRes, templatesRes] = await Promise.all([
-            fetch('/api/get_patients'),
-            fetch('/api/get_questionnaires'),
-            fetch('/api/get_templates')
-        ]);
-
-        if (!patientsRes.ok || !questionnairesRes.ok || !templatesRes.ok) {
-            throw new Error(`${patientsRes.status} ${patientsRes.statusText} ${questionnairesRes.status} ${questionnairesRes.statusText} ${templatesRes.status} ${templatesRes.statusText} `);
+// List endpoints return one page at a time; follow X-Next-Cursor until the last page
+async function fetchAllPages<T>(fetch: typeof globalThis.fetch, url: string): Promise<T[]> {
+    const rows: T[] = [];
+    let cursor: string | null = null;
+    do {
+        const res = await fetch(cursor === null ? url : `${url}?cursor=${cursor}`);
+        if (!res.ok) {
+            throw new Error(`${url}: ${res.status} ${res.statusText}`);
         }
+        rows.push(...await res.json());
+        cursor = res.headers.get('X-Next-Cursor');
+    } while (cursor !== null);
+    return rows;
+}
 
+export const load: LayoutServerLoad = async ({ fetch }) => {
+    try {
         const [patientsList, questionnairesList, templatesList] = await Promise.all([
-            patientsRes.json(),
-            questionnairesRes.json(),
-            templatesRes.json()
+            fetchAllPages<Patient>(fetch, '/api/get_patients'),
+            fetchAllPages<Questionnaire>(fetch, '/api/get_questionnaires'),
+            fetchAllPages<Template>(fetch, '/api/get_templates')
         ]);
-        
+
         const patients: Patient[] = patientsList;
         const questionnaires: Questionnaire[] = questionnairesList;
         const templates: Template[] = templatesList;
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime, timezone
+from cachetools import LRUCache
+from openai import AsyncOpenAI
+from sqlalchemy.dialects.postgresql import insert
+from core import SessionLocal, run_db
+from structured_logging import describe_error
+from models import MessageInterpretation
+
+
+# ++++++++++++++++++++++++++++++++++
+# ++++++++ LLM INTERPRETATION ++++++
+# ++++++++++++++++++++++++++++++++++
+
+# Free-text questionnaire replies are interpreted by one shared AsyncOpenAI client.
+# Patients send the same replies over and over, so interpretations are cached by normalized
+# text in an in-memory LRU and, with INTERPRETATION_CACHE_DB=true, in Message_interpretations.
+# Identical messages that arrive while a call is in flight wait for that call instead of
+# making their own.
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 20))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 2))
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # None for api.openai.com, set for local stubs
+INTERPRETATION_CACHE_SIZE = int(os.getenv("INTERPRETATION_CACHE_SIZE", 10000))
+INTERPRETATION_CACHE_DB = os.getenv("INTERPRETATION_CACHE_DB", "false").lower() == "true"
+
+logger = logging.getLogger(__name__)
+
+INTERPRETATION_PROMPT = "You are an assistant that interprets user messages. If the user intends to say a number (0-10), 'skip', or 'end', respond with just that word or number. For typos or wordy messages, interpret the likely intent. If the user doesn't intend any of these, respond with 'None'. Examples: 'I want to stop' -> end, 'Let's move on' -> skip, 'I feel about a seven today' -> 7, 'I had toast for breakfast' -> None. Response with only the desired string without any other text or any quotation marks."
+
+_openai_client: AsyncOpenAI | None = None
+_interpretations = LRUCache(maxsize=INTERPRETATION_CACHE_SIZE)
+_in_flight: dict[str, asyncio.Task] = {}
+_stats = {
+    "hits": 0,
+    "db_hits": 0,
+    "coalesced": 0,
+    "llm_calls": 0,
+    "errors": 0,
+}
+
+
+def get_openai_client() -> AsyncOpenAI:
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_KEY"),
+            base_url=OPENAI_BASE_URL,
+            timeout=OPENAI_TIMEOUT,
+            max_retries=OPENAI_MAX_RETRIES,
+        )
+    return _openai_client
+
+
+async def close_openai_client():
+    global _openai_client
+    if _openai_client is not None:
+        await _openai_client.close()
+        _openai_client = None
+
+
+def normalize_message_text(message_text: str) -> str:
+    text = re.sub(r"\s+", " ", message_text.lower()).strip()
+    return text.strip(" .,!?;:'\"")
+
+
+def _load_interpretation(normalized_text: str) -> str | None:
+    db = SessionLocal()
+    try:
+        row = db.query(MessageInterpretation.interpretation).filter(
+            MessageInterpretation.normalized_text == normalized_text
+        ).first()
+        return row.interpretation if row else None
+    finally:
+        db.close()
+
+
+def _save_interpretation(normalized_text: str, interpretation: str):
+    db = SessionLocal()
+    try:
+        db.execute(
+            insert(MessageInterpretation)
+            .values(normalized_text=normalized_text, interpretation=interpretation, created_at=datetime.now(timezone.utc))
+            .on_conflict_do_nothing(index_elements=[MessageInterpretation.normalized_text])
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+async def _interpret(normalized_text: str) -> str:
+    if INTERPRETATION_CACHE_DB:
+        interpretation = await run_db(_load_interpretation, normalized_text)
+        if interpretation is not None:
+            _stats["db_hits"] += 1
+            _interpretations[normalized_text] = interpretation
+            return interpretation
+
+    _stats["llm_calls"] += 1
+    try:
+        response = await get_openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": INTERPRETATION_PROMPT},
+                {"role": "user", "content": normalized_text}
+            ]
+        )
+    except Exception:
+        _stats["errors"] += 1
+        raise
+    interpretation = (response.choices[0].message.content or "none").strip().lower()
+
+    _interpretations[normalized_text] = interpretation
+    if INTERPRETATION_CACHE_DB:
+        try:
+            await run_db(_save_interpretation, normalized_text, interpretation)
+        except Exception as e:
+            logger.error("Error saving message interpretation", extra={"error": describe_error(e)})
+    return interpretation
+
+
+async def interpret_message(message_text: str) -> str:
+    # Returns the model's answer, lower-cased: a number, "skip", "end" or "none"
+    normalized_text = normalize_message_text(message_text)
+    interpretation = _interpretations.get(normalized_text)
+    if interpretation is not None:
+        _stats["hits"] += 1
+        return interpretation
+
+    task = _in_flight.get(normalized_text)
+    if task is not None:
+        _stats["coalesced"] += 1
+    else:
+        task = asyncio.create_task(_interpret(normalized_text))
+        _in_flight[normalized_text] = task
+        task.add_done_callback(lambda _: _in_flight.pop(normalized_text, None))
+    # Shielded so one cancelled caller does not cancel the call the others are waiting on
+    return await asyncio.shield(task)
+
+
+def interpretation_stats() -> dict:
+    lookups = _stats["hits"] + _stats["db_hits"] + _stats["coalesced"] + _stats["llm_calls"]
+    return {
+        **_stats,
+        "hit_rate": (_stats["hits"] + _stats["db_hits"] + _stats["coalesced"]) / lookups if lookups else 0.0,
+        "cache_size": len(_interpretations),
+        "in_flight": len(_in_flight),
+    }
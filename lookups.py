@@ -0,0 +1,216 @@
+import logging
+import os
+import threading
+from cachetools import TTLCache
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from core import end_read_transaction
+from models import Patient, User, Team
+
+
+# ++++++++++++++++++++++++++++++++++
+# ++++++++++ LOOKUP CACHES +++++++++
+# ++++++++++++++++++++++++++++++++++
+
+# Phone number -> patient id. The mapping almost never changes, so it is served from memory,
+# warmed at startup and written through by the patient endpoints. Unknown numbers are
+# remembered separately with a shorter TTL so they stop costing a query per message.
+# The caches are read from the database threads and invalidated from ORM hooks on any thread,
+# so every access goes through _lock.
+
+PATIENT_CACHE_SIZE = int(os.getenv("PATIENT_CACHE_SIZE", 50000))
+PATIENT_CACHE_TTL = int(os.getenv("PATIENT_CACHE_TTL", 60 * 60))
+PATIENT_CACHE_NEGATIVE_TTL = int(os.getenv("PATIENT_CACHE_NEGATIVE_TTL", 5 * 60))
+
+logger = logging.getLogger(__name__)
+
+_patient_ids_by_phone = TTLCache(maxsize=PATIENT_CACHE_SIZE, ttl=PATIENT_CACHE_TTL)
+_unknown_phone_numbers = TTLCache(maxsize=PATIENT_CACHE_SIZE, ttl=PATIENT_CACHE_NEGATIVE_TTL)
+_patient_cache_stats = {
+    "hits": 0,
+    "negative_hits": 0,
+    "misses": 0,
+}
+_lock = threading.RLock()
+
+
+def get_patient_id_from_phone_number(phone_number: str, db: Session) -> int | None:
+    with _lock:
+        patient_id = _patient_ids_by_phone.get(phone_number)
+        if patient_id is not None:
+            _patient_cache_stats["hits"] += 1
+            return patient_id
+        if phone_number in _unknown_phone_numbers:
+            _patient_cache_stats["negative_hits"] += 1
+            return None
+        _patient_cache_stats["misses"] += 1
+
+    row = db.query(Patient.id).filter(Patient.phone_number == phone_number).first()
+    # The message's transcription and LLM calls come next
+    end_read_transaction(db)
+    with _lock:
+        if row is None:
+            _unknown_phone_numbers[phone_number] = True
+            return None
+        _patient_ids_by_phone[phone_number] = row.id
+    return row.id
+
+
+def cache_patient_phone_number(phone_number: str | None, patient_id: int):
+    if not phone_number:
+        return
+    with _lock:
+        _unknown_phone_numbers.pop(phone_number, None)
+        _patient_ids_by_phone[phone_number] = patient_id
+
+
+def invalidate_patient_phone_number(phone_number: str | None):
+    if not phone_number:
+        return
+    with _lock:
+        _patient_ids_by_phone.pop(phone_number, None)
+        _unknown_phone_numbers.pop(phone_number, None)
+
+
+def warm_patient_cache(db: Session) -> int:
+    rows = db.query(Patient.phone_number, Patient.id).filter(
+        Patient.phone_number.isnot(None)
+    ).order_by(Patient.id.desc()).limit(PATIENT_CACHE_SIZE).all()
+    with _lock:
+        for row in rows:
+            _patient_ids_by_phone[row.phone_number] = row.id
+    logger.info("Warmed patient cache", extra={"phone_numbers": len(rows)})
+    return len(rows)
+
+
+def patient_cache_stats() -> dict:
+    with _lock:
+        lookups = sum(_patient_cache_stats.values())
+        return {
+            **_patient_cache_stats,
+            "hit_rate": (_patient_cache_stats["hits"] + _patient_cache_stats["negative_hits"]) / lookups if lookups else 0.0,
+            "size": len(_patient_ids_by_phone),
+            "negative_size": len(_unknown_phone_numbers),
+        }
+
+
+# Patient id -> (phone_number, whatsapp_number_id), the routing needed for every outbound send.
+# Resolved with one joined Patient/User/Team query and cached per session (request) and per
+# process. ORM writes that change a patient's number or assignment, a user's team or a
+# team's number invalidate the cached routes.
+
+ROUTE_CACHE_SIZE = int(os.getenv("ROUTE_CACHE_SIZE", 50000))
+ROUTE_CACHE_TTL = int(os.getenv("ROUTE_CACHE_TTL", 5 * 60))
+
+_patient_routes = TTLCache(maxsize=ROUTE_CACHE_SIZE, ttl=ROUTE_CACHE_TTL)
+_route_cache_stats = {
+    "request_hits": 0,
+    "hits": 0,
+    "misses": 0,
+    "invalidations": 0,
+}
+
+
+def get_patient_route(patient_id: int, db: Session) -> tuple[str, int]:
+    # Always followed by a Graph send, so the session's transaction is ended on every path
+    request_routes = db.info.setdefault("patient_routes", {})
+    route = request_routes.get(patient_id)
+    if route is not None:
+        with _lock:
+            _route_cache_stats["request_hits"] += 1
+        end_read_transaction(db)
+        return route
+
+    with _lock:
+        route = _patient_routes.get(patient_id)
+        if route is not None:
+            _route_cache_stats["hits"] += 1
+        else:
+            _route_cache_stats["misses"] += 1
+    if route is None:
+        route = _load_patient_route(patient_id, db)
+        with _lock:
+            _patient_routes[patient_id] = route
+    request_routes[patient_id] = route
+    end_read_transaction(db)
+    return route
+
+
+def _load_patient_route(patient_id: int, db: Session) -> tuple[str, int]:
+    row = db.query(
+        Patient.phone_number,
+        Patient.assigned_to,
+        User.id.label("user_id"),
+        Team.whatsapp_number_id
+    ).outerjoin(User, User.id == Patient.assigned_to).outerjoin(
+        Team, Team.id == User.team_id
+    ).filter(Patient.id == patient_id).first()
+
+    if row is None:
+        raise Exception("Error in get_patient_route: Patient not found")
+    if row.assigned_to is None:
+        raise Exception("Error in get_patient_route: Patient not assigned to any user")
+    if row.user_id is None:
+        raise Exception("Error in get_patient_route: User not found")
+    if row.whatsapp_number_id is None:
+        raise Exception("Error in get_patient_route: Team not found")
+    return row.phone_number, row.whatsapp_number_id
+
+
+def invalidate_patient_route(patient_id: int):
+    with _lock:
+        _patient_routes.pop(patient_id, None)
+        _route_cache_stats["invalidations"] += 1
+
+
+def invalidate_all_patient_routes():
+    with _lock:
+        _patient_routes.clear()
+        _route_cache_stats["invalidations"] += 1
+
+
+def route_cache_stats() -> dict:
+    with _lock:
+        return {
+            **_route_cache_stats,
+            "size": len(_patient_routes),
+        }
+
+
+def _attribute_changed(target, attribute: str) -> bool:
+    return inspect(target).attrs[attribute].history.has_changes()
+
+
+@event.listens_for(Patient, "after_update")
+def _patient_updated(mapper, connection, target):
+    if _attribute_changed(target, "phone_number"):
+        history = inspect(target).attrs["phone_number"].history
+        for phone_number in history.deleted:
+            invalidate_patient_phone_number(phone_number)
+        cache_patient_phone_number(target.phone_number, target.id)
+    if _attribute_changed(target, "phone_number") or _attribute_changed(target, "assigned_to"):
+        invalidate_patient_route(target.id)
+
+
+@event.listens_for(Patient, "after_delete")
+def _patient_deleted(mapper, connection, target):
+    invalidate_patient_phone_number(target.phone_number)
+    invalidate_patient_route(target.id)
+
+
+@event.listens_for(User, "after_update")
+def _user_updated(mapper, connection, target):
+    if _attribute_changed(target, "team_id"):
+        invalidate_all_patient_routes()
+
+
+@event.listens_for(Team, "after_update")
+def _team_updated(mapper, connection, target):
+    if _attribute_changed(target, "whatsapp_number_id"):
+        invalidate_all_patient_routes()
+
+
+@event.listens_for(User, "after_delete")
+@event.listens_for(Team, "after_delete")
+def _route_owner_deleted(mapper, connection, target):
+    invalidate_all_patient_routes()
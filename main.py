@@ -1,5 +1,10 @@
-import copy
+import asyncio
+import logging
+import time
 import traceback
+import uuid
+from cachetools import LRUCache
+from contextvars import ContextVar
 from fastapi import FastAPI, HTTPException, Depends
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta, timezone
@@ -9,6 +14,7 @@ import os
 from googleapiclient.discovery import build
 from fastapi.responses import JSONResponse, Response
 from supabase import create_client, Client
+from sqlalchemy import and_, case, select
 from sqlalchemy.exc import SQLAlchemyError
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_KEY")
@@ -17,7 +23,20 @@ from db import *
 from models import *
 from utils import *
 from core import *
-
+from webhook_queue import *
+from dedup import *
+from lookups import *
+from rate_limiter import *
+from llm import *
+from message_parser import *
+from audio_pipeline import *
+from migrations import *
+from metrics import *
+from structured_logging import *
+from conversation_sweeper import *
+from questionnaire_templates import *
+
+logger = logging.getLogger(__name__)
 
 
 # +++++++++++++++++++++++++++++++
@@ -36,7 +55,7 @@ async def whatsapp_verify_webhook(request: Request):
     challenge = request.query_params.get("hub.challenge")
 
     if mode == "subscribe" and token == WHATSAPP_WEBHOOK_VERIFY_TOKEN:
-        print("Webhook verified successfully!")
+        logger.info("Webhook verified successfully")
         res = Response(content=challenge, media_type="text/plain")
         return res
     else:
@@ -44,195 +63,387 @@ async def whatsapp_verify_webhook(request: Request):
 
     
 @app.post("/whatsapp/webhook")
-async def whatsapp_notify_webhook(request: WebhookRequest, db: Session = Depends(get_db)):
+async def whatsapp_notify_webhook(request: Request, db: Session = Depends(get_db)):
+    # Persist the raw event and acknowledge immediately, the webhook workers do the actual processing.
+    # Bodies that could never be processed are rejected here rather than retried by the workers.
     try:
-        for entry in request.entry:
-            for change in entry.changes:
-                value = change.value
-                if value.messages:
-                    message = value.messages[0]
-                    print(f"message from: {message.from_}")
-                    patient = get_patient_from_phone_number(message.from_, db)
-                    if not patient:
-                        print("ERROR: Recieved message from unknown patient")
-                        return {"status": "success"}
-                    print(f"Patient: {patient}")
-                    if message.type == 'text':
-                        print(f"Text message: {message.text['body']}")
-                        message_text = message.text['body']
-                        await handle_incoming_message(patient.id, message_text, message.id, db)
-
-                    elif message.type == 'audio':
-                        print(f"Audio message: {message.audio}")
-                        message_text = await process_audio_message(message)
-                        await handle_incoming_message(patient.id, message_text, message.id, db)
-
-                    elif message.type == 'button':
-                        print(f"Button pressed: {message.button['payload']}")
-                        message_text = "Thank you for pressing a button"
-                        if message.button['payload'] == 'Begin':
-                            message_text = "Let's start the questionnaire"
-                            await handle_begin_button(patient.id, db)
-
-                    business_phone_number_id = value.metadata.phone_number_id
-                    message_id = message.id
-                    message_from = message.from_
-
-                    await mark_message_as_read(business_phone_number_id, message_id)
-
-                elif value.statuses:
-                    status = value.statuses[0]
-                    print(f"Status update: {status.status} for message {status.id}")
-
-        return {"status": "success"}
-    except Exception as e:
-        print(f"Error processing WhatsApp webhook: {str(e)}")
-        print(f"Full error details: {traceback.format_exc()}")
-        return {"status": "success"}
+        payload = await request.json()
+        WebhookRequest.model_validate(payload)
+    except ValueError as e:  # Covers JSONDecodeError and pydantic's ValidationError
+        logger.warning("Rejected invalid webhook payload", extra={"error": type(e).__name__})
+        raise HTTPException(status_code=400, detail="Invalid webhook payload")
+    await enqueue_webhook_event(payload, db)
+    return {"status": "success"}
+
+
+WEBHOOK_PATIENT_CONCURRENCY = int(os.getenv("WEBHOOK_PATIENT_CONCURRENCY", 8))
+
+
+async def process_webhook_event(payload: dict):
+    started = time.perf_counter()
+    with STAGE_SECONDS.labels("webhook_parse").time():
+        request = WebhookRequest.model_validate(payload)
+
+    # Meta batches events under load, so collect every message and status in the delivery.
+    # Messages are grouped per sender so each patient's messages are still handled in order.
+    messages_by_sender = {}
+    statuses = []
+    for entry in request.entry:
+        for change in entry.changes:
+            value = change.value
+            for message in value.messages or []:
+                messages_by_sender.setdefault(message.from_, []).append((message, value.metadata.phone_number_id))
+            statuses.extend(value.statuses or [])
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for status in statuses:
+            logger.debug("Status update", extra={"status": status.status, "message_id": status.id})
+
+    semaphore = asyncio.Semaphore(WEBHOOK_PATIENT_CONCURRENCY)
+    results = await asyncio.gather(
+        *[process_sender_messages(sender, messages, semaphore) for sender, messages in messages_by_sender.items()],
+        return_exceptions=True
+    )
+
+    message_count = sum(len(messages) for messages in messages_by_sender.values())
+    duration = time.perf_counter() - started
+    record_webhook_batch(message_count, len(statuses), len(messages_by_sender), duration)
+    logger.info("Processed webhook batch", extra={
+        "messages": message_count,
+        "senders": len(messages_by_sender),
+        "statuses": len(statuses),
+        "seconds": round(duration, 3),
+    })
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        raise errors[0]
+
+
+async def process_sender_messages(sender: str, messages: list, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        db = SessionLocal()
+        claimed = []
+        processed = 0
+        try:
+            # Drop redelivered messages before any lookups, LLM or Graph calls
+            for item in messages:
+                if await run_db(claim_message_id, item[0].id, db):
+                    claimed.append(item)
+            if not claimed:
+                logger.debug("Skipping duplicate messages", extra={"sender": sender})
+                return
+            logger.debug("Messages received", extra={"sender": sender, "messages": len(claimed)})
+            with STAGE_SECONDS.labels("patient_lookup").time():
+                patient_id = await run_db(get_patient_id_from_phone_number, sender, db)
+            if not patient_id:
+                logger.warning("Received message from unknown patient", extra={"sender": sender})
+                return
+            bind_patient_id(patient_id)
+            claimed.sort(key=lambda item: int(item[0].timestamp))
+            for message, business_phone_number_id in claimed:
+                progress = MessageProgress()
+                _message_progress.set(progress)
+                try:
+                    await process_message(patient_id, message, business_phone_number_id, db)
+                except Exception:
+                    if not progress.committed:
+                        raise
+                    # Its changes are saved, so it keeps its claim and only the reply is sent again
+                    processed += 1
+                    if progress.unsent_reply is None:
+                        raise
+                    await resend_reply(progress.unsent_reply, db)
+                    await mark_message_as_read(business_phone_number_id, message.id)
+                    continue
+                processed += 1
+        except Exception:
+            # Anything claimed but not committed is released, so the queue's retry processes it
+            await release_unprocessed_messages([message for message, _ in claimed[processed:]], db)
+            raise
+        finally:
+            await run_db(db.close)
+
+
+# Handling a message commits its changes (an answer, a status change) before the replies are
+# sent. Once committed the message must not be handled again: the retry would apply the same
+# reply to the next question. A reply that fails after that point is resent on its own, unless
+# Graph may already have delivered it (see rate_limiter).
+REPLY_RESEND_ATTEMPTS = int(os.getenv("REPLY_RESEND_ATTEMPTS", 3))
+
+
+class MessageProgress:
+    def __init__(self):
+        self.committed = False
+        self.unsent_reply = None  # send_whatsapp_message arguments
+
+
+_message_progress: ContextVar[MessageProgress | None] = ContextVar("message_progress", default=None)
+
+
+async def commit_message_changes(db: Session):
+    await run_db(db.commit)
+    progress = _message_progress.get()
+    if progress is not None:
+        progress.committed = True
+
+
+def remember_unsent_reply(error: Exception, reply: dict):
+    progress = _message_progress.get()
+    may_have_been_sent = isinstance(error, httpx.RequestError) and not isinstance(error, NOT_SENT_ERRORS)
+    if progress is not None and progress.committed and not may_have_been_sent:
+        progress.unsent_reply = reply
+
+
+async def resend_reply(reply: dict, db: Session):
+    for attempt in range(1, REPLY_RESEND_ATTEMPTS + 1):
+        await asyncio.sleep(retry_delay(attempt))
+        try:
+            await send_whatsapp_message(**reply, db=db)
+            return
+        except Exception as e:
+            if attempt == REPLY_RESEND_ATTEMPTS:
+                raise
+            logger.warning("Error resending reply", extra={"attempt": attempt, "error": describe_error(e)})
 
-def get_patient_from_phone_number(phone_number: str, db: Session):
-    return db.query(Patient).filter(Patient.phone_number == phone_number).first()
 
+async def release_unprocessed_messages(messages: list, db: Session):
+    try:
+        await run_db(db.rollback)
+        for message in messages:
+            await run_db(release_message_id, message.id, db)
+    except Exception:
+        # The original error is the one re-raised; these ids stay claimed until the dedup TTL
+        logger.exception("Error releasing message ids", extra={"message_ids": [message.id for message in messages]})
 
 
-async def handle_incoming_message(patient_id: int, message_text: str, message_id: str, db: Session):
-    
-    conversation_in_questionnaire = db.query(Conversation).filter(
-        Conversation.patient_id == patient_id,
-        Conversation.status == "QuestionnaireInProgress",
-        Conversation.ended_at > datetime.now(timezone.utc)
-    ).order_by(Conversation.created_at.desc()).first()
+_message_stats = {}
 
 
-    twenty_four_hours_ago = datetime.now(timezone.utc) - timedelta(hours=24)
-    conversation_awaiting_feedback = db.query(Conversation).filter(
-        Conversation.patient_id == patient_id,
-        Conversation.status == "ReadyToComplete",
-        Conversation.questionnaire_id.isnot(None),
-        Conversation.ended_at > twenty_four_hours_ago,
-    ).order_by(Conversation.created_at.desc()).first()
+def record_message_stats(message_type: str, queries: int, seconds: float):
+    stats = _message_stats.setdefault(message_type, {"count": 0, "queries": 0, "seconds": 0.0, "max_seconds": 0.0})
+    stats["count"] += 1
+    stats["queries"] += queries
+    stats["seconds"] += seconds
+    stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
 
-    most_recent_conversation = db.query(Conversation).filter(
+def message_stats() -> dict:
+    return {
+        message_type: {
+            **stats,
+            "avg_queries": stats["queries"] / stats["count"],
+            "avg_seconds": stats["seconds"] / stats["count"],
+        }
+        for message_type, stats in _message_stats.items()
+    }
+
+
+async def process_message(patient_id: int, message: Message, business_phone_number_id: str, db: Session):
+    started = time.perf_counter()
+    with count_queries() as queries:
+        await handle_message(patient_id, message, business_phone_number_id, db)
+    record_message_stats(message.type, queries[0], time.perf_counter() - started)
+    MESSAGES.labels(message.type).inc()
+
+
+async def handle_message(patient_id: int, message: Message, business_phone_number_id: str, db: Session):
+    if message.type == 'text':
+        logger.debug("Text message", extra={"message_id": message.id, "text": message.text['body']})
+        message_text = message.text['body']
+        await handle_incoming_message(patient_id, message_text, message.id, db)
+
+    elif message.type == 'audio':
+        logger.debug("Audio message", extra={"message_id": message.id, "media_id": message.audio.id})
+        message_text = await process_audio_message(message)
+        await handle_incoming_message(patient_id, message_text, message.id, db)
+
+    elif message.type == 'button':
+        logger.debug("Button pressed", extra={"message_id": message.id, "payload": message.button['payload']})
+        message_text = "Thank you for pressing a button"
+        if message.button['payload'] == 'Begin':
+            message_text = "Let's start the questionnaire"
+            await handle_begin_button(patient_id, db)
+
+    await mark_message_as_read(business_phone_number_id, message.id)
+
+
+@app.on_event("startup")
+async def start_background_workers():
+    if run_migrations():
+        invalidate_table_info()
+    db = SessionLocal()
+    try:
+        await run_db(warm_patient_cache, db)
+    finally:
+        db.close()
+    start_chat_log_writer()
+    start_webhook_workers(process_webhook_event)
+    start_conversation_sweeper()
+
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    await stop_webhook_workers()
+    await stop_conversation_sweeper()
+    await stop_chat_log_writer()
+    await close_openai_client()
+    await stop_transcription_batcher()
+    await close_transcription_backend()
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(content=render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.get("/stats")
+def get_stats(db: Session = Depends(get_db)):
+    return {
+        "db_pool": db_pool_stats(),
+        "webhook_queue": webhook_queue_stats(db),
+        "dedup": dedup_stats(),
+        "patient_cache": patient_cache_stats(),
+        "route_cache": route_cache_stats(),
+        "messages": message_stats(),
+        "graph_rate_limits": graph_rate_limit_stats(),
+        "chat_log_writer": chat_log_writer_stats(),
+        "interpretations": interpretation_stats(),
+        "message_parser": message_parser_stats(),
+        "audio": audio_pipeline_stats(),
+        "conversation_sweeper": conversation_sweeper_stats(),
+        "logging": logging_stats(),
+    }
+
+
+def get_conversation_state(patient_id: int, db: Session):
+    # One query picks the conversation that should handle an inbound message, in priority order:
+    # an in-progress questionnaire, then one awaiting feedback, then the most recent conversation.
+    # The conversation's questionnaire comes back in the same row. Expired conversations are moved
+    # out of these statuses by the conversation sweeper, so the status alone decides.
+    state = case(
+        (Conversation.status == "QuestionnaireInProgress", "in_questionnaire"),
+        (and_(
+            Conversation.status == "ReadyToComplete",
+            Conversation.questionnaire_id.isnot(None)
+        ), "awaiting_feedback"),
+        else_="most_recent"
+    ).label("state")
+    priority = case(
+        (state == "in_questionnaire", 0),
+        (state == "awaiting_feedback", 1),
+        else_=2
+    )
+    row = db.query(Conversation, Questionnaire, state).outerjoin(
+        Questionnaire, Questionnaire.id == Conversation.questionnaire_id
+    ).filter(
         Conversation.patient_id == patient_id
-    ).order_by(Conversation.created_at.desc()).first()
+    ).order_by(priority, Conversation.created_at.desc()).first()
+    # The reply is parsed next, possibly by the LLM
+    end_read_transaction(db)
+
+    if row is None:
+        return None, None, None
+    return row.state, row.Conversation, row.Questionnaire
+
 
+async def handle_incoming_message(patient_id: int, message_text: str, message_id: str, db: Session):
+    with STAGE_SECONDS.labels("conversation_resolution").time():
+        state, conversation, questionnaire = await run_db(get_conversation_state, patient_id, db)
 
-    if conversation_in_questionnaire:
-        log_chat_message(conversation_in_questionnaire.id, patient_id, message_text, "user", db)
-        questionnaire = db.query(Questionnaire).filter(Questionnaire.patient_id == patient_id).order_by(Questionnaire.created_at.desc()).first()
+    if state == "in_questionnaire":
+        log_chat_message(conversation.id, patient_id, message_text, "user", db)
         parsed_response = await parse_message_text(message_text)
         if parsed_response is None:
-            await ask_for_clarication(patient_id, conversation_in_questionnaire.id, questionnaire, message_id, db)
+            await ask_for_clarication(patient_id, conversation.id, questionnaire, message_id, db)
             return
         skipped = parsed_response == "skip"
         if parsed_response == "end":
-            await cancel_questionnaire(conversation_in_questionnaire, questionnaire, message_id, db)
+            await cancel_questionnaire(conversation, questionnaire, message_id, db)
         else:
             if not skipped:
-                validation_response = range_check_response(parsed_response, questionnaire)
+                validation_response = range_check_response(parsed_response, await load_current_question(questionnaire))
                 if validation_response != "Valid":
-                    await send_whatsapp_message(patient_id, conversation_in_questionnaire.id, validation_response, db)
+                    await send_whatsapp_message(patient_id, conversation.id, validation_response, db)
                     return
-            await answer_question(parsed_response, conversation_in_questionnaire, questionnaire, message_id, db, skipped)
+            await answer_question(parsed_response, conversation, questionnaire, message_id, db, skipped)
 
-    elif conversation_awaiting_feedback:
+    elif state == "awaiting_feedback":
         # Save the message as a comment
-        log_chat_message(conversation_awaiting_feedback.id, patient_id, message_text, "user", db)
-        questionnaire = db.query(Questionnaire).filter(Questionnaire.id == conversation_awaiting_feedback.questionnaire_id).first()
-        questions = copy.deepcopy(questionnaire.questions)
-        if "comments" not in questions:
-            questions["comments"] = []
-        questions["comments"].append(message_text)
-        questionnaire.questions = questions
-        db.commit()
-        await send_whatsapp_message(patient_id, conversation_awaiting_feedback.id, "Thank you for sharing, your message has been saved for your clinician to review.",db, message_id)
-
-
-    elif most_recent_conversation:
-        log_chat_message(most_recent_conversation.id, patient_id, message_text, "user", db)
-        await send_whatsapp_message(patient_id, most_recent_conversation.id, "Thank you for sharing! We currently don't process any messages unless they're part of a questionnaire. \n\nHang tight, your clinician will send another one soon.", db)
-        db.commit()
+        log_chat_message(conversation.id, patient_id, message_text, "user", db)
+        await run_db(append_questionnaire_comment, questionnaire, message_text, db)
+        await commit_message_changes(db)
+        await send_whatsapp_message(patient_id, conversation.id, "Thank you for sharing, your message has been saved for your clinician to review.",db, message_id)
+
+
+    elif state == "most_recent":
+        log_chat_message(conversation.id, patient_id, message_text, "user", db)
+        await send_whatsapp_message(patient_id, conversation.id, "Thank you for sharing! We currently don't process any messages unless they're part of a questionnaire. \n\nHang tight, your clinician will send another one soon.", db)
+        await run_db(db.commit)
 
     else:
     #LATER NEED TO HANDLE THE CASE WHERE THERE IS NO IN PROGRESS QUESTIONNAIRE
-        print("No conversation found")
-        await send_whatsapp_message(patient_id, "We have no record of you as a patient. Please contact your mental health care provider to get started.", db)
+        logger.info("No conversation found for inbound message")
+        await send_whatsapp_message(patient_id, None, "We have no record of you as a patient. Please contact your mental health care provider to get started.", db)
 
 
-async def handle_begin_button(patient_id: int, db: Session):
-
-    # Get the most recent conversation with status "Initiated"
-    conversation = db.query(Conversation).filter(
+def get_initiated_conversation(patient_id: int, db: Session):
+    # Get the most recent conversation with status "Initiated", together with its questionnaire
+    row = db.query(Conversation, Questionnaire).outerjoin(
+        Questionnaire, Questionnaire.id == Conversation.questionnaire_id
+    ).filter(
         Conversation.patient_id == patient_id,
         Conversation.status == "Initiated"
     ).order_by(Conversation.created_at.desc()).first()
+    if row is None:
+        return None, None
+    return row.Conversation, row.Questionnaire
 
-    log_chat_message(conversation.id, patient_id, "Begin", "user", db)
 
-    questionnaire = db.query(Questionnaire).filter(Questionnaire.id == conversation.questionnaire_id).first()
+async def handle_begin_button(patient_id: int, db: Session):
+
+    with STAGE_SECONDS.labels("conversation_resolution").time():
+        conversation, questionnaire = await run_db(get_initiated_conversation, patient_id, db)
 
+    log_chat_message(conversation.id, patient_id, "Begin", "user", db)
 
     if questionnaire:
         # Update the conversation status to "QuestionnaireInProgress"
         conversation.status = "QuestionnaireInProgress"
+        await commit_message_changes(db)
         await ask_question(questionnaire, conversation.id, patient_id, db)
-        db.commit()
-        print("Questionnaire inprogress")
+        logger.debug("Questionnaire in progress", extra={"conversation_id": conversation.id})
     else:
-        print("No initiated conversation found for 'Begin' button")
+        logger.warning("No initiated conversation found for 'Begin' button")
 
 
 async def ask_for_clarication(patient_id: int, conversation_id: int, questionnaire: Questionnaire, message_id: str, db: Session):
-    question = questionnaire_get_current_question(questionnaire)
-    answer_scheme = question["response_format"]
-    explanation = questionnaire.questions["answer_schemes"][answer_scheme]["explanation"]
-    help_text = f"I didn't understand that. {explanation}\nYou can respond with 'skip' to skip the question or 'end' if you'd like to end the questionnaire early."
+    question = await load_current_question(questionnaire)
+    help_text = f"I didn't understand that. {question.explanation}\nYou can respond with 'skip' to skip the question or 'end' if you'd like to end the questionnaire early."
     await send_whatsapp_message(patient_id, conversation_id, help_text, db, message_id)
 
 
-def range_check_response(answer: str, questionnaire: Questionnaire):
-    print(f"Range checking response: {answer}")
-    current_index = int(questionnaire.current_status)
-    print(f"Current index: {current_index}")
-    questions = questionnaire.questions["questions_list"]
+def range_check_response(answer: str, question: CompiledQuestion):
+    logger.debug("Range checking response", extra={"answer": answer})
     answer = int(answer)
-    print(f"Answer: {answer}")
-    for question in questions:
-        if question["index"] == current_index:
-            response_format = question["response_format"]
-            break
-    answer_scheme = questionnaire.questions["answer_schemes"][response_format]
-    if "range" in answer_scheme:
-        print(f"Range is in Answer scheme: {answer_scheme}")
-        start = answer_scheme["range"]["start"]
-        end = answer_scheme["range"]["end"]
-        print(f"Start: {start}, End: {end}")
-        if start <= answer <= end:
+    if question.range_start is not None:
+        logger.debug("Question range", extra={"range_start": question.range_start, "range_end": question.range_end})
+        if question.range_start <= answer <= question.range_end:
             return "Valid"
         else:
-            return f"{answer_scheme['explanation']}\n You can respond with 'skip' to skip the question or 'end' if you'd like to end the questionnaire early."
+            return f"{question.explanation}\n You can respond with 'skip' to skip the question or 'end' if you'd like to end the questionnaire early."
     return "Valid"
 
 async def ask_question(questionnaire: Questionnaire, conversation_id: int, patient_id: int, db: Session):
+    compiled = await load_compiled_questionnaire(questionnaire)
     current_question_index = int(questionnaire.current_status)
-    print(f"Asking question: {current_question_index}")
-    questions = questionnaire.questions["questions_list"]
-    question_text = ""
-    for question in questions:
-        print(f"Question: {question}")
-        index = question["index"]
-        if index == current_question_index:
-            question_text = question["text"]
-            answer_scheme = question["response_format"]
-            print(f"Answer scheme: {answer_scheme}")
-            break
+    logger.debug("Asking question", extra={"question_index": current_question_index})
+    question = compiled.question(current_question_index)
     if current_question_index == 0:
-        explanation = f"\n\n{questionnaire.questions['answer_schemes'][answer_scheme]['explanation']}"
+        explanation = f"\n\n{question.explanation}"
     else:
-        explanation = ""    
-    print(f"Explanation: {explanation}")
-    question_text = f"*Question {current_question_index + 1} out of {len(questions)}* \n\n{question_text}{explanation}"
-    print(f"Question text: {question_text}")
+        explanation = ""
+    question_text = f"*Question {current_question_index + 1} out of {len(compiled)}* \n\n{question.text}{explanation}"
     await send_whatsapp_message(patient_id, conversation_id, question_text, db)
 
 
@@ -240,23 +451,17 @@ async def ask_question(questionnaire: Questionnaire, conversation_id: int, patie
 async def answer_question(answer: str, conversation: Conversation, questionnaire: Questionnaire, message_id: str, db: Session, skipped = False):
     emoji = "⏭️" if skipped else "👍"
     await react_to_message(questionnaire.patient_id, message_id, emoji, db)
+    compiled = await load_compiled_questionnaire(questionnaire)
     current_index = int(questionnaire.current_status)
-    
-    questions = copy.deepcopy(questionnaire.questions)
-    for question in questions["questions_list"]:
-        if question["index"] == current_index:
-            question["answer"] = str(answer)
-            break
-    
-    questionnaire.questions = questions
-    
-    db.commit()
-    
-    if current_index == len(questions["questions_list"]) - 1:
+
+    # The answer and the move to the next question are committed together
+    await run_db(set_questionnaire_answer, questionnaire, compiled.question(current_index).position, str(answer), db)
+
+    if current_index == len(compiled) - 1:
         await finish_questionnaire(conversation, questionnaire, db)
     else:
         questionnaire.current_status = str(current_index + 1)
-        db.commit()
+        await commit_message_changes(db)
         await ask_question(questionnaire, conversation.id, questionnaire.patient_id, db)
 
 
@@ -264,7 +469,7 @@ async def finish_questionnaire(conversation: Conversation, questionnaire: Questi
     conversation.status = "ReadyToComplete"
     conversation.ended_at = datetime.now(timezone.utc)
     questionnaire.current_status = "Completed"
-    db.commit()
+    await commit_message_changes(db)
     await send_whatsapp_message(questionnaire.patient_id,
                            conversation.id,
                            "*Thank you for completing the questionnaire!*🎉  \n\nWe'll send your clinician a summary of your responses. If you have anything else you want to say about how you're in the meantime, you can respond here. \n\n Take care!",
@@ -274,190 +479,147 @@ async def cancel_questionnaire(conversation: Conversation, questionnaire: Questi
     conversation.status = "ReadyToComplete"
     conversation.ended_at = datetime.now(timezone.utc)
     questionnaire.current_status = "Cancelled"
-    db.commit()
+    await commit_message_changes(db)
     await send_whatsapp_message(questionnaire.patient_id,
                            conversation.id,
                            "Got you, we'll stop here.\n\nWe'll send your clinician a summary of your responses so far. If you have any feedback in the meantime, you can send a message or a voice note here. \n\n Take care!",
                            db,
                            message_id)
 
-async def get_patient_relations(patient_id:int, db: Session):
-    try:
-        patient = db.query(Patient).filter(Patient.id == patient_id).first()
-        if not patient:
-            print("Error in get_patient_relations: Patient not found")
-            raise Exception("Error in get_patient_relations: Patient not found")
-        print('found patient')
-        if patient.assigned_to is None:
-            print("Error in get_patient_relations: Patient not assigned to any user")
-            raise Exception("Error in get_patient_relations: Patient not assigned to any user")
-        user = db.query(User).filter(User.id == patient.assigned_to).first()
-        if not user:
-            print("Error in get_patient_relations: User not found")
-            raise Exception("Error in get_patient_relations: User not found")
-        print('found user')
-        team = db.query(Team).filter(Team.id == user.team_id).first()
-        if not team:
-            print("Error in get_patient_relations: Team not found")
-            raise Exception("Error in get_patient_relations: Team not found")
-        print('found team')
-        return patient, user, team
-    except Exception as e:
-        print(f"Error in get_patient_relations: {str(e)}")
-        raise
-
 async def send_whatsapp_message(patient_id: int, conversation_id: int, message_text: str, db: Session, context_message_id = None, logging = True):
+    reply = {
+        "patient_id": patient_id,
+        "conversation_id": conversation_id,
+        "message_text": message_text,
+        "context_message_id": context_message_id,
+        "logging": logging,
+    }
     try:
-        print(f"Sending message: {message_text}")
-        patient, user, team = await get_patient_relations(patient_id, db)
-        recipient_number = patient.phone_number
-        business_phone_number_id = team.whatsapp_number_id
-
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"https://graph.facebook.com/v18.0/{business_phone_number_id}/messages",
-                headers={"Authorization": f"Bearer {WHATSAPP_GRAPH_API_TOKEN}"},
-                json={
-                    "messaging_product": "whatsapp",
-                    "to": recipient_number,
-                    "text": {"body": message_text},
-                    **({"context": {"message_id": context_message_id}} if context_message_id else {})
-                    }
-            )
-            response.raise_for_status()
-            if logging:
-                log_chat_message(conversation_id, patient_id, message_text, "system", db)
+        logger.debug("Sending message", extra={"conversation_id": conversation_id, "text": message_text})
+        recipient_number, business_phone_number_id = await run_db(get_patient_route, patient_id, db)
+
+        await post_graph_message(
+            business_phone_number_id,
+            {
+                "messaging_product": "whatsapp",
+                "to": recipient_number,
+                "text": {"body": message_text},
+                **({"context": {"message_id": context_message_id}} if context_message_id else {})
+                }
+        )
+        if logging:
+            log_chat_message(conversation_id, patient_id, message_text, "system", db)
     except httpx.HTTPStatusError as e:
-        print(f"Error sending WhatsApp message: {e.response.status_code}")
+        logger.error("Error sending WhatsApp message", extra={"status_code": e.response.status_code})
+        remember_unsent_reply(e, reply)
         raise
     except httpx.RequestError as e:
-        print(f"An error occurred while sending the WhatsApp message: {str(e)}")
+        logger.error("An error occurred while sending the WhatsApp message", extra={"error": describe_error(e)})
+        remember_unsent_reply(e, reply)
         raise
 
 
 
 async def send_whatsapp_begin_questionnaire_template(patient_id, conversation_id, duration,db: Session):
-    patient, user, team = await get_patient_relations(patient_id, db)
+    recipient_number, business_phone_number_id = await run_db(get_patient_route, patient_id, db)
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"https://graph.facebook.com/v18.0/{team.whatsapp_number_id}/messages",
-                headers={"Authorization": f"Bearer {WHATSAPP_GRAPH_API_TOKEN}"},
-                json={
-                    "messaging_product": "whatsapp",
-                    "to": patient.phone_number,
-                    "type": "template",
-                    "template": {
-                        "name": "begin_questionnaire",
-                        "language": {
-                            "code": "en"
+        await post_graph_message(
+            business_phone_number_id,
+            {
+                "messaging_product": "whatsapp",
+                "to": recipient_number,
+                "type": "template",
+                "template": {
+                    "name": "begin_questionnaire",
+                    "language": {
+                        "code": "en"
+                    },
+                    "components": [
+                        {
+                            "type": "body",
+                            "parameters": [
+                                {
+                                    "type": "text",
+                                    "text": duration
+                                }
+                            ]
                         },
-                        "components": [
-                            {
-                                "type": "body",
-                                "parameters": [
-                                    {
-                                        "type": "text",
-                                        "text": duration
-                                    }
-                                ]
-                            },
-                            {
-                                 "type": "BUTTON",
-                                 "sub_type": "QUICK_REPLY",
-                                 "index": "0",
-                                 "parameters": [
-                                     {
-                                         "type": "text",
-                                         "text": "Begin",
-                                         "payload": "Begin"
-                                     }
-                                 ]
-                             }
-                        ]
-                    }
+                        {
+                             "type": "BUTTON",
+                             "sub_type": "QUICK_REPLY",
+                             "index": "0",
+                             "parameters": [
+                                 {
+                                     "type": "text",
+                                     "text": "Begin",
+                                     "payload": "Begin"
+                                 }
+                             ]
+                         }
+                    ]
                 }
-            )
-            response.raise_for_status()
-            log_chat_message(conversation_id, patient_id, "Template: begin_questionnaire", "system", db)
+            }
+        )
+        log_chat_message(conversation_id, patient_id, "Template: begin_questionnaire", "system", db)
     except httpx.HTTPStatusError as e:
-        print(f"Error sending WhatsApp template message: {e.response.status_code}")
+        logger.error("Error sending WhatsApp template message", extra={"status_code": e.response.status_code})
         raise
     except httpx.RequestError as e:
-        print(f"An error occurred while sending the WhatsApp template message: {str(e)}")
+        logger.error("An error occurred while sending the WhatsApp template message", extra={"error": describe_error(e)})
         raise
 
 async def mark_message_as_read(business_phone_number_id: str, message_id):
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"https://graph.facebook.com/v18.0/{business_phone_number_id}/messages",
-                headers={"Authorization": f"Bearer {WHATSAPP_GRAPH_API_TOKEN}"},
-                json={
-                    "messaging_product": "whatsapp",
-                    "status": "read",
-                    "message_id": message_id,
-                }
-            )
-            response.raise_for_status()
+        await post_graph_message(
+            business_phone_number_id,
+            {
+                "messaging_product": "whatsapp",
+                "status": "read",
+                "message_id": message_id,
+            }
+        )
     except httpx.HTTPStatusError as e:
-        print(f"Error marking message as read: {e.response.status_code}")
-        raise
+        # Not fatal: the message has been handled, a failed read receipt must not get it retried
+        logger.error("Error marking message as read", extra={"status_code": e.response.status_code})
     except httpx.RequestError as e:
-        print(f"An error occurred while marking the message as read: {str(e)}")
-        raise
+        logger.error("An error occurred while marking the message as read", extra={"error": describe_error(e)})
 
 
 async def react_to_message(patient_id: int, message_id: str, emoji: str, db: Session):
-    patient, user, team = await get_patient_relations(patient_id, db)
-    business_phone_number_id = team.whatsapp_number_id
+    recipient_number, business_phone_number_id = await run_db(get_patient_route, patient_id, db)
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"https://graph.facebook.com/v20.0/{business_phone_number_id}/messages",
-                headers={"Authorization": f"Bearer {WHATSAPP_GRAPH_API_TOKEN}"},
-                json={
-                    "messaging_product": "whatsapp",
-                    "recipient_type": "individual",
-                    "to": patient.phone_number,
-                    "type": "reaction",
-                    "reaction": {
-                        "message_id": message_id,
-                        "emoji": emoji
-                    }
+        response = await post_graph_message(
+            business_phone_number_id,
+            {
+                "messaging_product": "whatsapp",
+                "recipient_type": "individual",
+                "to": recipient_number,
+                "type": "reaction",
+                "reaction": {
+                    "message_id": message_id,
+                    "emoji": emoji
                 }
-            )
-            response.raise_for_status()
-            return response.json()
+            }
+        )
+        return response.json()
     except httpx.HTTPStatusError as e:
-        print(f"Error reacting to message: {e.response.status_code}")
+        logger.error("Error reacting to message", extra={"status_code": e.response.status_code})
         raise
     except httpx.RequestError as e:
-        print(f"An error occurred while reacting to the message: {str(e)}")
+        logger.error("An error occurred while reacting to the message", extra={"error": describe_error(e)})
         raise
 
 async def process_audio_message(message: Message):
-    print(f"Received audio message: {message.audio.id}")
     try:
-
-        async with httpx.AsyncClient() as client:
-            # Get the audio file
-            response = await client.get(
-                f"https://graph.facebook.com/v20.0/{message.audio.id}/",
-                headers={"Authorization": f"Bearer {WHATSAPP_GRAPH_API_TOKEN}"},
-            )
-            audio_data = response.json()
-            audio_binary_data = await client.get(
-                audio_data['url'],
-                headers={"Authorization": f"Bearer {WHATSAPP_GRAPH_API_TOKEN}"},)
-            text = await transcribe_audio(audio_binary_data.content)
-            print(f"Transcription: {text}")
-            return text            
+        with STAGE_SECONDS.labels("transcription").time():
+            text = await transcribe_media(message.audio.id)
+        logger.debug("Transcribed audio message", extra={"media_id": message.audio.id, "transcription": text})
+        return text
 
     except Exception as e:
-        print("Error querying the API:", str(e))
+        logger.error("Error transcribing audio message", extra={"media_id": message.audio.id, "error": describe_error(e)})
         return None
     
 
@@ -468,53 +630,33 @@ async def parse_message_text(message_text: str) -> str | None:
         return message_text
 
     try:
-        if message_text == "0":
-            return "0"
+        # Clear replies ("7/10", "I'd say six", "let's move on") are resolved without the LLM
+        with STAGE_SECONDS.labels("parse_local").time():
+            local = parse_locally(message_text)
+        record_parse(local.confident)
+        MESSAGE_PARSES.labels("local", "resolved" if local.confident else "escalated").inc()
+        if local.confident:
+            if local.value == 0:
+                return "0"
+            return local.value
 
-        if message_text.isdigit():
-            return int(message_text)
-        
-        text_to_num = {
-            "zero": 0, "one": 1, "two": 2, "three": 3,
-            "four": 4, "five": 5, "six": 6, "seven": 7,
-            "eight": 8, "nine": 9, "ten": 10,
-            "0️⃣": 0, "1️⃣": 1, "2️⃣": 2, "3️⃣": 3,
-            "4️⃣": 4, "5️⃣": 5, "6️⃣": 6, "7️⃣": 7,
-            "8️⃣": 8, "9️⃣": 9, "🔟": 10,
-            "zerro": 0, "wun": 1, "too": 2, "tre": 3, "thre": 3, "fore": 4,
-            "fiv": 5, "sixe": 6, "sevn": 7, "eigt": 8, "nien": 9
-        }
-        result = text_to_num.get(message_text)
-        if result is not None:
-            return result
-        
         # If we reach here, use OpenAI to interpret the message
-        chat_gpt = init_openai()
-        response = chat_gpt.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are an assistant that interprets user messages. If the user intends to say a number (0-10), 'skip', or 'end', respond with just that word or number. For typos or wordy messages, interpret the likely intent. If the user doesn't intend any of these, respond with 'None'. Examples: 'I want to stop' -> end, 'Let's move on' -> skip, 'I feel about a seven today' -> 7, 'I had toast for breakfast' -> None. Response with only the desired string without any other text or any quotation marks."},
-                {"role": "user", "content": message_text}
-            ]
-        )
-        interpreted_text = response.choices[0].message.content.strip().lower()
-        print(interpreted_text)
+        with STAGE_SECONDS.labels("parse_llm").time():
+            interpreted_text = await interpret_message(message_text)
+        MESSAGE_PARSES.labels("llm", "unclear" if interpreted_text in (None, "none") else "resolved").inc()
+        logger.debug("Interpreted message", extra={"interpretation": interpreted_text})
         if interpreted_text is None or interpreted_text == 'none':
             return None
-        if interpreted_text == 0 or "0":
-            print("interpreted_text is 0")
+        if interpreted_text == "0":
             return "0"
         if interpreted_text.isdigit():
-            print("interpreted_text is a digit")
             return int(interpreted_text)
         elif interpreted_text in ["skip", "end"]:
-            print("interpreted_text is skip or end")
             return interpreted_text
         else:
-            print("interpreted_text is None")
             return None
     except ValueError:
-        print("ValueError")
+        logger.debug("Could not interpret message", exc_info=True)
         return None
     
 
@@ -528,79 +670,268 @@ async def root():
     return {"message": "Nothing to see here. Checkout README.md to start."}
 
 
-@app.post("/init_questionnaire")
-async def init_questionnaire(request: InitQuestionnaireRequest, db: Session = Depends(get_db)):
+def prepare_init_questionnaire(request: InitQuestionnaireRequest, db: Session):
+    # Returns (conversation, template), or (None, None) if the patient already has a questionnaire in progress
+    # Make sure that there isn't already an inprogress conversation for this patient
+    conversation = db.query(Conversation).filter(
+        Conversation.patient_id == request.patient_id,
+        Conversation.status == "QuestionnaireInProgress"
+    ).first()
+
+    if conversation:
+        return None, None
 
-    try:
-        # Make sure that there isn't already an inprogress conversation for this patient
-        conversation = db.query(Conversation).filter(
-            Conversation.patient_id == request.patient_id,
-            Conversation.status == "QuestionnaireInProgress",
-            Conversation.ended_at > datetime.now(timezone.utc)
-        ).first()
-
-        if conversation:
-            return {"status": "error", "message": "There is already an inprogress conversation for this patient"}
 
+    template = db.query(Template).filter(Template.id == request.template_id).first()
 
-        template = db.query(Template).filter(Template.id == request.template_id).first()
+    # Check if a questionnaire with the same patient, template, and status (0) already exists
+    questionnaire = db.query(Questionnaire).filter(
+        Questionnaire.patient_id == request.patient_id,
+        Questionnaire.template_id == request.template_id,
+        Questionnaire.current_status == "0"
+    ).first()
+
+    # Check if a conversation with the same patient and status ("Initiated") already exists
+    conversation = db.query(Conversation).filter(
+        Conversation.patient_id == request.patient_id,
+        Conversation.status == "Initiated"
+    ).first()
 
-        # Check if a questionnaire with the same patient, template, and status (0) already exists
-        questionnaire = db.query(Questionnaire).filter(
-            Questionnaire.patient_id == request.patient_id,
-            Questionnaire.template_id == request.template_id,
-            Questionnaire.current_status == "0"
-        ).first()
+    already_initiated = conversation and questionnaire
+    if not already_initiated:
 
-        # Check if a conversation with the same patient and status ("Initiated") already exists
-        conversation = db.query(Conversation).filter(
-            Conversation.patient_id == request.patient_id,
-            Conversation.status == "Initiated"
-        ).first()
+        questionnaire = create_new_questionnaire(request.patient_id, request.template_id, request.user_id, "0", db)
 
-        already_initiated = conversation and questionnaire
-        if not already_initiated:
+        conversation = create_new_conversation(request.patient_id, "Initiated", questionnaire.id, db)
 
-            questionnaire = create_new_questionnaire(request.patient_id, request.template_id, request.user_id, "0", db)
+    return conversation, template
 
-            conversation = create_new_conversation(request.patient_id, "Initiated", questionnaire.id, db)
+
+@app.post("/init_questionnaire")
+async def init_questionnaire(request: InitQuestionnaireRequest, db: Session = Depends(get_db)):
+    bind_patient_id(request.patient_id)
+    try:
+        conversation, template = await run_db(prepare_init_questionnaire, request, db)
+        if conversation is None:
+            return {"status": "error", "message": "There is already an inprogress conversation for this patient"}
 
         await send_whatsapp_begin_questionnaire_template(request.patient_id, conversation.id, template.duration, db)
 
         return {"status": "success", "data":"conversation and questionnaire created"}
     except Exception as e:
+        logger.error("Error initiating questionnaire", extra={"error": describe_error(e)})
         return {"status": "error", "message": str(e)}
 
 
 
 
-def questionnaire_get_current_question(questionnaire: Questionnaire):
-    current_index = int(questionnaire.current_status)
-    questions = questionnaire.questions["questions_list"]
-    
-    for question in questions:
-        if question["index"] == current_index:
-            return question
-    
-    return None  # Return None if no matching question is found
-    
+BULK_DISPATCH_CONCURRENCY = int(os.getenv("BULK_DISPATCH_CONCURRENCY", 10))
+BULK_DISPATCH_JOBS_KEPT = int(os.getenv("BULK_DISPATCH_JOBS_KEPT", 100))
+
+_bulk_dispatch_jobs = LRUCache(maxsize=BULK_DISPATCH_JOBS_KEPT)
+_bulk_dispatch_tasks = set()
+
 
+def prepare_bulk_dispatch(request: BulkInitQuestionnaireRequest, db: Session):
+    # Returns (per-patient results, patient_id -> conversation_id to send to, template duration)
+    template = db.query(Template).filter(Template.id == request.template_id).first()
+    if not template:
+        raise HTTPException(status_code=404, detail="Template not found")
+
+    patient_query = db.query(Patient.id, Patient.assigned_to)
+    if request.patient_ids is not None:
+        patient_query = patient_query.filter(Patient.id.in_(request.patient_ids))
+    elif request.team_id is not None or request.assigned_to is not None:
+        if request.team_id is not None:
+            patient_query = patient_query.filter(Patient.assigned_to.in_(select(User.id).where(User.team_id == request.team_id)))
+        if request.assigned_to is not None:
+            patient_query = patient_query.filter(Patient.assigned_to == request.assigned_to)
+    else:
+        raise HTTPException(status_code=400, detail="Provide patient_ids or a team_id/assigned_to filter")
+    patients = patient_query.all()
+    patient_ids = [patient.id for patient in patients]
+
+    results = {patient_id: {"patient_id": patient_id, "status": "pending"} for patient_id in patient_ids}
+    if request.patient_ids is not None:
+        for patient_id in set(request.patient_ids) - set(patient_ids):
+            results[patient_id] = {"patient_id": patient_id, "status": "failed", "detail": "Patient not found"}
+
+    # Patients that already have a questionnaire in progress are skipped
+    in_progress = {row.patient_id for row in db.query(Conversation.patient_id).filter(
+        Conversation.patient_id.in_(patient_ids),
+        Conversation.status == "QuestionnaireInProgress"
+    ).distinct()}
+    for patient_id in in_progress:
+        results[patient_id].update(status="skipped", detail="There is already an inprogress conversation for this patient")
+
+    # Patients already initiated with this template just get the template resent
+    conversation_ids = {}
+    for row in db.query(Conversation.patient_id, Conversation.id).join(
+        Questionnaire, Questionnaire.id == Conversation.questionnaire_id
+    ).filter(
+        Conversation.patient_id.in_(patient_ids),
+        Conversation.status == "Initiated",
+        Questionnaire.template_id == request.template_id,
+        Questionnaire.current_status == "0"
+    ).order_by(Conversation.created_at):
+        if row.patient_id not in in_progress:
+            conversation_ids[row.patient_id] = row.id
+
+    now = datetime.now(timezone.utc)
+    new_patients = [patient for patient in patients if patient.id not in in_progress and patient.id not in conversation_ids]
+    questionnaire_ids = create_questionnaires_bulk([
+        {
+            "patient_id": patient.id,
+            "template_id": request.template_id,
+            "user_id": request.user_id if request.user_id is not None else patient.assigned_to,
+            "questions": template.questions,
+            "current_status": "0",
+            "created_at": now,
+        }
+        for patient in new_patients
+    ], db)
+    conversation_ids.update(create_conversations_bulk([
+        {
+            "patient_id": patient.id,
+            "created_at": now,
+            "ended_at": now + timedelta(days=3),
+            "status": "Initiated",
+            "questionnaire_id": questionnaire_ids[patient.id],
+        }
+        for patient in new_patients
+    ], db))
+    db.commit()
+    return results, conversation_ids, template.duration
+
+
+@app.post("/init_questionnaire/bulk")
+async def init_questionnaire_bulk(request: BulkInitQuestionnaireRequest, db: Session = Depends(get_db)):
+    results, conversation_ids, duration = await run_db(prepare_bulk_dispatch, request, db)
+    now = datetime.now(timezone.utc)
+    job_id = str(uuid.uuid4())
+    job = {
+        "job_id": job_id,
+        "template_id": request.template_id,
+        "status": "running",
+        "created_at": now.isoformat(),
+        "total": len(results),
+        "results": results,
+    }
+    _bulk_dispatch_jobs[job_id] = job
+    task = asyncio.create_task(run_bulk_dispatch(job, conversation_ids, duration))
+    _bulk_dispatch_tasks.add(task)
+    task.add_done_callback(_bulk_dispatch_tasks.discard)
+    return {"status": "success", "data": bulk_dispatch_summary(job)}
+
+
+async def run_bulk_dispatch(job: dict, conversation_ids: dict, duration: str):
+    semaphore = asyncio.Semaphore(BULK_DISPATCH_CONCURRENCY)
+
+    async def send(patient_id: int, conversation_id: int):
+        async with semaphore:
+            db = SessionLocal()
+            try:
+                await send_whatsapp_begin_questionnaire_template(patient_id, conversation_id, duration, db)
+                job["results"][patient_id].update(status="sent", conversation_id=conversation_id)
+            except Exception as e:
+                job["results"][patient_id].update(status="failed", conversation_id=conversation_id, detail=str(e))
+            finally:
+                await run_db(db.close)
+
+    await asyncio.gather(*[send(patient_id, conversation_id) for patient_id, conversation_id in conversation_ids.items()])
+    job["status"] = "finished"
+    logger.info("Bulk dispatch finished", extra={"job_id": job['job_id'], "counts": bulk_dispatch_summary(job)['counts']})
+
+
+def bulk_dispatch_summary(job: dict) -> dict:
+    counts = {}
+    for result in job["results"].values():
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return {key: value for key, value in job.items() if key != "results"} | {"counts": counts}
+
+
+@app.get("/init_questionnaire/bulk/{job_id}")
+async def get_bulk_dispatch_job(job_id: str):
+    job = _bulk_dispatch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"status": "success", "data": {**bulk_dispatch_summary(job), "results": list(job["results"].values())}}
 
 
 @app.get("/get_patients")
-async def get_patients(db: Session = Depends(get_db)):
-    patients = db.query(Patient).all()
-    return patients
+def get_patients(
+    cursor: int | None = None,
+    limit: int | None = Query(None, ge=1, le=5000),
+    fields: str | None = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    team_id: int | None = None,
+    assigned_to: int | None = None,
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+    db: Session = Depends(get_db)
+):
+    filters = []
+    if team_id is not None:
+        filters.append(Patient.assigned_to.in_(select(User.id).where(User.team_id == team_id)))
+    if assigned_to is not None:
+        filters.append(Patient.assigned_to == assigned_to)
+    if created_after is not None:
+        filters.append(Patient.created_at >= created_after)
+    if created_before is not None:
+        filters.append(Patient.created_at < created_before)
+    return list_rows(Patient, filters, cursor, limit, fields, format, db)
 
 
 
 @app.get("/get_questionnaires")
-async def get_questionnaires(db: Session = Depends(get_db)):
-    questionnaires = db.query(Questionnaire).all()
-    return questionnaires
+def get_questionnaires(
+    cursor: int | None = None,
+    limit: int | None = Query(None, ge=1, le=5000),
+    fields: str | None = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    team_id: int | None = None,
+    user_id: int | None = None,
+    patient_id: int | None = None,
+    status: str | None = None,
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+    db: Session = Depends(get_db)
+):
+    filters = []
+    if team_id is not None:
+        filters.append(Questionnaire.user_id.in_(select(User.id).where(User.team_id == team_id)))
+    if user_id is not None:
+        filters.append(Questionnaire.user_id == user_id)
+    if patient_id is not None:
+        filters.append(Questionnaire.patient_id == patient_id)
+    if status is not None:
+        filters.append(Questionnaire.current_status == status)
+    if created_after is not None:
+        filters.append(Questionnaire.created_at >= created_after)
+    if created_before is not None:
+        filters.append(Questionnaire.created_at < created_before)
+    return list_rows(Questionnaire, filters, cursor, limit, fields, format, db)
 
 
 @app.get("/get_templates")
-async def get_templates(db: Session = Depends(get_db)):
-    templates = db.query(Template).all()
-    return templates
\ No newline at end of file
+def get_templates(
+    cursor: int | None = None,
+    limit: int | None = Query(None, ge=1, le=5000),
+    fields: str | None = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    team_id: int | None = None,
+    owner: int | None = None,
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+    db: Session = Depends(get_db)
+):
+    filters = []
+    if team_id is not None:
+        filters.append(Template.team_id == team_id)
+    if owner is not None:
+        filters.append(Template.owner == owner)
+    if created_after is not None:
+        filters.append(Template.created_at >= created_after)
+    if created_before is not None:
+        filters.append(Template.created_at < created_before)
+    return list_rows(Template, filters, cursor, limit, fields, format, db)
@@ -0,0 +1,187 @@
+import os
+import re
+from dataclasses import dataclass
+
+
+# ++++++++++++++++++++++++++++++++++
+# ++++++++ LOCAL MESSAGE PARSER ++++
+# ++++++++++++++++++++++++++++++++++
+
+# Deterministic first pass over questionnaire replies, run before the LLM. The message is
+# tokenized, numbers are read from digits, number words (with typo tolerance), keycap emoji
+# and "7/10" style scores, and skip/end intents from keywords. The result is scored; only
+# replies below PARSER_CONFIDENCE_THRESHOLD are sent on to the LLM. Any word that is not a
+# number, an intent or filler sends the reply to the LLM, since it may change what the number
+# means ("I had 3 eggs", "I slept 4 hours").
+
+PARSER_CONFIDENCE_THRESHOLD = float(os.getenv("PARSER_CONFIDENCE_THRESHOLD", 0.7))
+
+NUMBER_WORDS = {
+    "zero": 0, "one": 1, "two": 2, "three": 3,
+    "four": 4, "five": 5, "six": 6, "seven": 7,
+    "eight": 8, "nine": 9, "ten": 10,
+    "nought": 0, "nil": 0,
+    # Common misspellings that are too short for edit-distance matching
+    "zerro": 0, "wun": 1, "too": 2, "tre": 3, "thre": 3, "fore": 4,
+    "fiv": 5, "sixe": 6, "sevn": 7, "eigt": 8, "nien": 9,
+}
+
+SKIP_WORDS = {"skip", "skp"}
+# Only a skip when they are the whole reply ("next week", "pass me the salt")
+STANDALONE_SKIP_WORDS = {"pass", "next"}
+END_WORDS = {"end", "stop", "quit", "cancel", "exit", "finish"}
+INTENT_WORDS = {**{word: "skip" for word in SKIP_WORDS}, **{word: "end" for word in END_WORDS}}
+SKIP_PHRASES = ("move on", "moving on", "next question", "next one", "rather not say", "prefer not to say")
+END_PHRASES = ("no more", "that's enough", "thats enough", "leave it there")
+
+# Words that carry no meaning of their own in a short reply ("I'd say about a 6 today")
+FILLER_WORDS = {
+    "i", "i'd", "id", "i'm", "im", "i'll", "ill", "it", "it's", "its", "is", "was", "be", "would", "will",
+    "say", "said", "about", "around", "roughly", "maybe", "probably", "like", "a", "an", "the",
+    "feel", "feeling", "felt", "think", "guess", "reckon", "today", "tonight", "now", "currently",
+    "honestly", "pretty", "much", "solid", "definitely", "just", "so", "very", "really", "um", "umm",
+    "uh", "hmm", "ok", "okay", "yeah", "yes", "yep", "please", "pls", "plz", "thanks", "thank", "you",
+    "nah", "lets", "let's", "want", "to", "go", "with", "give", "me", "my", "answer", "score", "rating",
+    "rate", "at", "this", "that", "question", "for", "on", "out", "of", "mood", "level", "day",
+    "can", "we", "could", "here", "there", "oh", "well", "hey", "hi", "and",
+}
+# "one" after these words is a pronoun ("next one"), not a score
+ONE_PRONOUN_AFTER = {"this", "that", "next", "the", "another", "last", "other"}
+NEGATIONS = {"not", "no", "never", "don't", "dont", "isn't", "isnt", "wasn't", "wasnt", "can't", "cant", "won't", "wont"}
+
+_KEYCAP = re.compile(r"([0-9])\ufe0f?\u20e3")
+# A leading minus ("-3") and ordinal suffixes ("2nd") stay on the number so the reply can be
+# left to the LLM. "6-7" is still split into two numbers.
+_TOKEN = re.compile(r"(?<!\w)-?\d+(?:\.\d+)?(?:st|nd|rd|th)?(?![a-z])|\d+(?:\.\d+)?|[a-z]+(?:'[a-z]+)?|/")
+_SIGNED_OR_ORDINAL = re.compile(r"-.+|\d+(?:st|nd|rd|th)")
+
+_stats = {
+    "local": 0,
+    "escalated": 0,
+}
+
+
+@dataclass(frozen=True)
+class ParseResult:
+    value: int | str | None  # An int, "skip", "end", or None when nothing was recognised
+    confidence: float
+
+    @property
+    def confident(self) -> bool:
+        return self.value is not None and self.confidence >= PARSER_CONFIDENCE_THRESHOLD
+
+
+def _edit_distance(a: str, b: str) -> int:
+    # Optimal string alignment distance, so a swapped pair of letters counts as one edit
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+def _fuzzy_match(token: str, vocabulary: dict):
+    # Only words of four letters or more are matched fuzzily, "and" must not become "end".
+    # Returns the vocabulary value when every close word agrees on it ("eigth" -> eight/eigt -> 8).
+    if len(token) < 4:
+        return None
+    values = {value for word, value in vocabulary.items() if len(word) >= 4 and _edit_distance(token, word) <= 1}
+    return values.pop() if len(values) == 1 else None
+
+
+def tokenize(message_text: str) -> list[str]:
+    text = message_text.lower().replace("\u2019", "'").replace("\U0001f51f", " 10 ")
+    text = _KEYCAP.sub(r" \1 ", text)
+    return _TOKEN.findall(text)
+
+
+def _collapse_scores(tokens: list) -> list:
+    # "7/10", "7 out of 10" and "7 of 10" all mean 7
+    collapsed = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if isinstance(token, int):
+            for tail in (["/", 10], ["out", "of", 10], ["of", 10]):
+                if tokens[i + 1:i + 1 + len(tail)] == tail:
+                    i += len(tail)
+                    break
+        collapsed.append(token)
+        i += 1
+    return collapsed
+
+
+def parse_locally(message_text: str) -> ParseResult:
+    text = f" {' '.join(tokenize(message_text))} "
+    if text.strip() in STANDALONE_SKIP_WORDS:
+        return ParseResult("skip", 1.0)
+    intents = set()
+    for phrases, intent in ((SKIP_PHRASES, "skip"), (END_PHRASES, "end")):
+        for phrase in phrases:
+            if f" {phrase} " in text:
+                intents.add(intent)
+                text = text.replace(f" {phrase} ", " ")
+
+    tokens = []
+    unknown = 0
+    fuzzy = False
+    negated = False
+    previous = None
+    for token in text.split():
+        if token == "one" and previous in ONE_PRONOUN_AFTER:
+            tokens.append(token)
+        elif token.isdigit():
+            tokens.append(int(token))
+        elif _SIGNED_OR_ORDINAL.fullmatch(token):
+            # Not a score on the scale ("-3", "the 2nd one"), whatever else the reply says
+            return ParseResult(None, 0.0)
+        elif token in NUMBER_WORDS:
+            tokens.append(NUMBER_WORDS[token])
+        elif token in SKIP_WORDS:
+            intents.add("skip")
+        elif token in END_WORDS:
+            intents.add("end")
+        elif token in NEGATIONS:
+            negated = True
+        elif token in FILLER_WORDS or token == "/":
+            tokens.append(token)
+        elif (number := _fuzzy_match(token, NUMBER_WORDS)) is not None:
+            tokens.append(number)
+            fuzzy = True
+        elif (intent := _fuzzy_match(token, INTENT_WORDS)) is not None:
+            intents.add(intent)
+            fuzzy = True
+        else:
+            # Anything else, including decimals like "6.5", leaves the reply to the LLM
+            unknown += 1
+        previous = token
+
+    numbers = {token for token in _collapse_scores(tokens) if isinstance(token, int)}
+    candidates = numbers | intents
+    if len(candidates) != 1:
+        # Nothing recognised, or an ambiguous reply like "6 or 7" / "skip, actually 5"
+        return ParseResult(None, 0.0)
+
+    confidence = 1.0 - (0.1 if fuzzy else 0.0)
+    if unknown or negated:
+        confidence = min(confidence, 0.2)
+    return ParseResult(candidates.pop(), max(confidence, 0.0))
+
+
+def record_parse(resolved_locally: bool):
+    _stats["local" if resolved_locally else "escalated"] += 1
+
+
+def message_parser_stats() -> dict:
+    total = _stats["local"] + _stats["escalated"]
+    return {
+        **_stats,
+        "local_rate": _stats["local"] / total if total else 0.0,
+        "threshold": PARSER_CONFIDENCE_THRESHOLD,
+    }
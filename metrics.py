@@ -0,0 +1,262 @@
+import bisect
+import threading
+import time
+from sqlalchemy import event
+from core import DB_MAX_OVERFLOW, DB_POOL_SIZE, SessionLocal, db_pool_stats, engine
+
+
+# ++++++++++++++++++++++++++++++++++
+# +++++++++++++ METRICS ++++++++++++
+# ++++++++++++++++++++++++++++++++++
+
+# Counters, gauges and latency histograms served at /metrics in the Prometheus text format.
+# Recording is an index lookup and two additions under a per-series lock (DB commits are timed
+# on the database threads), so it stays on in production. Gauges for state the app already
+# tracks (pool checkouts, in-flight webhooks) are read by a callback at scrape time rather than
+# updated on every change.
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. Local work lands in the low buckets, Graph/LLM/transcription calls in the high ones.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry: list = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        self._function = None
+        with _registry_lock:
+            _registry.append(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        # Children are created once per label combination; callers on hot paths can keep them
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def set_function(self, function):
+        # function() returns the value, or {label values tuple: value} for a labelled metric
+        self._function = function
+
+    def _function_samples(self) -> list[str]:
+        values = self._function()
+        if not self.labelnames:
+            values = {(): values}
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}" for key, value in values.items()]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        if self._function is not None:
+            return lines + self._function_samples()
+        for values, child in list(self._children.items()):
+            lines.extend(child.samples(self.name, self.labelnames, values))
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def samples(self, name: str, labelnames: tuple, values: tuple) -> list[str]:
+        return [f"{name}{_format_labels(labelnames, values)} {_format_number(self._value)}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class _GaugeChild(_CounterChild):
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+
+class _Timer:
+    __slots__ = ("_child", "_started")
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._child.observe(time.perf_counter() - self._started)
+        return False
+
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)  # Per bucket, the last one is +Inf; made cumulative when rendered
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+    def samples(self, name: str, labelnames: tuple, values: tuple) -> list[str]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + (float("inf"),), counts):
+            cumulative += count
+            le = f'le="{_format_number(float(bound))}"'
+            lines.append(f"{name}_bucket{_format_labels(labelnames, values, le)} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, values)} {_format_number(total)}")
+        lines.append(f"{name}_count{_format_labels(labelnames, values)} {cumulative}")
+        return lines
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+
+def render_metrics() -> str:
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Webhook processing stages: webhook_parse, patient_lookup, conversation_resolution,
+# parse_local, parse_llm, transcription
+STAGE_SECONDS = Histogram("moodulate_stage_seconds", "Time spent in each webhook processing stage", ("stage",))
+MESSAGES = Counter("moodulate_messages_total", "Inbound WhatsApp messages processed, by type", ("type",))
+MESSAGE_PARSES = Counter("moodulate_message_parses_total", "Free-text replies interpreted, by parser and result", ("parser", "result"))
+
+# One observation per HTTP attempt, so retries show up as extra requests
+GRAPH_REQUEST_SECONDS = Histogram("moodulate_graph_request_seconds", "Graph API request latency, by call type", ("call",))
+GRAPH_REQUESTS = Counter("moodulate_graph_requests_total", "Graph API requests, by call type and outcome", ("call", "outcome"))
+
+
+def graph_outcome(status_code: int) -> str:
+    if status_code == 429:
+        return "rate_limited"
+    if status_code >= 500:
+        return "server_error"
+    if status_code >= 400:
+        return "client_error"
+    return "ok"
+
+
+WEBHOOK_EVENTS = Counter("moodulate_webhook_events_total", "Queued webhook events, by outcome", ("outcome",))
+WEBHOOKS_IN_FLIGHT = Gauge("moodulate_webhooks_in_flight", "Webhook events being processed by the workers")
+
+
+# Every session commit, including its flush. The start time lives on the session so commits on
+# different database threads do not interfere.
+DB_COMMIT_SECONDS = Histogram("moodulate_db_commit_seconds", "Session commit latency, including the flush")
+_db_commit_seconds = DB_COMMIT_SECONDS.labels()
+
+
+@event.listens_for(SessionLocal, "before_commit")
+def _commit_started(session):
+    session.info["commit_started"] = time.perf_counter()
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _commit_finished(session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        _db_commit_seconds.observe(time.perf_counter() - started)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _commit_abandoned(session):
+    session.info.pop("commit_started", None)
+
+
+Gauge("moodulate_db_pool_capacity", "Connection pool size plus overflow").set(DB_POOL_SIZE + DB_MAX_OVERFLOW)
+Gauge("moodulate_db_pool_checked_out", "Connections currently checked out of the pool").set_function(lambda: engine.pool.checkedout())
+Counter("moodulate_db_pool_checkouts_total", "Connection pool checkouts").set_function(lambda: db_pool_stats()["checkouts"])
+Gauge("moodulate_run_db_in_flight", "Blocking database calls running or queued for a database thread").set_function(
+    lambda: db_pool_stats()["run_db_in_flight"]
+)
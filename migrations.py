@@ -0,0 +1,280 @@
+import argparse
+import logging
+import sys
+from datetime import datetime, timezone
+from sqlalchemy import insert, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+from core import engine
+from models import *
+
+
+# ++++++++++++++++++++++++++++++++++
+# ++++++++++ MIGRATIONS ++++++++++++
+# ++++++++++++++++++++++++++++++++++
+
+# Versioned schema changes, applied in order at startup (or with `python -m migrations`).
+# Applied versions are recorded in Schema_migrations. The whole run, including creating that
+# table, holds a session-level advisory lock, so several instances starting at once apply each
+# migration exactly once. Never edit a migration that has shipped; add a new one.
+#
+# A step is a SQL string, a callable taking the connection, a NonTransactional step or a Guard.
+# Consecutive SQL/callable steps and the version record run in one transaction.
+# NonTransactional steps (CREATE/DROP INDEX CONCURRENTLY, which cannot run in a transaction)
+# run on their own in autocommit mode, so index builds on live tables never block writes.
+# A Guard checks the data before anything runs: if the data would make the migration fail
+# (duplicates under a new unique index), the problem is logged and the migration left pending
+# until a later run, instead of stopping the app from starting. Later migrations still apply,
+# so nothing may depend on a guarded one.
+#
+# Tables are created with explicit DDL, not from the ORM models, so what a migration does
+# never changes when models.py does.
+
+MIGRATIONS_LOCK_KEY = 7347001  # Arbitrary, only has to be unique among this database's advisory locks
+
+logger = logging.getLogger(__name__)
+
+
+class Guard:
+    def __init__(self, check):
+        self.check = check  # Takes the connection, returns a description of the problem or None
+
+
+class NonTransactional:
+    def __init__(self, *statements: str, before=None):
+        self.statements = statements
+        self.before = before  # Optional callable taking the autocommit connection, run first
+
+    def run(self, bind: Engine):
+        with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            if self.before:
+                self.before(connection)
+            for statement in self.statements:
+                connection.execute(text(statement))
+
+
+def create_index_concurrently(name: str, definition: str, unique: bool = False) -> NonTransactional:
+    # definition is everything after ON, e.g. '"Patients" (phone_number)'
+    def drop_invalid(connection: Connection):
+        # A concurrent build that failed part way leaves an invalid index that IF NOT EXISTS would keep
+        invalid = connection.execute(
+            text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+            {"name": name}
+        ).scalar()
+        if invalid:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    unique_keyword = "UNIQUE " if unique else ""
+    return NonTransactional(f"CREATE {unique_keyword}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}", before=drop_invalid)
+
+
+def drop_index_concurrently(name: str) -> NonTransactional:
+    return NonTransactional(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def _duplicate_phone_numbers(connection: Connection) -> str | None:
+    # Patient ids only, the numbers themselves stay out of the logs
+    duplicates = connection.execute(text('''
+        SELECT array_agg(id ORDER BY id) AS patient_ids
+        FROM "Patients"
+        WHERE phone_number IS NOT NULL
+        GROUP BY phone_number
+        HAVING count(*) > 1
+        LIMIT 20
+    ''')).scalars().all()
+    if not duplicates:
+        return None
+    listed = "; ".join(", ".join(str(patient_id) for patient_id in patient_ids) for patient_ids in duplicates)
+    return f"Patients share phone numbers, merge or fix them before the unique index can be created: {listed}"
+
+
+MIGRATIONS = [
+    (1, "Queue and cache tables", [
+        # These tables were created by create_all at startup before migrations existed
+        '''CREATE TABLE IF NOT EXISTS "Webhook_events" (
+            id BIGSERIAL PRIMARY KEY,
+            created_at TIMESTAMP NOT NULL DEFAULT now(),
+            payload JSONB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            locked_at TIMESTAMP,
+            processed_at TIMESTAMP,
+            error TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS "Processed_messages" (
+            message_id TEXT PRIMARY KEY,
+            created_at TIMESTAMP NOT NULL DEFAULT now()
+        )''',
+        '''CREATE TABLE IF NOT EXISTS "Message_interpretations" (
+            normalized_text TEXT PRIMARY KEY,
+            created_at TIMESTAMP NOT NULL DEFAULT now(),
+            interpretation TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS "Transcriptions" (
+            content_hash TEXT PRIMARY KEY,
+            media_id TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT now(),
+            backend TEXT NOT NULL,
+            text TEXT NOT NULL
+        )''',
+    ]),
+    (2, "Hot-path indexes", [
+        # Conversation state, Initiated lookups (newest first) and in-progress checks (ended_at)
+        create_index_concurrently("ix_conversations_patient_status_created", '"Conversations" (patient_id, status, created_at)'),
+        create_index_concurrently("ix_conversations_patient_status_ended", '"Conversations" (patient_id, status, ended_at)'),
+        # Existing-questionnaire check in /init_questionnaire
+        create_index_concurrently("ix_questionnaires_patient_template_status", '"Questionnaires" (patient_id, template_id, current_status)'),
+        create_index_concurrently("ix_chat_logs_conversation_id", '"Chat_logs" (conversation_id)'),
+        # Route lookups join Patients -> Users -> Teams, bulk dispatch filters by assignee
+        create_index_concurrently("ix_patients_assigned_to", '"Patients" (assigned_to)'),
+        create_index_concurrently("ix_users_team_id", '"Users" (team_id)'),
+        # Workers claim the oldest pending event; done rows would otherwise be scanned past
+        create_index_concurrently("ix_webhook_events_pending", '"Webhook_events" (id) WHERE status = \'pending\''),
+        create_index_concurrently("ix_transcriptions_media_id", '"Transcriptions" (media_id)'),
+    ]),
+    (3, "Conversation sweeper indexes", [
+        # In-progress checks are status-only now, (patient_id, status, created_at) covers them
+        drop_index_concurrently("ix_conversations_patient_status_ended"),
+        # The sweeper looks for live conversations past ended_at; terminal rows stay out of the index
+        create_index_concurrently(
+            "ix_conversations_live_ended",
+            '"Conversations" (status, ended_at) WHERE status IN (\'QuestionnaireInProgress\', \'ReadyToComplete\')'
+        ),
+    ]),
+    (4, "Webhook retry backoff", [
+        'ALTER TABLE "Webhook_events" ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP',
+    ]),
+    (5, "Per-sender webhook ordering", [
+        'ALTER TABLE "Webhook_events" ADD COLUMN IF NOT EXISTS sender TEXT',
+        # Claims check for an earlier unfinished event from the same sender
+        create_index_concurrently(
+            "ix_webhook_events_live_sender",
+            '"Webhook_events" (sender, id) WHERE status IN (\'pending\', \'processing\')'
+        ),
+    ]),
+    (6, "Webhook event retention", [
+        # The recovery loop deletes finished events by age
+        create_index_concurrently(
+            "ix_webhook_events_finished_created",
+            '"Webhook_events" (status, created_at) WHERE status IN (\'done\', \'failed\')'
+        ),
+    ]),
+    (7, "Processed message retention", [
+        create_index_concurrently("ix_processed_messages_created_at", '"Processed_messages" (created_at)'),
+    ]),
+    (8, "Transcription cache retention", [
+        create_index_concurrently("ix_transcriptions_created_at", '"Transcriptions" (created_at)'),
+    ]),
+    (9, "Unique patient phone numbers", [
+        # Inbound messages are routed by phone number, one patient per number. Databases where
+        # migration 2 built this index before it moved here simply skip the build.
+        Guard(_duplicate_phone_numbers),
+        create_index_concurrently("uq_patients_phone_number", '"Patients" (phone_number)', unique=True),
+    ]),
+]
+
+
+def _applied_versions(connection: Connection) -> set[int]:
+    return set(connection.execute(select(SchemaMigration.version)).scalars())
+
+
+def _run_in_transaction(bind: Engine, steps: list):
+    if not steps:
+        return
+    with bind.begin() as connection:
+        for step in steps:
+            if callable(step):
+                step(connection)
+            else:
+                connection.execute(text(step))
+
+
+def _guard_problem(bind: Engine, steps: list) -> str | None:
+    guards = [step for step in steps if isinstance(step, Guard)]
+    if not guards:
+        return None
+    with bind.connect() as connection:
+        for guard in guards:
+            problem = guard.check(connection)
+            if problem:
+                return problem
+    return None
+
+
+def _apply_migration(bind: Engine, version: int, name: str, steps: list) -> bool:
+    # Returns False when a guard left the migration pending
+    problem = _guard_problem(bind, steps)
+    if problem:
+        logger.error("Skipping migration until its data is fixed", extra={"version": version, "migration": name, "problem": problem})
+        return False
+
+    def record(connection: Connection):
+        connection.execute(insert(SchemaMigration).values(
+            version=version,
+            name=name,
+            applied_at=datetime.now(timezone.utc)
+        ))
+
+    # Every step is idempotent, so a migration interrupted part way is simply run again
+    transactional = []
+    for step in steps:
+        if isinstance(step, Guard):
+            continue
+        if isinstance(step, NonTransactional):
+            _run_in_transaction(bind, transactional)
+            transactional = []
+            step.run(bind)
+        else:
+            transactional.append(step)
+    _run_in_transaction(bind, transactional + [record])
+    return True
+
+
+def run_migrations(bind: Engine = engine) -> list[int]:
+    # Returns the versions applied by this call
+    applied = []
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_connection:
+        lock_connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+        try:
+            with bind.begin() as connection:
+                connection.execute(text('''CREATE TABLE IF NOT EXISTS "Schema_migrations" (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT now()
+                )'''))
+                applied_versions = _applied_versions(connection)
+            for version, name, steps in MIGRATIONS:
+                if version in applied_versions:
+                    continue
+                logger.info("Applying migration", extra={"version": version, "migration": name})
+                if _apply_migration(bind, version, name, steps):
+                    applied.append(version)
+        finally:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+    return applied
+
+
+def migration_status(bind: Engine = engine) -> list[dict]:
+    with bind.connect() as connection:
+        applied = {}
+        if inspect(connection).has_table(SchemaMigration.__tablename__):
+            applied = {row.version: row.applied_at for row in connection.execute(select(SchemaMigration))}
+    return [
+        {"version": version, "name": name, "applied_at": applied.get(version)}
+        for version, name, _ in MIGRATIONS
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply or list schema migrations")
+    parser.add_argument("--status", action="store_true", help="List migrations and whether they are applied")
+    args = parser.parse_args()
+    if args.status:
+        for migration in migration_status():
+            print(f"{migration['version']:>4}  {migration['applied_at'] or 'pending':<28}  {migration['name']}")
+    else:
+        applied = run_migrations()
+        pending = [migration for migration in migration_status() if migration["applied_at"] is None]
+        print(f"Applied {len(applied)} migrations" if applied or pending else "Database is up to date")
+        for migration in pending:
+            print(f"Still pending: {migration['version']} {migration['name']}, see the log for the reason")
+        sys.exit(1 if pending else 0)
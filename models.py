@@ -114,9 +114,18 @@ class InitQuestionnaireRequest(BaseModel):
     template_id: int
     user_id: int
 
+class BulkInitQuestionnaireRequest(BaseModel):
+    template_id: int
+    user_id: Optional[int] = None  # Defaults to each patient's assigned user
+    patient_ids: Optional[List[int]] = None
+    # Used instead of patient_ids to select patients by filter
+    team_id: Optional[int] = None
+    assigned_to: Optional[int] = None
+
 
 
 #POSTGRES DB MODELS
+# Indexes and constraints beyond primary keys are owned by the versioned migrations in migrations.py
 
 from sqlalchemy.orm import declarative_base, sessionmaker, Session, relationship
 from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Text, TIMESTAMP
@@ -228,4 +237,50 @@ class Conversation(Base):
     chat_logs = relationship("ChatLogMessage", back_populates="conversation")
     patient = relationship("Patient", back_populates="conversations")
 
+# WebhookEvent model
+# Raw WhatsApp webhook payloads, persisted on receipt and drained by the background workers
+class WebhookEvent(Base):
+    __tablename__ = 'Webhook_events'
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    created_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
+    payload = Column(JSONB, nullable=False)
+    sender = Column(Text, nullable=True)  # WhatsApp number the messages are from, None for status-only events
+    status = Column(Text, nullable=False, server_default="pending")  # pending, processing, done, failed
+    attempts = Column(Integer, nullable=False, server_default="0")
+    locked_at = Column(TIMESTAMP, nullable=True)
+    next_attempt_at = Column(TIMESTAMP, nullable=True)  # Set when a failed event is waiting to be retried
+    processed_at = Column(TIMESTAMP, nullable=True)
+    error = Column(Text, nullable=True)
+
+# ProcessedMessage model
+# WhatsApp message ids that have already been handled, used to drop redelivered webhooks
+class ProcessedMessage(Base):
+    __tablename__ = 'Processed_messages'
+    message_id = Column(Text, primary_key=True)
+    created_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
 
+# MessageInterpretation model
+# Cached LLM interpretations of free-text questionnaire replies, keyed by normalized text
+class MessageInterpretation(Base):
+    __tablename__ = 'Message_interpretations'
+    normalized_text = Column(Text, primary_key=True)
+    created_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
+    interpretation = Column(Text, nullable=False)  # A number, "skip", "end" or "none"
+
+# Transcription model
+# Cached voice note transcriptions, keyed by the audio's SHA-256 and looked up by WhatsApp media id
+class Transcription(Base):
+    __tablename__ = 'Transcriptions'
+    content_hash = Column(Text, primary_key=True)
+    media_id = Column(Text, nullable=False)
+    created_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
+    backend = Column(Text, nullable=False)
+    text = Column(Text, nullable=False)
+
+# SchemaMigration model
+# Versions from migrations.MIGRATIONS that have been applied to this database
+class SchemaMigration(Base):
+    __tablename__ = 'Schema_migrations'
+    version = Column(Integer, primary_key=True)
+    name = Column(Text, nullable=False)
+    applied_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
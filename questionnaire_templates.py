@@ -0,0 +1,190 @@
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from cachetools import LRUCache
+from sqlalchemy import event, inspect
+from core import run_db
+from models import Questionnaire, Template
+
+
+# ++++++++++++++++++++++++++++++++++
+# +++++++ COMPILED QUESTIONNAIRES ++
+# ++++++++++++++++++++++++++++++++++
+
+# Template/questionnaire "questions" documents look like:
+#   {"questions_list": [{"index": 0, "text": "...", "response_format": "scale"}, ...],
+#    "answer_schemes": {"scale": {"explanation": "...", "range": {"start": 0, "end": 10}}}}
+# They are compiled once per template into an index -> question map so the conversation code
+# never scans questions_list, and malformed templates are rejected when they are created.
+#
+# ORM writes to Template.questions drop the template's compiled form. Questionnaires copied
+# from the template before such an edit keep their own questions, so they are compiled on their
+# own rather than from (or into) the cache. Async code gets compiled forms through
+# load_compiled_questionnaire, so a cache miss reads the questions document, which may be
+# expired after a partial update, on a database thread.
+
+COMPILED_TEMPLATE_CACHE_SIZE = int(os.getenv("COMPILED_TEMPLATE_CACHE_SIZE", 1000))
+
+
+@dataclass(frozen=True)
+class CompiledQuestion:
+    index: int
+    position: int  # Position in questions_list, used for in-place JSONB updates
+    text: str
+    response_format: str
+    explanation: str
+    range_start: int | None = None
+    range_end: int | None = None
+
+
+@dataclass(frozen=True)
+class CompiledQuestionnaire:
+    questions: dict[int, CompiledQuestion]
+
+    def __len__(self):
+        return len(self.questions)
+
+    def question(self, index: int) -> CompiledQuestion | None:
+        return self.questions.get(index)
+
+
+_compiled_templates = LRUCache(maxsize=COMPILED_TEMPLATE_CACHE_SIZE)
+_edited_at: dict[int, datetime] = {}  # Template id -> when its questions last changed, naive UTC
+_lock = threading.Lock()  # Filled from the template endpoint's threadpool as well as the event loop
+
+
+def compile_questions(questions: dict) -> CompiledQuestionnaire:
+    # Raises ValueError describing the first problem found
+    if not isinstance(questions, dict):
+        raise ValueError("questions must be an object")
+    questions_list = questions.get("questions_list")
+    answer_schemes = questions.get("answer_schemes")
+    if not isinstance(questions_list, list) or not questions_list:
+        raise ValueError("questions.questions_list must be a non-empty list")
+    if not isinstance(answer_schemes, dict):
+        raise ValueError("questions.answer_schemes must be an object")
+
+    compiled = {}
+    for position, question in enumerate(questions_list):
+        if not isinstance(question, dict):
+            raise ValueError(f"questions_list[{position}] must be an object")
+        index = question.get("index")
+        text = question.get("text")
+        response_format = question.get("response_format")
+        if not isinstance(index, int) or isinstance(index, bool):
+            raise ValueError(f"questions_list[{position}].index must be an integer")
+        if index in compiled:
+            raise ValueError(f"questions_list[{position}].index {index} is duplicated")
+        if not isinstance(text, str) or not text:
+            raise ValueError(f"questions_list[{position}].text must be a non-empty string")
+        if response_format not in answer_schemes:
+            raise ValueError(f"questions_list[{position}].response_format '{response_format}' is not in answer_schemes")
+
+        answer_scheme = answer_schemes[response_format]
+        if not isinstance(answer_scheme, dict) or not isinstance(answer_scheme.get("explanation"), str):
+            raise ValueError(f"answer_schemes.{response_format}.explanation must be a string")
+        range_start = range_end = None
+        if "range" in answer_scheme:
+            answer_range = answer_scheme["range"]
+            if not isinstance(answer_range, dict):
+                raise ValueError(f"answer_schemes.{response_format}.range must be an object")
+            range_start = answer_range.get("start")
+            range_end = answer_range.get("end")
+            if not isinstance(range_start, int) or not isinstance(range_end, int) or range_start > range_end:
+                raise ValueError(f"answer_schemes.{response_format}.range must have integer start <= end")
+
+        compiled[index] = CompiledQuestion(
+            index=index,
+            position=position,
+            text=text,
+            response_format=response_format,
+            explanation=answer_scheme["explanation"],
+            range_start=range_start,
+            range_end=range_end,
+        )
+
+    # The conversation advances current_status by one and finishes on the last index
+    if sorted(compiled) != list(range(len(compiled))):
+        raise ValueError("question indexes must run from 0 to len(questions_list) - 1")
+
+    return CompiledQuestionnaire(questions=compiled)
+
+
+def get_compiled_template(template_id: int | None, questions: dict) -> CompiledQuestionnaire:
+    if template_id is None:
+        return compile_questions(questions)
+    with _lock:
+        compiled = _compiled_templates.get(template_id)
+    if compiled is None:
+        compiled = compile_questions(questions)
+        cache_compiled_template(template_id, compiled)
+    return compiled
+
+
+def _copied_before_edit(questionnaire: Questionnaire) -> bool:
+    with _lock:
+        edited_at = _edited_at.get(questionnaire.template_id)
+    created_at = questionnaire.created_at
+    if edited_at is None or created_at is None:
+        return False
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return created_at < edited_at
+
+
+def cached_compiled_questionnaire(questionnaire: Questionnaire) -> CompiledQuestionnaire | None:
+    # Never reads the questions document, safe on the event loop
+    if _copied_before_edit(questionnaire):
+        return None
+    with _lock:
+        return _compiled_templates.get(questionnaire.template_id)
+
+
+def get_compiled_questionnaire(questionnaire: Questionnaire) -> CompiledQuestionnaire:
+    # Questionnaires copy their template's questions, so they share the template's compiled form.
+    # May read the questions document, so it runs on a database thread.
+    if _copied_before_edit(questionnaire):
+        return compile_questions(questionnaire.questions)
+    compiled = cached_compiled_questionnaire(questionnaire)
+    if compiled is None:
+        compiled = get_compiled_template(questionnaire.template_id, questionnaire.questions)
+    return compiled
+
+
+async def load_compiled_questionnaire(questionnaire: Questionnaire) -> CompiledQuestionnaire:
+    compiled = cached_compiled_questionnaire(questionnaire)
+    if compiled is None:
+        compiled = await run_db(get_compiled_questionnaire, questionnaire)
+    return compiled
+
+
+def cache_compiled_template(template_id: int, compiled: CompiledQuestionnaire):
+    with _lock:
+        _compiled_templates[template_id] = compiled
+
+
+def invalidate_compiled_template(template_id: int):
+    with _lock:
+        _compiled_templates.pop(template_id, None)
+        _edited_at[template_id] = datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def current_question_index(questionnaire: Questionnaire) -> int:
+    return int(questionnaire.current_status)
+
+
+async def load_current_question(questionnaire: Questionnaire) -> CompiledQuestion | None:
+    compiled = await load_compiled_questionnaire(questionnaire)
+    return compiled.question(current_question_index(questionnaire))
+
+
+@event.listens_for(Template, "after_update")
+def _template_updated(mapper, connection, target):
+    if inspect(target).attrs["questions"].history.has_changes():
+        invalidate_compiled_template(target.id)
+
+
+@event.listens_for(Template, "after_delete")
+def _template_deleted(mapper, connection, target):
+    invalidate_compiled_template(target.id)
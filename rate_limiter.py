@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import random
+import time
+import httpx
+from core import get_graph_client
+from metrics import GRAPH_REQUEST_SECONDS, GRAPH_REQUESTS, graph_outcome
+
+
+# ++++++++++++++++++++++++++++++++++
+# ++++++++ GRAPH RATE LIMITING +++++
+# ++++++++++++++++++++++++++++++++++
+
+# Every send to /{business_phone_number_id}/messages goes through a token bucket for that
+# business number (Team.whatsapp_number_id), so our throughput stays under Meta's per-number
+# limits. 429s, 5xx responses and transport errors are retried with jittered exponential
+# backoff, honouring Retry-After when Meta sends it.
+#
+# A read timeout or a dropped connection after the request was written may mean Graph accepted
+# the send and only the response was lost. Texts and templates are not retried then, since the
+# patient would get the message twice; only failures that show the request never reached Graph
+# (connect errors, no free connection) are. Read receipts and reactions are safe to repeat and
+# are retried on any transport error.
+
+GRAPH_RATE_LIMIT_PER_SECOND = float(os.getenv("GRAPH_RATE_LIMIT_PER_SECOND", 20))
+GRAPH_RATE_LIMIT_BURST = int(os.getenv("GRAPH_RATE_LIMIT_BURST", 20))
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", 4))
+GRAPH_RETRY_BASE_DELAY = float(os.getenv("GRAPH_RETRY_BASE_DELAY", 0.5))
+GRAPH_RETRY_MAX_DELAY = float(os.getenv("GRAPH_RETRY_MAX_DELAY", 30))
+
+IDEMPOTENT_CALLS = {"read", "reaction"}
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        # Waits for a token and returns how long the caller was held back
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            wait = 0.0
+            if self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate
+                await asyncio.sleep(wait)
+                self.updated_at = time.monotonic()
+                self.tokens = 0.0
+            else:
+                self.tokens -= 1
+            return wait
+
+
+_buckets: dict[str, TokenBucket] = {}
+_stats: dict[str, dict] = {}
+
+
+def _number_stats(business_phone_number_id: str) -> dict:
+    return _stats.setdefault(business_phone_number_id, {
+        "queue_depth": 0,
+        "sent": 0,
+        "throttled": 0,
+        "throttle_wait_seconds": 0.0,
+        "retries": 0,
+        "rate_limited": 0,
+        "server_errors": 0,
+        "failed": 0,
+        "not_retried": 0,  # Transport errors where the send may have been delivered
+    })
+
+
+def _retry_delay(attempt: int, response: httpx.Response | None) -> float:
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(float(retry_after), GRAPH_RETRY_MAX_DELAY)
+            except ValueError:
+                pass
+    # Full jitter: anywhere between 0 and the exponential ceiling
+    return random.uniform(0, min(GRAPH_RETRY_MAX_DELAY, GRAPH_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def graph_message_call(payload: dict) -> str:
+    # Metrics label for a /messages payload: text, template, reaction, ... or read for read receipts
+    if payload.get("status") == "read":
+        return "read"
+    return payload.get("type", "text")
+
+
+async def post_graph_message(business_phone_number_id, payload: dict) -> httpx.Response:
+    business_phone_number_id = str(business_phone_number_id)
+    call = graph_message_call(payload)
+    request_seconds = GRAPH_REQUEST_SECONDS.labels(call)
+    bucket = _buckets.get(business_phone_number_id)
+    if bucket is None:
+        bucket = _buckets[business_phone_number_id] = TokenBucket(GRAPH_RATE_LIMIT_PER_SECOND, GRAPH_RATE_LIMIT_BURST)
+    stats = _number_stats(business_phone_number_id)
+    client = get_graph_client()
+
+    attempt = 0
+    while True:
+        stats["queue_depth"] += 1
+        try:
+            waited = await bucket.acquire()
+        finally:
+            stats["queue_depth"] -= 1
+        if waited:
+            stats["throttled"] += 1
+            stats["throttle_wait_seconds"] += waited
+
+        response = None
+        started = time.perf_counter()
+        try:
+            try:
+                response = await client.post(f"/{business_phone_number_id}/messages", json=payload)
+            finally:
+                request_seconds.observe(time.perf_counter() - started)
+            GRAPH_REQUESTS.labels(call, graph_outcome(response.status_code)).inc()
+            if response.status_code == 429:
+                stats["rate_limited"] += 1
+            elif response.status_code >= 500:
+                stats["server_errors"] += 1
+            else:
+                response.raise_for_status()
+                stats["sent"] += 1
+                return response
+            if attempt >= GRAPH_MAX_RETRIES:
+                response.raise_for_status()
+        except httpx.RequestError as e:
+            GRAPH_REQUESTS.labels(call, "transport_error").inc()
+            if call not in IDEMPOTENT_CALLS and not isinstance(e, NOT_SENT_ERRORS):
+                stats["not_retried"] += 1
+                stats["failed"] += 1
+                raise
+            if attempt >= GRAPH_MAX_RETRIES:
+                stats["failed"] += 1
+                raise
+        except httpx.HTTPStatusError:
+            stats["failed"] += 1
+            raise
+
+        delay = _retry_delay(attempt, response)
+        logger.warning("Retrying Graph API send", extra={
+            "business_phone_number_id": business_phone_number_id,
+            "call": call,
+            "delay": round(delay, 2),
+            "attempt": attempt + 1,
+        })
+        stats["retries"] += 1
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+def graph_rate_limit_stats() -> dict:
+    return {number: dict(stats) for number, stats in _stats.items()}
@@ -0,0 +1,291 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import traceback
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+
+# ++++++++++++++++++++++++++++++++++
+# ++++++++ STRUCTURED LOGGING ++++++
+# ++++++++++++++++++++++++++++++++++
+
+# Log records are put on a bounded in-memory queue by the calling code and written to stdout
+# by a background thread, so logging never does a blocking write on the event loop. Records
+# below a logger's level are dropped by the logging module before anything is formatted, so
+# debug output on the conversation path is free unless it is switched on:
+#
+#     LOG_LEVEL=INFO                          default level for every module
+#     LOG_LEVELS=main=DEBUG,rate_limiter=WARNING
+#     LOG_FORMAT=json | console
+#
+# Records carry the request id (the HTTP request, or the queued webhook event a worker is
+# processing) and the patient id of the current task, taken from context variables. The
+# formatter runs on the logging thread and redacts message text and phone numbers: fields
+# listed in REDACTED_TEXT_FIELDS and REDACTED_PHONE_FIELDS, and anything that looks like a
+# phone number in the message, any other field or a traceback, so patient data goes in fields
+# rather than the message. Exceptions are logged with describe_error() or exc_info, never
+# str(e): database errors carry bound parameters. LOG_REDACT=false turns redaction off for local debugging. If the queue is full,
+# records are dropped and counted rather than blocking the caller.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_REDACT = os.getenv("LOG_REDACT", "true").lower() == "true"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+REDACTED_TEXT_FIELDS = {"text", "message_text", "body", "transcription", "interpretation", "answer", "comment"}
+REDACTED_PHONE_FIELDS = {"phone_number", "sender", "recipient", "to", "from_"}
+# International numbers as WhatsApp sends them (447912345678) or as entered (+44 7912 345678)
+_PHONE_NUMBER = re.compile(r"(?<![\w+])(?:\+\d[\d ]{8,16}\d|\d{10,15})(?!\d)")
+_REQUEST_ID = re.compile(r"[\w.-]{1,64}")
+
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+patient_id_var: ContextVar[int | None] = ContextVar("patient_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed in extra= and is logged as a field
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "request_id", "patient_id", "taskName"}
+
+_stats = {
+    "dropped": 0,
+}
+_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_listener: logging.handlers.QueueListener | None = None
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def bind_request_id(request_id: str | None = None) -> str:
+    # Binds for the current task (and anything it runs through run_db)
+    if not request_id or not _REQUEST_ID.fullmatch(request_id):
+        request_id = new_request_id()
+    request_id_var.set(request_id)
+    return request_id
+
+
+def bind_patient_id(patient_id: int | None):
+    patient_id_var.set(patient_id)
+
+
+@contextmanager
+def log_context(request_id: str | None = None, patient_id: int | None = None):
+    # Binds ids for a block of a long-lived task, e.g. one event in a worker loop
+    request_token = request_id_var.set(request_id)
+    patient_token = patient_id_var.set(patient_id)
+    try:
+        yield
+    finally:
+        patient_id_var.reset(patient_token)
+        request_id_var.reset(request_token)
+
+
+def redact_phone_number(value) -> str:
+    digits = re.sub(r"\D", "", str(value))
+    return f"***{digits[-4:]}" if len(digits) > 4 else "***"
+
+
+def redact_text(value) -> str:
+    return f"<redacted {len(str(value))} chars>"
+
+
+def redact_phone_numbers_in(text: str) -> str:
+    return _PHONE_NUMBER.sub(lambda match: redact_phone_number(match.group()), text)
+
+
+def _redact_value(value):
+    if isinstance(value, str):
+        return redact_phone_numbers_in(value)
+    if isinstance(value, (list, tuple, set)):
+        return [_redact_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _redact_value(item) for key, item in value.items()}
+    return value
+
+
+def _redact_field(name: str, value):
+    if value is None:
+        return None
+    if name in REDACTED_TEXT_FIELDS:
+        return redact_text(value)
+    if name in REDACTED_PHONE_FIELDS:
+        return redact_phone_number(value)
+    return _redact_value(value)
+
+
+def describe_error(error: BaseException) -> str:
+    # For error fields. Database errors render their statement, bound parameters and the failing
+    # row (message text, names, "Key (phone_number)=(...)"), so they are reduced to the class
+    # and the Postgres error code.
+    if not LOG_REDACT:
+        return f"{type(error).__name__}: {error}"
+    orig = getattr(error, "orig", None)
+    if hasattr(error, "statement") or hasattr(error, "pgcode"):
+        database_error = orig if orig is not None else error
+        pgcode = getattr(database_error, "pgcode", None)
+        if database_error is error:
+            return f"{type(error).__name__} (pgcode {pgcode})"
+        return f"{type(error).__name__} ({type(database_error).__name__}, pgcode {pgcode})"
+    return f"{type(error).__name__}: {error}"
+
+
+def _format_exception(exc_info) -> str:
+    # Frames are kept, but each exception in the chain is rendered through describe_error
+    error_type, error, tb = exc_info
+    if not LOG_REDACT or error is None:
+        return "".join(traceback.format_exception(error_type, error, tb))
+    lines = ["Traceback (most recent call last):\n", *traceback.format_tb(tb), describe_error(error) + "\n"]
+    seen = {id(error)}
+    cause = error.__cause__ or error.__context__
+    while cause is not None and id(cause) not in seen:
+        seen.add(id(cause))
+        lines.append(f"Caused by: {describe_error(cause)}\n")
+        cause = cause.__cause__ or cause.__context__
+    return "".join(lines)
+
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Runs on the caller's thread: only merges the arguments and captures the context, the
+        # formatting is left to the listener. Arguments may be ORM objects that must not be
+        # touched from another thread, so they are rendered here.
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _format_exception(record.exc_info)
+            record.exc_info = None
+        record.request_id = request_id_var.get()
+        record.patient_id = patient_id_var.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _stats["dropped"] += 1
+
+
+class _StructuredFormatter(logging.Formatter):
+    def fields(self, record: logging.LogRecord) -> tuple[str, dict, str | None]:
+        # (message, extra fields, traceback), redacted
+        fields = {
+            name: value for name, value in record.__dict__.items()
+            if name not in _RECORD_ATTRIBUTES
+        }
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if LOG_REDACT:
+            fields = {name: _redact_field(name, value) for name, value in fields.items()}
+            message = redact_phone_numbers_in(message)
+            if exc_text:
+                exc_text = redact_phone_numbers_in(exc_text)
+        return message, fields, exc_text
+
+
+class JSONFormatter(_StructuredFormatter):
+    def format(self, record: logging.LogRecord) -> str:
+        message, fields, exc_text = self.fields(record)
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": message,
+            "request_id": getattr(record, "request_id", None),
+            "patient_id": getattr(record, "patient_id", None),
+            **fields,
+        }
+        if exc_text:
+            entry["exception"] = exc_text
+        return json.dumps(entry, default=str)
+
+
+class ConsoleFormatter(_StructuredFormatter):
+    def format(self, record: logging.LogRecord) -> str:
+        message, fields, exc_text = self.fields(record)
+        context = " ".join(
+            f"{name}={value}" for name, value in (
+                ("request", getattr(record, "request_id", None)),
+                ("patient", getattr(record, "patient_id", None)),
+            ) if value is not None
+        )
+        line = f"{datetime.fromtimestamp(record.created).strftime('%H:%M:%S.%f')[:-3]} {record.levelname:<7} {record.name}"
+        if context:
+            line += f" [{context}]"
+        line += f" {message}"
+        if fields:
+            line += " " + " ".join(f"{name}={value}" for name, value in fields.items())
+        if exc_text:
+            line += "\n" + exc_text
+        return line
+
+
+class RequestIdMiddleware:
+    # Plain ASGI middleware: binds a request id for each HTTP request (the caller's X-Request-ID
+    # when it is well formed) and echoes it in the response headers
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        header = dict(scope["headers"]).get(b"x-request-id")
+        request_id = bind_request_id(header.decode("latin-1") if header else None)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
+
+
+def _module_levels(spec: str) -> dict[str, str]:
+    levels = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(ConsoleFormatter() if LOG_FORMAT == "console" else JSONFormatter())
+    _listener = logging.handlers.QueueListener(_queue, output)
+    _listener.start()
+    atexit.register(stop_logging)
+
+    root = logging.getLogger()
+    root.handlers = [_ContextQueueHandler(_queue)]
+    root.setLevel(LOG_LEVEL)
+    for name, level in _module_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+
+def stop_logging():
+    # Flushes whatever is still queued
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def logging_stats() -> dict:
+    return {
+        **_stats,
+        "queued": _queue.qsize(),
+        "queue_size": LOG_QUEUE_SIZE,
+    }
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import tempfile
+import threading
+import uuid
+from dataclasses import dataclass
+from typing import AsyncIterator
+import httpx
+
+
+# ++++++++++++++++++++++++++++++++++
+# ++++ TRANSCRIPTION BACKENDS ++++++
+# ++++++++++++++++++++++++++++++++++
+
+# TRANSCRIPTION_BACKEND picks what turns a voice note into text:
+#   http  - an OpenAI-compatible /audio/transcriptions endpoint (default). Point
+#           TRANSCRIPTION_URL at a local stub server for load tests.
+#   local - an offline faster-whisper model running in this process (pip install faster-whisper).
+# Backends take VoiceNotes, whose chunks can only be read once, and return the text.
+
+TRANSCRIPTION_BACKEND = os.getenv("TRANSCRIPTION_BACKEND", "http")
+TRANSCRIPTION_MODEL = os.getenv("TRANSCRIPTION_MODEL", "whisper-1")
+TRANSCRIPTION_URL = os.getenv("TRANSCRIPTION_URL", "https://api.openai.com/v1/audio/transcriptions")
+TRANSCRIPTION_TIMEOUT = float(os.getenv("TRANSCRIPTION_TIMEOUT", 120))
+LOCAL_WHISPER_MODEL = os.getenv("LOCAL_WHISPER_MODEL", "base")
+LOCAL_WHISPER_DEVICE = os.getenv("LOCAL_WHISPER_DEVICE", "cpu")
+LOCAL_WHISPER_COMPUTE_TYPE = os.getenv("LOCAL_WHISPER_COMPUTE_TYPE", "int8")
+
+# The transcription API picks the decoder from the file extension
+AUDIO_EXTENSIONS = {
+    "audio/ogg": "ogg",
+    "audio/mpeg": "mp3",
+    "audio/mp4": "m4a",
+    "audio/aac": "m4a",
+    "audio/wav": "wav",
+    "audio/webm": "webm",
+}
+
+
+@dataclass
+class VoiceNote:
+    media_id: str
+    mime_type: str
+    file_size: int | None  # None when the length is not known up front
+    chunks: AsyncIterator[bytes]
+
+    @property
+    def extension(self) -> str:
+        return AUDIO_EXTENSIONS.get(self.mime_type, "ogg")
+
+
+class TranscriptionBackend:
+    name = "base"
+
+    async def transcribe(self, note: VoiceNote) -> str:
+        raise NotImplementedError
+
+    async def transcribe_batch(self, notes: list[VoiceNote]) -> list[str]:
+        # Backends without a native batch call transcribe the notes side by side
+        return list(await asyncio.gather(*(self.transcribe(note) for note in notes)))
+
+    async def close(self):
+        pass
+
+
+class HTTPTranscriptionBackend(TranscriptionBackend):
+    name = "http"
+
+    def __init__(self):
+        self.client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {os.getenv('OPENAI_KEY')}"},
+            timeout=httpx.Timeout(TRANSCRIPTION_TIMEOUT, connect=5),
+        )
+
+    async def _multipart_body(self, note: VoiceNote, head: bytes, tail: bytes):
+        yield head
+        async for chunk in note.chunks:
+            yield chunk
+        yield tail
+
+    async def transcribe(self, note: VoiceNote) -> str:
+        # The note's chunks are streamed straight into the upload, it is never held in memory whole
+        boundary = uuid.uuid4().hex
+        head = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="model"\r\n\r\n{TRANSCRIPTION_MODEL}\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="audio.{note.extension}"\r\n'
+            f'Content-Type: {note.mime_type}\r\n\r\n'
+        ).encode()
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+        if note.file_size is not None:
+            # Without a length the upload falls back to chunked transfer encoding
+            headers["Content-Length"] = str(len(head) + note.file_size + len(tail))
+
+        response = await self.client.post(TRANSCRIPTION_URL, content=self._multipart_body(note, head, tail), headers=headers)
+        response.raise_for_status()
+        return response.json().get("text")
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    name = "local"
+
+    def __init__(self):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise RuntimeError("TRANSCRIPTION_BACKEND=local requires the faster-whisper package")
+        self.model = WhisperModel(LOCAL_WHISPER_MODEL, device=LOCAL_WHISPER_DEVICE, compute_type=LOCAL_WHISPER_COMPUTE_TYPE)
+        self.lock = threading.Lock()  # One model instance, one transcription at a time
+
+    async def _write_file(self, note: VoiceNote) -> str:
+        # The model reads from disk, so the note goes to a temporary file rather than memory
+        with tempfile.NamedTemporaryFile(suffix=f".{note.extension}", delete=False) as f:
+            async for chunk in note.chunks:
+                f.write(chunk)
+            return f.name
+
+    def _transcribe_files(self, paths: list[str]) -> list[str]:
+        texts = []
+        with self.lock:
+            for path in paths:
+                segments, _ = self.model.transcribe(path)
+                texts.append(" ".join(segment.text.strip() for segment in segments))
+        return texts
+
+    async def transcribe(self, note: VoiceNote) -> str:
+        return (await self.transcribe_batch([note]))[0]
+
+    async def transcribe_batch(self, notes: list[VoiceNote]) -> list[str]:
+        paths = []
+        try:
+            for note in notes:
+                paths.append(await self._write_file(note))
+            # One thread hop for the whole batch, the model stays warm between notes
+            return await asyncio.to_thread(self._transcribe_files, paths)
+        finally:
+            for path in paths:
+                os.unlink(path)
+
+
+TRANSCRIPTION_BACKENDS = {
+    "http": HTTPTranscriptionBackend,
+    "local": LocalWhisperBackend,
+}
+
+_backend: TranscriptionBackend | None = None
+
+
+def get_transcription_backend() -> TranscriptionBackend:
+    global _backend
+    if _backend is None:
+        if TRANSCRIPTION_BACKEND not in TRANSCRIPTION_BACKENDS:
+            raise ValueError(f"Unknown TRANSCRIPTION_BACKEND '{TRANSCRIPTION_BACKEND}', expected one of {sorted(TRANSCRIPTION_BACKENDS)}")
+        _backend = TRANSCRIPTION_BACKENDS[TRANSCRIPTION_BACKEND]()
+    return _backend
+
+
+async def close_transcription_backend():
+    global _backend
+    if _backend is not None:
+        await _backend.close()
+        _backend = None
@@ -0,0 +1,332 @@
+import asyncio
+import logging
+import os
+import random
+import traceback
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, or_, select, text
+from sqlalchemy.orm import Session, aliased
+from core import SessionLocal, count_queries, run_db
+from audio_pipeline import prune_transcriptions
+from dedup import prune_processed_messages
+from metrics import WEBHOOK_EVENTS, WEBHOOKS_IN_FLIGHT
+from structured_logging import describe_error, log_context
+from models import WebhookEvent
+
+
+# ++++++++++++++++++++++++++++++++++
+# ++++++++++ WEBHOOK QUEUE +++++++++
+# ++++++++++++++++++++++++++++++++++
+
+# Incoming webhooks are written to the Webhook_events table and acknowledged straight away.
+# A fixed pool of workers drains the table, so slow LLM/transcription calls never hold up
+# the response to Meta. Rows left in "processing" by a crashed or restarted worker are put
+# back to "pending" once they are older than WEBHOOK_STALE_AFTER seconds. A failed event is
+# retried after an exponential backoff (next_attempt_at), so a short Graph/OpenAI/database outage
+# does not use up all of its attempts within a few polls.
+#
+# Each patient's messages are handled in order across deliveries. A delivery is stored as one
+# event per sender, and an event is only claimed once every earlier event from its sender is
+# done or has failed for good. Inserts for one sender are serialized with an advisory lock, so
+# ids (the claim order) follow arrival order even when two deliveries are acknowledged at once.
+#
+# Finished events hold full patient messages, so they are only kept for a while: the recovery
+# loop deletes done events after WEBHOOK_DONE_RETENTION_DAYS and failed ones, kept longer for
+# investigation, after WEBHOOK_FAILED_RETENTION_DAYS.
+
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 3))
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", 2))
+WEBHOOK_STALE_AFTER = int(os.getenv("WEBHOOK_STALE_AFTER", 300))
+WEBHOOK_RETRY_BASE_DELAY = float(os.getenv("WEBHOOK_RETRY_BASE_DELAY", 5))
+WEBHOOK_RETRY_MAX_DELAY = float(os.getenv("WEBHOOK_RETRY_MAX_DELAY", 300))
+WEBHOOK_DONE_RETENTION_DAYS = float(os.getenv("WEBHOOK_DONE_RETENTION_DAYS", 7))
+WEBHOOK_FAILED_RETENTION_DAYS = float(os.getenv("WEBHOOK_FAILED_RETENTION_DAYS", 30))
+WEBHOOK_PRUNE_BATCH_SIZE = int(os.getenv("WEBHOOK_PRUNE_BATCH_SIZE", 1000))
+
+logger = logging.getLogger(__name__)
+
+_wakeup = asyncio.Event()
+_tasks: list[asyncio.Task] = []
+_stats = {
+    "enqueued": 0,
+    "processed": 0,
+    "retried": 0,
+    "failed": 0,
+    "recovered": 0,
+    "pruned": 0,
+    "in_flight": 0,
+    "queries": 0,  # Statements issued to enqueue, claim and process events
+    "batches": 0,
+    "last_batch_messages": 0,
+    "last_batch_statuses": 0,
+    "last_batch_senders": 0,
+    "last_batch_seconds": 0.0,
+    "max_batch_messages": 0,
+    "max_batch_seconds": 0.0,
+}
+WEBHOOKS_IN_FLIGHT.set_function(lambda: _stats["in_flight"])
+
+
+def split_by_sender(payload: dict) -> list[tuple[str | None, dict]]:
+    # [(sender, payload)]: one payload per sender with only that sender's messages, plus one
+    # with no sender for statuses and anything else in the delivery
+    parts = {}
+
+    def add_change(sender, entry: dict, change: dict, value: dict):
+        part = parts.setdefault(sender, {**payload, "entry": []})
+        part["entry"].append({**entry, "changes": [{**change, "value": value}]})
+
+    for entry in payload.get("entry", []):
+        for change in entry.get("changes", []):
+            value = change.get("value", {})
+            shared = {key: item for key, item in value.items() if key not in ("messages", "statuses")}
+            messages_by_sender = {}
+            for message in value.get("messages") or []:
+                messages_by_sender.setdefault(message.get("from"), []).append(message)
+            for sender, messages in messages_by_sender.items():
+                add_change(sender, entry, change, {**shared, "messages": messages})
+            if value.get("statuses") or not messages_by_sender:
+                add_change(None, entry, change, {**shared, "statuses": value.get("statuses") or []})
+    return list(parts.items()) or [(None, payload)]
+
+
+def _insert_webhook_events(payload: dict, db: Session) -> int:
+    now = datetime.now(timezone.utc)
+    events = split_by_sender(payload)
+    for sender in sorted(sender for sender, _ in events if sender is not None):
+        db.execute(text("SELECT pg_advisory_xact_lock(hashtext(:sender))"), {"sender": sender})
+    db.add_all([
+        WebhookEvent(payload=part, sender=sender, status="pending", created_at=now)
+        for sender, part in events
+    ])
+    db.commit()
+    return len(events)
+
+
+async def enqueue_webhook_event(payload: dict, db: Session):
+    with count_queries() as queries:
+        enqueued = await run_db(_insert_webhook_events, payload, db)
+    _stats["queries"] += queries[0]
+    _stats["enqueued"] += enqueued
+    WEBHOOK_EVENTS.labels("enqueued").inc(enqueued)
+    _wakeup.set()
+
+
+def claim_next_event(db: Session) -> WebhookEvent | None:
+    # SKIP LOCKED lets several workers (and several app instances) claim rows without blocking each other.
+    # An event waits while an earlier one from the same sender is pending (including a backed-off retry)
+    # or processing.
+    earlier = aliased(WebhookEvent)
+    earlier_unfinished = select(earlier.id).where(
+        earlier.sender == WebhookEvent.sender,
+        earlier.id < WebhookEvent.id,
+        earlier.status.in_(("pending", "processing"))
+    ).exists()
+    event = db.query(WebhookEvent).filter(
+        WebhookEvent.status == "pending",
+        or_(WebhookEvent.next_attempt_at.is_(None), WebhookEvent.next_attempt_at <= datetime.now(timezone.utc)),
+        ~earlier_unfinished
+    ).order_by(WebhookEvent.id).with_for_update(skip_locked=True).first()
+    if event is None:
+        db.rollback()
+        return None
+    event.status = "processing"
+    event.locked_at = datetime.now(timezone.utc)
+    event.attempts = event.attempts + 1
+    db.commit()
+    return event
+
+
+def recover_stale_events(db: Session) -> int:
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=WEBHOOK_STALE_AFTER)
+    recovered = db.query(WebhookEvent).filter(
+        WebhookEvent.status == "processing",
+        WebhookEvent.locked_at < stale_before
+    ).update({"status": "pending", "locked_at": None}, synchronize_session=False)
+    db.commit()
+    return recovered
+
+
+def prune_finished_events(db: Session) -> int:
+    # Deleted in batches so no single statement holds row locks on a large backlog for long
+    pruned = 0
+    now = datetime.now(timezone.utc)
+    for status, days in (("done", WEBHOOK_DONE_RETENTION_DAYS), ("failed", WEBHOOK_FAILED_RETENTION_DAYS)):
+        batch = select(WebhookEvent.id).where(
+            WebhookEvent.status == status,
+            WebhookEvent.created_at < now - timedelta(days=days)
+        ).limit(WEBHOOK_PRUNE_BATCH_SIZE)
+        while True:
+            deleted = db.query(WebhookEvent).filter(WebhookEvent.id.in_(batch)).delete(synchronize_session=False)
+            db.commit()
+            pruned += deleted
+            if deleted < WEBHOOK_PRUNE_BATCH_SIZE:
+                break
+    return pruned
+
+
+def _complete_event(event: WebhookEvent, db: Session):
+    event.status = "done"
+    event.processed_at = datetime.now(timezone.utc)
+    event.error = None
+    db.commit()
+
+
+def retry_delay(attempts: int) -> float:
+    # Exponential in the attempts made so far, with jitter so events failed by one outage spread out
+    delay = min(WEBHOOK_RETRY_MAX_DELAY, WEBHOOK_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _fail_event(event: WebhookEvent, error: str, db: Session) -> bool:
+    # Returns True when the event will be retried
+    db.rollback()
+    event.error = error
+    retry = event.attempts < WEBHOOK_MAX_ATTEMPTS
+    if retry:
+        event.status = "pending"
+        event.locked_at = None
+        event.next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=retry_delay(event.attempts))
+    else:
+        event.status = "failed"
+    db.commit()
+    return retry
+
+
+async def _process_event(event: WebhookEvent, handler, db: Session):
+    _stats["in_flight"] += 1
+    try:
+        with log_context(request_id=f"webhook-{event.id}"):
+            await _run_handler(event, handler, db)
+    finally:
+        _stats["in_flight"] -= 1
+
+
+async def _run_handler(event: WebhookEvent, handler, db: Session):
+    try:
+        await handler(event.payload)
+        await run_db(_complete_event, event, db)
+        _stats["processed"] += 1
+        WEBHOOK_EVENTS.labels("processed").inc()
+    except Exception:
+        logger.exception("Error processing webhook event", extra={"event_id": event.id, "attempts": event.attempts})
+        if await run_db(_fail_event, event, traceback.format_exc(), db):
+            _stats["retried"] += 1
+            WEBHOOK_EVENTS.labels("retried").inc()
+        else:
+            _stats["failed"] += 1
+            WEBHOOK_EVENTS.labels("failed").inc()
+
+
+def record_webhook_batch(messages: int, statuses: int, senders: int, seconds: float):
+    _stats["batches"] += 1
+    _stats["last_batch_messages"] = messages
+    _stats["last_batch_statuses"] = statuses
+    _stats["last_batch_senders"] = senders
+    _stats["last_batch_seconds"] = seconds
+    _stats["max_batch_messages"] = max(_stats["max_batch_messages"], messages)
+    _stats["max_batch_seconds"] = max(_stats["max_batch_seconds"], seconds)
+
+
+async def _worker(handler):
+    while True:
+        db = SessionLocal()
+        try:
+            with count_queries() as queries:
+                event = await run_db(claim_next_event, db)
+                if event is not None:
+                    await _process_event(event, handler, db)
+            if event is not None:
+                _stats["queries"] += queries[0]
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Webhook worker error", extra={"error": describe_error(e)})
+        finally:
+            await run_db(db.close)
+
+        # Nothing to do, sleep until a new event is enqueued or the poll interval passes
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=WEBHOOK_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+
+
+async def _recovery_loop():
+    while True:
+        db = SessionLocal()
+        try:
+            recovered = await run_db(recover_stale_events, db)
+            if recovered:
+                logger.info("Recovered unprocessed webhook events", extra={"recovered": recovered})
+                _stats["recovered"] += recovered
+                _wakeup.set()
+        except Exception as e:
+            logger.error("Webhook recovery error", extra={"error": describe_error(e)})
+        finally:
+            await run_db(db.close)
+        await _run_retention()
+        await asyncio.sleep(WEBHOOK_STALE_AFTER)
+
+
+async def _run_retention():
+    db = SessionLocal()
+    try:
+        pruned = await run_db(prune_finished_events, db)
+        if pruned:
+            logger.info("Pruned finished webhook events", extra={"pruned": pruned})
+            _stats["pruned"] += pruned
+        pruned_claims = await run_db(prune_processed_messages, db)
+        if pruned_claims:
+            logger.info("Pruned processed message ids", extra={"pruned": pruned_claims})
+        pruned_transcriptions = await run_db(prune_transcriptions)
+        if pruned_transcriptions:
+            logger.info("Pruned cached transcriptions", extra={"pruned": pruned_transcriptions})
+    except Exception as e:
+        logger.error("Webhook pruning error", extra={"error": describe_error(e)})
+    finally:
+        await run_db(db.close)
+
+
+def start_webhook_workers(handler):
+    # handler is an async callable taking the raw payload dict
+    if _tasks:
+        return
+    _tasks.append(asyncio.create_task(_recovery_loop()))
+    for _ in range(WEBHOOK_WORKERS):
+        _tasks.append(asyncio.create_task(_worker(handler)))
+    _wakeup.set()
+    logger.info("Started webhook workers", extra={"workers": WEBHOOK_WORKERS})
+
+
+async def stop_webhook_workers():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+
+
+def webhook_queue_stats(db: Session) -> dict:
+    pending, oldest = db.query(
+        func.count(WebhookEvent.id),
+        func.min(WebhookEvent.created_at)
+    ).filter(WebhookEvent.status == "pending").one()
+    processing = db.query(func.count(WebhookEvent.id)).filter(WebhookEvent.status == "processing").scalar()
+    waiting_retry = db.query(func.count(WebhookEvent.id)).filter(
+        WebhookEvent.status == "pending",
+        WebhookEvent.next_attempt_at > datetime.now(timezone.utc)
+    ).scalar()
+    oldest_age = None
+    if oldest is not None:
+        oldest_age = (datetime.now(timezone.utc).replace(tzinfo=None) - oldest).total_seconds()
+    return {
+        **_stats,
+        "workers": WEBHOOK_WORKERS,
+        "pending": pending,
+        "processing": processing,
+        "waiting_retry": waiting_retry,
+        "oldest_pending_age_seconds": oldest_age,
+    }